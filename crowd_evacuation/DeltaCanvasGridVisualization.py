@@ -0,0 +1,124 @@
+# -*- coding: utf-8 -*-
+"""
+Delta Canvas Grid Module
+============
+
+Grid visualization that only sends what changed since the previous frame
+
+"""
+import numpy as np
+from mesa.visualization.ModularVisualization import VisualizationElement
+
+from crowd_evacuation.cell_types import CellType
+
+
+class DeltaCanvasGrid(VisualizationElement):
+    """ Draws a LayeredGrid like mesa's CanvasGrid, with the same portrayals, but sending the browser only what
+    changed since the previous frame instead of portraying every agent of the grid on every frame.
+
+    The cells of the static types (walls and exits) are portrayed and sent once, drawn by the client on a background
+    canvas. People are portrayed once, when they appear, and then only their new position is sent when they move.
+    The rest of the cells (fire) are portrayed again on every frame, but only sent when their portrayal changed
+    (e.g. from "On Fire" to "Burned Out").
+
+    Frames are dictionaries with the keys:
+        full: True if the client must drop what it has, the first frame of every model
+        static: Portrayals of the static cells, by layer (only in full frames)
+        moved: [key, x, y] of the agents that moved
+        added: Portrayals of new or changed objects, with their key
+        removed: Keys of the objects that are no longer on the grid
+
+    The frames are computed from the type and agent_index layers of the grid, so the grid must be a LayeredGrid.
+    Static layers should have lower Layer numbers than the dynamic ones, they are drawn below them.
+
+    The server keeps the state of the last frame sent, so the frames are only correct when a single browser is
+    showing the model, as usual.
+    """
+    package_includes = ["GridDraw.js", "InteractionHandler.js"]
+    local_includes = ["DeltaCanvasModule.js"]
+
+    def __init__(self, portrayal_method, grid_width, grid_height, canvas_width=500, canvas_height=500,
+                 static_types=(CellType.WALL, CellType.EXIT)):
+        """
+        Create a new delta encoded grid visualization.
+
+        Args:
+            portrayal_method: Function that converts an agent to a portrayal, as for CanvasGrid
+            grid_width, grid_height: Size of the grid, in cells.
+            canvas_width, canvas_height: Size of the canvas to draw in the client, in pixels.
+            static_types: CellType codes of the agents that never move nor change
+        """
+        self.portrayal_method = portrayal_method
+        self.grid_width = grid_width
+        self.grid_height = grid_height
+        self.canvas_width = canvas_width
+        self.canvas_height = canvas_height
+        self.static_types = tuple(int(cell_type) for cell_type in static_types)
+
+        self._model = None  # Model of the last frame
+        self._static = None  # Type layer of the static cells of the last frame
+        self._people = {}  # unique_id to position of the people of the last frame
+        self._cells = {}  # Position to portrayal of the other dynamic cells of the last frame
+
+        new_element = "new DeltaCanvasModule({}, {}, {}, {})".format(canvas_width, canvas_height, grid_width,
+                                                                     grid_height)
+        self.js_code = "elements.push(" + new_element + ");"
+
+    def _portray(self, agent, x, y, key):
+        portrayal = self.portrayal_method(agent)
+        if portrayal:
+            portrayal["x"] = x
+            portrayal["y"] = y
+            portrayal["key"] = key
+        return portrayal
+
+    def render(self, model):
+        grid = model.grid
+        types = grid.types
+        agent_index = grid.agent_index
+        static = np.where(np.isin(types, self.static_types), types, 0)
+        frame = {"full": False, "moved": [], "added": [], "removed": []}
+
+        # A new model, or a building that changed, is sent from scratch
+        if model is not self._model or not np.array_equal(static, self._static):
+            self._model = model
+            self._static = static
+            self._people = {}
+            self._cells = {}
+            layers = {}
+            ys, xs = np.nonzero(static)
+            for x, y in zip(xs.tolist(), ys.tolist()):
+                portrayal = self._portray(grid[x][y], x, y, None)
+                if portrayal:
+                    layers.setdefault(portrayal["Layer"], []).append(portrayal)
+            frame["full"] = True
+            frame["static"] = layers
+
+        # People: compare the positions with the ones of the last frame
+        ys, xs = np.nonzero(agent_index >= 0)
+        people = dict(zip(agent_index[ys, xs].tolist(), zip(xs.tolist(), ys.tolist())))
+        previous = self._people
+        for unique_id, pos in people.items():
+            old_pos = previous.get(unique_id)
+            if old_pos is None:
+                portrayal = self._portray(grid[pos[0]][pos[1]], pos[0], pos[1], "a{}".format(unique_id))
+                if portrayal:
+                    frame["added"].append(portrayal)
+            elif old_pos != pos:
+                frame["moved"].append(["a{}".format(unique_id), pos[0], pos[1]])
+        frame["removed"] += ["a{}".format(unique_id) for unique_id in previous if unique_id not in people]
+        self._people = people
+
+        # Everything else: portray it again and send it if it looks different
+        ys, xs = np.nonzero((types != 0) & (agent_index < 0) & (static == 0))
+        cells = {}
+        for x, y in zip(xs.tolist(), ys.tolist()):
+            portrayal = self._portray(grid[x][y], x, y, "c{},{}".format(x, y))
+            if not portrayal:
+                continue
+            cells[(x, y)] = portrayal
+            if self._cells.get((x, y)) != portrayal:
+                frame["added"].append(portrayal)
+        frame["removed"] += ["c{},{}".format(x, y) for x, y in self._cells if (x, y) not in cells]
+        self._cells = cells
+        return frame
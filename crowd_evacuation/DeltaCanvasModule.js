@@ -0,0 +1,76 @@
+// Grid drawn from the frames of DeltaCanvasGrid: the static cells are drawn once on a background canvas, and the
+// rest of the objects are kept by key and updated with the changes of every frame.
+
+var DeltaCanvasModule = function(canvas_width, canvas_height, grid_width, grid_height) {
+    // Create the tags like mesa's CanvasModule, with absolute positioning:
+    var canvas_tag = `<canvas width="${canvas_width}" height="${canvas_height}" class="world-grid"/>`;
+    var parent_div_tag = '<div style="height:' + canvas_height + 'px;" class="world-grid-parent"></div>';
+
+    var canvas = $(canvas_tag)[0];
+    var interaction_canvas = $(canvas_tag)[0];
+    var parent = $(parent_div_tag)[0];
+    $("#elements").append(parent);
+    parent.append(canvas);
+    parent.append(interaction_canvas);
+
+    // Background canvas with the static cells, never added to the page
+    var static_canvas = document.createElement("canvas");
+    static_canvas.width = canvas_width;
+    static_canvas.height = canvas_height;
+
+    var context = canvas.getContext("2d");
+    var interactionHandler = new InteractionHandler(canvas_width, canvas_height, grid_width, grid_height,
+                                                    interaction_canvas.getContext("2d"));
+    var canvasDraw = new GridVisualization(canvas_width, canvas_height, grid_width, grid_height, context,
+                                           interactionHandler);
+    var staticDraw = new GridVisualization(canvas_width, canvas_height, grid_width, grid_height,
+                                           static_canvas.getContext("2d"), null);
+
+    var objects = {};  // key to portrayal of every object that isn't static
+
+    // GridVisualization modifies the portrayals it draws (flips y, turns Color into a list), so it gets copies
+    var copyLayers = function(portrayals) {
+        var layers = {};
+        for (var i in portrayals) {
+            var p = portrayals[i];
+            if (!(p.Layer in layers))
+                layers[p.Layer] = [];
+            layers[p.Layer].push(Object.assign({}, p));
+        }
+        return layers;
+    };
+
+    this.render = function(data) {
+        if (data.full) {
+            objects = {};
+            staticDraw.resetCanvas();
+            for (var layer in data.static)
+                staticDraw.drawLayer(data.static[layer]);
+        }
+        for (var i in data.removed)
+            delete objects[data.removed[i]];
+        for (var i in data.moved) {
+            var move = data.moved[i];
+            var p = objects[move[0]];
+            if (p) {
+                p.x = move[1];
+                p.y = move[2];
+            }
+        }
+        for (var i in data.added)
+            objects[data.added[i].key] = data.added[i];
+
+        canvasDraw.resetCanvas();
+        context.drawImage(static_canvas, 0, 0);
+        var layers = copyLayers(Object.values(objects));
+        for (var layer in layers)
+            canvasDraw.drawLayer(layers[layer]);
+        canvasDraw.drawGridLines();
+    };
+
+    this.reset = function() {
+        objects = {};
+        staticDraw.resetCanvas();
+        canvasDraw.resetCanvas();
+    };
+};
@@ -1,34 +1,69 @@
 import argparse
-from functools import partial
 from pathlib import Path
 
-from mesa.batchrunner import BatchRunner
+import numpy as np
 
-from crowd_evacuation.model import EvacuationModel, count_agents_saved
+from crowd_evacuation.civilian_agent import CivilianAgent
+from crowd_evacuation.ensemble import EnsembleModel
+from crowd_evacuation.floor_plan import e_building, load_floor_plan
+from crowd_evacuation.layout_cache import get_layout
+from crowd_evacuation.model import EvacuationModel
+from crowd_evacuation.parallel_batch_runner import ParallelBatchRunner
+from crowd_evacuation.reasons import Reasons
+from crowd_evacuation.result_store import ResultStore
 
 
 def get_agents_saved(model):
     return len(model.agents_saved)
 
 
-def get_list_saved_agents(model):
-    list_of_agents = []
-    for agent in model.agents_saved:
-        list_of_agents.append(agent.attr_to_list())
-    return list_of_agents
+def get_agents_killed(model):
+    return len(model.agents_killed)
 
 
-def get_list_dead_agents(model):
-    list_of_agents = []
-    for agent in model.agents_killed:
-        list_of_agents.append(agent.attr_to_list())
-    return list_of_agents
+def get_agent_records(model):
+    """
+    Traits and outcome of every civilian and steward of the model, as typed columns for a ResultStore table.
+    outcome is the value of the Reasons the agent left the building for, or 0 if it is still inside. exit_x and
+    exit_y are -1 for the agents that weren't saved.
+
+    Args:
+        model (EvacuationModel): Model at the end of a run
+
+    Returns:
+        (dict): Column name to a NumPy array with one element per agent
+    """
+    inside = [agent for agent in model.schedule.agents if isinstance(agent, CivilianAgent)]
+    agents = model.agents_saved + model.agents_killed + inside
+    outcomes = [Reasons.SAVED.value] * len(model.agents_saved)
+    outcomes += [Reasons.KILLED_BY_FIRE.value] * len(model.agents_killed)
+    outcomes += [0] * len(inside)
+    records = [agent.attr_to_list() for agent in agents]
+    exits = [agent._exit_point if agent._exit_point[0] is not None else (-1, -1) for agent in agents]
+    return {
+        "unique_id": np.array([r[0] for r in records], dtype=np.int32),
+        "age": np.array([r[1] for r in records], dtype=np.int16),
+        "weight": np.array([r[2] for r in records], dtype=np.float32),
+        "visual_range": np.array([r[3] for r in records], dtype=np.int16),
+        "speed": np.array([r[4] for r in records], dtype=np.int16),
+        "being_risky": np.array([r[5] for r in records], dtype=np.int8),
+        "outcome": np.array(outcomes, dtype=np.int8),
+        "exit_x": np.array([e[0] for e in exits], dtype=np.int16),
+        "exit_y": np.array([e[1] for e in exits], dtype=np.int16),
+    }
+
+
+def get_replicate_agent_records(replicate):
+    """
+    Same columns as get_agent_records, for a replicate of an ensemble run (ensemble.EnsembleReplicate).
+    """
+    return replicate.agent_records()
 
 
 def parse_arguments():
     parser = argparse.ArgumentParser(description='Simulates evacuation of a building')
     parser.add_argument('--filename', type=str, required=True,
-                        help='The name of the file where the results will be saved')
+                        help='The name of the directory where the results will be saved')
     parser.add_argument('--n_civilians', type=int, default=501,
                         help='Maximum number of civilians for the batch run. It will run experiments from 100 civilian '
                              'to n_civilians')
@@ -43,37 +78,85 @@ def parse_arguments():
                         help='If civilians will exchange information or not')
     parser.add_argument('--fire_init', type=int, nargs='+', default=(47, 15),
                         help='Initial coordinates of the fire hazard. First x-coordinate then y-coordinate')
+    parser.add_argument('--floor_plan', type=str, default=None,
+                        help='File of the building (text, JSON or image, see floor_plan.py). The original E-shaped '
+                             'building by default')
+    parser.add_argument('--workers', type=int, default=None,
+                        help='Number of processes running the simulations in parallel. Defaults to the number of CPUs')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='Seed of the batch run. The seed of every run is derived from it and the run parameters')
+    parser.add_argument('--iterations', type=int, default=10,
+                        help='Number of runs for every combination of parameters. The maximum when --tolerance is set')
+    parser.add_argument('--tolerance', type=float, default=None,
+                        help='Adaptive replication: stop running a combination of parameters when the 95%% confidence '
+                             'interval of the agents saved is within +- tolerance')
+    parser.add_argument('--min_iterations', type=int, default=3,
+                        help='Minimum number of runs for every combination of parameters when --tolerance is set')
+    parser.add_argument('--converge_deaths', action='store_true',
+                        help='With --tolerance, the number of deaths has to converge as well')
+    parser.add_argument('--approximate_ensemble', dest='ensemble', action='store_true',
+                        help='Run all the iterations of every combination of parameters at once, as the replicates '
+                             'of a vectorized ensemble.EnsembleModel instead of the agent model. It is an '
+                             'approximation: the people saved agree within about 1%% on average when the fire is away '
+                             'from the exits, but it can save about 25%% fewer people when the fire starts next to '
+                             'them, so its results should not be mixed with agent model runs (a store only resumes '
+                             'runs of the same engine). Not compatible with --tolerance')
+    parser.add_argument('--activation', type=str, default="random", choices=("random", "simultaneous"),
+                        help='Whether civilians and stewards move one at a time in a random order or all at the same '
+                             'time (see scheduling.SimultaneousActivation). Not compatible with --approximate_ensemble')
     args = parser.parse_args()
-    return (args.filename, args.n_civilians, args.step_civilians, args.n_stewards, args.step_stewards,
-            args.info_exchange, tuple(args.fire_init))
+    if args.ensemble and args.activation != "random":
+        parser.error("--activation is not compatible with --approximate_ensemble")
+    if args.ensemble and args.tolerance is not None:
+        parser.error("--tolerance is not compatible with --approximate_ensemble")
+    return args
 
 
 if __name__ == '__main__':
-    filename, n_civilians, step_civilians, n_stewards, step_stewards, info_exchange, fire_init = parse_arguments()
+    args = parse_arguments()
+    batch_dir = Path.cwd() / "batch_results"
+    if not batch_dir.exists():
+        Path.mkdir(batch_dir)
     fixed_params = {
-        "civil_info_exchange": info_exchange,
-        "fire_x": fire_init[0],
-        "fire_y": fire_init[1],
+        "civil_info_exchange": args.info_exchange,
+        "fire_x": args.fire_init[0],
+        "fire_y": args.fire_init[1],
     }
+    if args.floor_plan is not None:
+        fixed_params["floor_plan"] = args.floor_plan
+    if args.activation != "random":
+        fixed_params["activation"] = args.activation
     variable_params = {
-        "N": range(100, n_civilians, step_civilians),
-        "K": range(0, n_stewards, step_stewards),
+        "N": range(100, args.n_civilians, args.step_civilians),
+        "K": range(0, args.n_stewards, args.step_stewards),
     }
+    # The graph and distance fields of the building are built (or loaded from the cache directory) before the worker
+    # processes are started, which then share them instead of building them for every run
+    floor_plan = e_building() if args.floor_plan is None else load_floor_plan(args.floor_plan)
+    get_layout(floor_plan, "grid" if args.ensemble else "networkx", batch_dir / "layout_cache")
 
-    batch_run = BatchRunner(
-        EvacuationModel,
+    # Results are written to the store as every run finishes, running the same command again after a crash resumes
+    # the batch
+    batch_run = ParallelBatchRunner(
+        EnsembleModel if args.ensemble else EvacuationModel,
         variable_params,
         fixed_params,
-        iterations=10,  # For now, then could be 100
+        iterations=args.iterations,
         max_steps=500,
-        model_reporters={"Agents saved": get_agents_saved,
-                         "List saved agents": get_list_saved_agents,
-                         "List dead agents": get_list_dead_agents}
+        model_reporters={"agents_saved": get_agents_saved,
+                         "agents_killed": get_agents_killed,
+                         "agents": get_replicate_agent_records if args.ensemble else get_agent_records},
+        workers=args.workers,
+        base_seed=args.seed,
+        store=ResultStore(batch_dir / args.filename),
+        tolerance=args.tolerance,
+        metrics=("agents_saved", "agents_killed") if args.converge_deaths else ("agents_saved",),
+        min_iterations=args.min_iterations,
+        ensemble=args.ensemble
     )
 
     batch_run.run_all()
-    batch_dir = Path.cwd() / "batch_results"
-    if not batch_dir.exists():
-        Path.mkdir(batch_dir)
-    run_data = batch_run.get_model_vars_dataframe()
-    run_data.to_csv(path_or_buf=(batch_dir / filename))
+    runs_per_cell = batch_run.get_runs_per_cell_dataframe()
+    runs_per_cell.to_csv(path_or_buf=(batch_dir / args.filename / "runs_per_cell.csv"))
+    print(runs_per_cell.to_string(index=False))
+    print("Total runs:", runs_per_cell["Runs"].sum())
@@ -0,0 +1,221 @@
+import argparse
+import json
+import platform
+import random
+import subprocess
+import time
+from pathlib import Path
+
+import mesa
+import networkx as nx
+import numpy as np
+
+from crowd_evacuation import path_finding
+from crowd_evacuation.batch_run import get_agents_saved, get_agents_killed
+from crowd_evacuation.ensemble import EnsembleModel
+from crowd_evacuation.flow_field import ExitDistanceFields
+from crowd_evacuation.floor_plan import e_building
+from crowd_evacuation.layered_grid import LayeredGrid
+from crowd_evacuation.layout_cache import Layout, get_layout
+from crowd_evacuation.model import EvacuationModel
+from crowd_evacuation.parallel_batch_runner import ParallelBatchRunner
+
+# Fixed (start, goal) pairs for the path finding benchmarks, from the far corners of the building to the exits
+PATH_PAIRS = [((48, 48), (0, 5)), ((26, 30), (49, 15)), ((1, 48), (0, 25)), ((40, 3), (0, 45))]
+# Cells blocked in the path finding benchmarks: a burning area in the middle of the building
+BLOCKED = frozenset((x, y) for x in range(27, 34) for y in range(20, 31))
+
+
+def measure(function, repeat):
+    """
+    Args:
+        function (function): Function without arguments to time
+        repeat (int): Number of times it's called
+
+    Returns:
+        (List): Wall clock time of every call, in seconds
+    """
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+    return times
+
+
+def result(name, times, seed=None, **params):
+    return {"name": name, "params": params, "seed": seed, "repeat": len(times), "times": times,
+            "mean": float(np.mean(times)), "min": float(np.min(times))}
+
+
+def seed_everything(seed):
+    # The model only uses its own generators, but the global ones are pinned too in case anything else draws from them
+    random.seed(seed)
+    np.random.seed(seed)
+
+
+def bench_init(seed, repeat):
+    results = []
+    for backend in ("networkx", "grid"):
+        # Building the layout of the building (what the first model of a process does), then creating models with it
+        results.append(result("layout_cache.Layout", measure(lambda: Layout(e_building(), backend), repeat),
+                              graph_backend=backend))
+        get_layout(e_building(), backend)
+        seed_everything(seed)
+        times = measure(lambda: EvacuationModel(N=500, K=10, graph_backend=backend, seed=seed), repeat)
+        results.append(result("model.__init__", times, seed, N=500, K=10, graph_backend=backend))
+
+    model = EvacuationModel(N=0, seed=seed)
+
+    def draw_environment():
+        model.grid = LayeredGrid(model.grid.width, model.grid.height, False)
+        model.draw_environment()
+
+    results.append(result("model.draw_environment", measure(draw_environment, repeat)))
+    results.append(result("floor_plan.e_building", measure(lambda: e_building(300, 300), repeat), width=300,
+                          height=300))
+    results.append(result("path_finding.create_graph", measure(lambda: path_finding.create_graph(model), repeat)))
+    results.append(result("path_finding.create_grid_graph",
+                          measure(lambda: path_finding.create_grid_graph(model), repeat)))
+    results.append(result("ExitDistanceFields", measure(
+        lambda: ExitDistanceFields(model.graph, model.pos_exits, model.grid.width, model.grid.height, (0, 1)),
+        repeat)))
+    return results
+
+
+def bench_step(seed, repeat, n_steps):
+    results = []
+    for n_civilians in (100, 500, 1000):
+        for n_stewards in (0, 10, 30):
+            times = []
+            for _ in range(repeat):
+                # Every repetition starts from the same model, so they all simulate the same steps
+                seed_everything(seed)
+                model = EvacuationModel(N=n_civilians, K=n_stewards, fire_x=30, fire_y=25, seed=seed)
+                times.append(sum(measure(model.step, n_steps)) / n_steps)
+            results.append(result("model.step", times, seed, N=n_civilians, K=n_stewards, steps=n_steps))
+    # The same steps with civilians and stewards moving at the same time
+    for n_civilians in (500, 1000):
+        times = []
+        for _ in range(repeat):
+            seed_everything(seed)
+            model = EvacuationModel(N=n_civilians, K=10, fire_x=30, fire_y=25, seed=seed, activation="simultaneous")
+            times.append(sum(measure(model.step, n_steps)) / n_steps)
+        results.append(result("model.step", times, seed, N=n_civilians, K=10, steps=n_steps,
+                              activation="simultaneous"))
+    # Two-phase steps, with the paths planned in the model's process and by a pool of processes
+    for workers in (1, 2, 4):
+        times = []
+        for _ in range(repeat):
+            seed_everything(seed)
+            model = EvacuationModel(N=1000, K=10, fire_x=30, fire_y=25, seed=seed, planning_workers=workers)
+            times.append(sum(measure(model.step, n_steps)) / n_steps)
+            model.planner.close()
+        results.append(result("model.step", times, seed, N=1000, K=10, steps=n_steps, planning_workers=workers))
+    return results
+
+
+def bench_path_finding(seed, repeat):
+    results = []
+    model = EvacuationModel(N=0, seed=seed)
+    graphs = {"networkx": path_finding.create_graph(model), "grid": path_finding.create_grid_graph(model)}
+    for backend, graph in graphs.items():
+        for blocked in (frozenset(), BLOCKED):
+            def find_paths():
+                for start, goal in PATH_PAIRS:
+                    path_finding.find_path(graph, start, goal, non_walkable=blocked)
+
+            def astar_paths():
+                for start, goal in PATH_PAIRS:
+                    try:
+                        path_finding.astar_path(graph, start, goal, heuristic=path_finding.euc_dist, blocked=blocked)
+                    except nx.NetworkXNoPath:
+                        pass
+
+            for name, function in (("path_finding.find_path", find_paths),
+                                   ("path_finding.astar_path", astar_paths)):
+                results.append(result(name, measure(function, repeat), graph_backend=backend,
+                                      blocked=len(blocked), pairs=len(PATH_PAIRS)))
+    return results
+
+
+def bench_batch_run(seed, repeat, workers):
+    def sweep(ensemble):
+        batch_run = ParallelBatchRunner(EnsembleModel if ensemble else EvacuationModel, {"N": [100, 200], "K": [0, 5]},
+                                        {"fire_x": 30, "fire_y": 25}, iterations=2, max_steps=30,
+                                        model_reporters={"agents_saved": get_agents_saved,
+                                                         "agents_killed": get_agents_killed},
+                                        workers=workers, base_seed=seed, ensemble=ensemble)
+        batch_run.run_all()
+
+    results = [result("batch_run", measure(lambda: sweep(False), repeat), seed, runs=8, max_steps=30, workers=workers)]
+    # The same runs as replicates of ensembles, and a large ensemble on its own
+    results.append(result("batch_run", measure(lambda: sweep(True), repeat), seed, runs=8, max_steps=30,
+                          workers=workers, ensemble=True))
+    results.append(result("EnsembleModel.run", measure(
+        lambda: EnsembleModel(list(range(seed, seed + 100)), N=500, K=10, fire_x=30, fire_y=25).run(500), repeat),
+        seed, replicates=100, N=500, K=10))
+    return results
+
+
+def environment():
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True,
+                                cwd=Path(__file__).parent).stdout.strip() or None
+    except OSError:
+        commit = None
+    return {"commit": commit, "time": time.strftime("%Y-%m-%dT%H:%M:%S"), "python": platform.python_version(),
+            "platform": platform.platform(), "numpy": np.__version__, "networkx": nx.__version__,
+            "mesa": mesa.__version__}
+
+
+def compare(results, baseline_path):
+    """
+    Prints the ratio between the mean times of the benchmarks and the ones with the same name and parameters in a
+    previous output file.
+    """
+    with open(baseline_path) as f:
+        baseline = {(b["name"], json.dumps(b["params"], sort_keys=True)): b for b in json.load(f)["benchmarks"]}
+    for bench in results:
+        old = baseline.get((bench["name"], json.dumps(bench["params"], sort_keys=True)))
+        if old is not None:
+            print("{:32} {:60} {:9.4f}s -> {:9.4f}s  x{:.2f}".format(
+                bench["name"], json.dumps(bench["params"]), old["mean"], bench["mean"], old["mean"] / bench["mean"]))
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description='Benchmarks the evacuation model')
+    parser.add_argument('--output', type=str, default='benchmark.json',
+                        help='JSON file where the results will be saved')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='Seed of the models, the same seed always simulates the same steps')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='Number of times every benchmark is repeated')
+    parser.add_argument('--steps', type=int, default=10,
+                        help='Number of steps timed by the model.step benchmarks')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='Number of processes of the batch_run benchmark')
+    parser.add_argument('--only', type=str, nargs='+', choices=('init', 'step', 'path_finding', 'batch_run'),
+                        default=('init', 'step', 'path_finding', 'batch_run'),
+                        help='Benchmarks to run')
+    parser.add_argument('--compare', type=str, default=None,
+                        help='Previous output file to compare the results with')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_arguments()
+    benchmarks = {
+        "init": lambda: bench_init(args.seed, args.repeat),
+        "step": lambda: bench_step(args.seed, args.repeat, args.steps),
+        "path_finding": lambda: bench_path_finding(args.seed, args.repeat),
+        "batch_run": lambda: bench_batch_run(args.seed, args.repeat, args.workers),
+    }
+    results = []
+    for name in args.only:
+        print("Running", name)
+        results += benchmarks[name]()
+    with open(args.output, "w") as f:
+        json.dump({"environment": environment(), "benchmarks": results}, f, indent=1)
+    if args.compare is not None:
+        compare(results, args.compare)
@@ -0,0 +1,11 @@
+from enum import IntEnum
+
+
+class CellType(IntEnum):
+    """ Codes stored in the type layer of LayeredGrid, one per kind of agent that can occupy a cell. """
+    EMPTY = 0
+    WALL = 1
+    EXIT = 2
+    FIRE = 3
+    CIVILIAN = 4
+    STEWARD = 5
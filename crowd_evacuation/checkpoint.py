@@ -0,0 +1,111 @@
+import io
+import pickle
+
+import numpy as np
+
+
+class _SharingPickler(pickle.Pickler):
+    """ Pickler that writes a reference instead of the objects shared between a checkpoint and its forks. """
+
+    def __init__(self, file, shared_ids):
+        super().__init__(file, protocol=pickle.HIGHEST_PROTOCOL)
+        self.shared_ids = shared_ids
+
+    def persistent_id(self, obj):
+        return self.shared_ids.get(id(obj))
+
+
+class _SharingUnpickler(pickle.Unpickler):
+    """ Unpickler that resolves the references written by _SharingPickler to the shared objects. """
+
+    def __init__(self, file, shared):
+        super().__init__(file)
+        self.shared = shared
+
+    def persistent_load(self, pid):
+        return self.shared[pid]
+
+
+class ModelCheckpoint:
+    """
+    Snapshot of the whole state of an EvacuationModel (grid, schedule order, agents with their traits and
+    knowledge, fire, statistics and the state of both random number generators), from which any number of
+    independent continuations can be forked.
+
+    Studies that share a prefix (same crowd, same first steps of the fire) can simulate it once, take a checkpoint
+    and fork every variant from it, instead of creating and running every model from scratch:
+
+        model = EvacuationModel(N=500, fire_x=30, fire_y=25, seed=0)
+        for _ in range(50):
+            model.step()
+        checkpoint = ModelCheckpoint(model)
+        with_stewards = checkpoint.fork(seed=1)
+        with_stewards.add_stewards(10)
+        with_exchange = checkpoint.fork(seed=2)
+        with_exchange.set_civil_info_exchange(True)
+
+    The mutable state is kept as a pickle. The parts that never change during a simulation and don't refer to the
+    model (floor plan, graph, static distance fields and exit index) are left out of it and shared by the model and
+    all its forks, so a checkpoint is small and doesn't keep the model alive. Everything else, agents included, is
+    rebuilt for every fork.
+
+    Profiled models can't be checkpointed, and forks don't record their trajectory.
+    """
+
+    def __init__(self, model):
+        """
+        Args:
+            model (EvacuationModel): Model whose current state is saved. It can keep running afterwards.
+        """
+        if model.profiler is not None:
+            raise ValueError("Profiled models can't be checkpointed, the profiler wraps the methods of their agents")
+        fields = model.exit_fields
+        # Agents (walls included) refer to their model, so they are never shared
+        self.shared = [model.floor_plan, model.graph, model.exit_index, fields.indptr, fields.indices,
+                       fields.fields, fields._neighbours, fields._fields]
+        buffer = io.BytesIO()
+        _SharingPickler(buffer, {id(obj): i for i, obj in enumerate(self.shared)}).dump(model)
+        self.state = buffer.getvalue()
+
+    @property
+    def size(self):
+        """ Bytes of the mutable state, what every checkpoint costs on top of the shared parts. """
+        return len(self.state)
+
+    def fork(self, seed=None):
+        """
+        Args:
+            seed (int): New seed of the random number generators of the fork. If None, the fork continues with the
+                generators as they were at the checkpoint, so it simulates the same steps as the original model
+                would (if nothing else changes).
+
+        Returns:
+            (EvacuationModel): New, independent model in the state of the checkpoint
+        """
+        model = _SharingUnpickler(io.BytesIO(self.state), self.shared).load()
+        if seed is not None:
+            model.reset_randomizer(seed)
+            model.np_random = np.random.RandomState(seed)
+        return model
+
+    def save(self, path):
+        """
+        Writes the checkpoint to a file, shared parts included, to resume the simulation later (see load).
+
+        Args:
+            path (str or Path): Output file
+        """
+        with open(path, "wb") as f:
+            pickle.dump(self.fork(), f, protocol=pickle.HIGHEST_PROTOCOL)
+
+    @classmethod
+    def load(cls, path):
+        """
+        Args:
+            path (str or Path): File written by save
+
+        Returns:
+            (ModelCheckpoint): Checkpoint of the saved model
+        """
+        with open(path, "rb") as f:
+            return cls(pickle.load(f))
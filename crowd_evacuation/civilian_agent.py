@@ -1,33 +1,48 @@
-import random
 import numpy as np
 from mesa import Agent
 
 from crowd_evacuation import path_finding
+from crowd_evacuation.cell_types import CellType
 from crowd_evacuation.exit_agent import ExitAgent
 from crowd_evacuation.fire_agent import FireAgent
+from crowd_evacuation.knowledge import CellSet
+from crowd_evacuation.population import PopulationTrait
 from crowd_evacuation.reasons import Reasons
 from crowd_evacuation.wall_agent import WallAgent
 
 
 class CivilianAgent(Agent):
+    cell_type = CellType.CIVILIAN
+    # Traits are stored in the model's population arrays when it has one (see population.Population)
+    _age = PopulationTrait()
+    _weight = PopulationTrait()
+    _visual_range = PopulationTrait()
+    _speed = PopulationTrait()
+    _being_risky = PopulationTrait()
+    _willingness_to_follow_steward = PopulationTrait()
 
     def __init__(self, unique_id, model, known_exits):
         super().__init__(unique_id, model)
 
-        self._known_exits = known_exits
-        self._discarded_exits = set()
-        self._willingness_to_follow_steward = random.uniform(0, 1)
-        self._age = random.randrange(15, 65)
-        self._weight = random.uniform(40, 100)
+        # Known and discarded exits are bitmasks of the model's exit_index, observed fire a CellSet of the grid cells.
+        # They are replaced (never modified) when they change, so agents that exchanged information can share them.
+        self._known_exits = self.model.exit_index.mask(known_exits)
+        self._discarded_exits = 0
+        self._willingness_to_follow_steward = self.random.uniform(0, 1)
+        self._age = self.random.randrange(15, 65)
+        self._weight = self.random.uniform(40, 100)
         self._goal = None
         self._exit_point = (None, None)
         self._visual_range = self.calculate_visual_range(self._age)
         self._speed = self.calculate_speed(self._visual_range, self._weight)
-        self._observed_fire = set()
-        self._being_risky = random.randrange(0, 2)
+        self._observed_fire = CellSet(0, self.model.grid.width)
+        self._being_risky = self.random.randrange(0, 2)
         self._info_exchange = self.model.civil_info_exchange
         self.last_pos = None
-        self.walks = []
+        self._path_cache = None  # (key, path) of the last path planned towards the goal
+        self._proposal = None  # Move decided by propose, instead of made
+        self._step_state = None  # What the agent saw when it prepared its move (see prepare)
+        self._planned = None  # (whether the goal is reachable, path) planned in this step (see plan)
 
     def calculate_visual_range(self, age):
         """
@@ -35,9 +50,9 @@ class CivilianAgent(Agent):
         :return: the visual range of the agent based on age
         """
         if age <= 45:
-            visual_range = random.randrange(5, 7)  # randomness accounts for individual variation
+            visual_range = self.random.randrange(5, 7)  # randomness accounts for individual variation
         else:
-            visual_range = random.randrange(4, 5)
+            visual_range = self.random.randrange(4, 5)
         return visual_range
 
     def calculate_speed(self, visual_range, weight):
@@ -47,7 +62,7 @@ class CivilianAgent(Agent):
         :return: speed according to age and size. Speed varies between 3 and 7 m/s as per previous studies
         """
         if weight > 70:
-            speed = visual_range - random.randrange(1, 3)  # weight has negative penalty on the speed
+            speed = visual_range - self.random.randrange(1, 3)  # weight has negative penalty on the speed
         else:
             speed = 4  # else, the speed is the maximum speed which is set to 4
         return speed
@@ -56,6 +71,18 @@ class CivilianAgent(Agent):
         return self.unique_id, self._age, self._weight, self._visual_range, self._speed, self._being_risky
 
     def step(self):
+        # Models that plan every path at once (see planning.PathPlanner) prepare and plan the move of every agent at
+        # the start of the step, the rest of the agents do it now
+        if self._step_state is None:
+            self.prepare()
+            self.plan()
+        self.act()
+
+    def prepare(self):
+        """
+        First phase of the step: looks around, exchanges information and chooses the goal. What the agent saw is
+        kept for the next phases (plan and act).
+        """
         # Remember the previous position
         temp_last_pos = self.pos
 
@@ -70,10 +97,10 @@ class CivilianAgent(Agent):
                 extended_fire_area = set(self.model.grid.get_neighborhood(surrounding_agent.pos, moore=True,
                                                                           include_center=True,
                                                                           radius=self._being_risky))
-                self._observed_fire = self._observed_fire.union(extended_fire_area)
+                self._observed_fire = self._observed_fire.with_cells(extended_fire_area)
             # Also, if there is exit in agent's vision range, add it to known exits
             elif isinstance(surrounding_agent, ExitAgent):
-                self._known_exits.append(surrounding_agent.pos)
+                self._known_exits |= self.model.exit_index.bit(surrounding_agent.pos)
 
             # Else if civilians should exchange information and there is any other civilian in the objects surrounding
             # the agent, communicate and exchange information.
@@ -82,31 +109,161 @@ class CivilianAgent(Agent):
 
         # try to run towards the goal exit
         self._determine_goal()
+        # Set as non_walkable the nodes in the graph that contain other people or fire hazards.
+        people = set()
+        if self._goal is not None:
+            for neighbour in contacting_objects:
+                if isinstance(neighbour, CivilianAgent):
+                    people.add(neighbour.pos)
+        self._step_state = (temp_last_pos, surrounding_agents, possible_steps, people)
+        self._planned = None
+
+    def plan(self):
+        """
+        Second phase of the step: plans the path to the goal, avoiding the fire the agent knows about and the people
+        it saw next to it. It only reads the terrain, so the paths of all agents can be planned in any order, or at
+        the same time (see planning.PathPlanner).
+        """
+        if self._goal is None:
+            return
+        people = self._step_state[3]
+        # Path queries never modify the graph, so positions outside of it (e.g. walls) can be left in the set
+        non_walkable = self._observed_fire.with_cells(people)
+        # Calculates the shortest possible path to the agent's goal. The route planned without the people around
+        # is kept between steps, and only its first steps are replanned when someone is standing on them.
+        route = self._route()
+        best_path = None if route is None else self._avoid_people(route, people, non_walkable)
+        self._planned = (route is not None, best_path)
+
+    def act(self):
+        """
+        Last phase of the step: moves along the planned path, or wanders around when there is no goal or the path
+        is blocked.
+        """
+        temp_last_pos, surrounding_agents, possible_steps, _ = self._step_state
+        self._step_state = None
+        # Agents that moved since the agent looked around may be standing where it could go
+        possible_steps = [cell for cell in possible_steps if self.model.grid.is_cell_empty(cell)]
         if self._goal is None:
             self._movement_of_evacuation(possible_steps, surrounding_agents)
         else:
-            # Set as non_walkable the nodes in the graph that contain other people or fire hazards.
-            non_walkable = set()
-            for neighbour in contacting_objects:
-                if isinstance(neighbour, CivilianAgent):
-                    non_walkable.add(neighbour.pos)
-            keys_set = set(self.model.graph.nodes.keys())  # double check that non walkable belong to the graph
-            non_walkable = non_walkable.union(self._observed_fire).intersection(keys_set)
-            # Calculates the shortest possible path to the agent's goal.
-            best_path = path_finding.find_path(self.model.graph, self.pos, self._goal, non_walkable=non_walkable)
+            reachable, best_path = self._planned
             if best_path is not None and self.model.grid.is_cell_empty(best_path[1]):
                 self.decide_move_action(best_path)
             else:
                 # If the exit is unreachable because of fire, discard that exit for future calculations. This reduces
                 # workload for A* algorithm
-                non_walkable = self._observed_fire.intersection(keys_set)
-                path = path_finding.find_path(self.model.graph, self.pos, self._goal, non_walkable=non_walkable)
-                if path is None:
-                    self._discarded_exits.add(self._goal)
+                if not reachable:
+                    self._discarded_exits |= self.model.exit_index.bit(self._goal)
                 self._movement_of_evacuation(possible_steps, surrounding_agents)
-        # update previous position and remember the locations where agent walk
+        # update previous position
         self.last_pos = temp_last_pos
-        self.walks.append(self.pos)
+
+    def propose(self):
+        """
+        :return: (cells, saved) the move the agent decides in this step, against the current grid, without making it:
+        the cells it would walk through and whether the last one is the exit it would leave through.
+        Used by scheduling.SimultaneousActivation, which makes the moves once all agents decided them.
+        """
+        self._proposal = ([], False)
+        try:
+            self.step()
+            return self._proposal
+        finally:
+            self._proposal = None
+
+    def move_along(self, cells, saved):
+        """
+        :param cells: cells the agent walks through, all of them empty but the exit it may leave through
+        :param saved: whether the last cell is the exit the agent leaves through
+        Moves the agent to the last cell, or takes it out of the building. When the move is only being proposed
+        (see propose), it's just recorded.
+        """
+        if self._proposal is not None:
+            self._proposal = (cells, saved)
+        elif saved:
+            self._exit_point = cells[-1]
+            self.model.remove_agent(self, Reasons.SAVED)
+        elif cells:
+            self.model.grid.move_agent(self, cells[-1])
+
+    def _route(self):
+        """
+        :return: a shortest path from the agent's position to its goal avoiding the observed fire, None if there is
+        no path.
+        The last route is reused while the goal is the same, the agent is still on it and none of its cells caught
+        fire (checked against the cells that burned since the terrain version it was planned with) or became known
+        fire. The rest of a shortest path is still a shortest path, since obstacles only make the other paths longer.
+        """
+        stats = self.model.path_cache_stats
+        version = self.model.terrain_version
+        if self._path_cache is not None:
+            (goal, planned_version), path = self._path_cache
+            if goal == self._goal and self.pos in path:
+                path = path[path.index(self.pos):]
+                valid = not any(cell in self._observed_fire for cell in path[1:])
+                if valid and planned_version != version:
+                    cells = set(path)
+                    valid = not any(cell in cells for cell in self.model.burned_since(planned_version))
+                if valid:
+                    stats["hits"] += 1
+                    self._path_cache = ((goal, version), path)
+                    return path
+        stats["misses"] += 1
+        path = self._plan_path(self._observed_fire)
+        self._path_cache = None if path is None else ((self._goal, version), path)
+        return path
+
+    def _avoid_people(self, route, people, non_walkable):
+        """
+        :param route: shortest path to the goal avoiding the observed fire
+        :param people: positions of the people next to the agent
+        :param non_walkable: positions the agent shouldn't walk through
+        :return: a shortest path to the goal that also avoids the people next to the agent, None if there is no path.
+        People next to the agent can only stand on the first steps of the route. They are stepped around with a path
+        as long as the part of the route they block, so the result is still as short as the route. Only when that is
+        not possible the whole path is planned again.
+        """
+        blocked = [i for i, cell in enumerate(route[:3]) if cell in people]
+        if not blocked:
+            return list(route)
+        end = blocked[-1] + 1
+        prefix = None
+        if end < len(route):
+            prefix = path_finding.bounded_path(self.model.graph, self.pos, route[end], non_walkable, max_length=end)
+        if prefix is None:
+            self.model.path_cache_stats["misses"] += 1
+            return self._plan_path(non_walkable)
+        self.model.path_cache_stats["repairs"] += 1
+        route = prefix + route[end + 1:]
+        self._path_cache = (self._path_cache[0], route)
+        return list(route)
+
+    def _plan_path(self, non_walkable):
+        """
+        :param non_walkable: positions the agent shouldn't walk through
+        :return: a shortest path from the agent's position to its goal, None if there is no path.
+        Follows the precomputed distance field of the goal. When the gradient is blocked, it first tries to step around
+        the blocked neighbours, then does the same on the field that keeps the agent's distance from the fire, and
+        only then A* searches around the blocked cells, guided by the static distance field.
+        The fire-aware field avoids all the fire of the building, not only the fire the agent knows about, so its path
+        is only taken when it is as short as any path avoiding non_walkable can be (see
+        ExitDistanceFields.lower_bound): it is then a shortest path for the agent too, otherwise A* decides.
+        """
+        exit_fields = self.model.exit_fields
+        if exit_fields.distance(self._goal, self.pos) == np.inf:
+            return None  # Not even reachable without obstacles
+        for hazard_radius in (None, self._being_risky):
+            path = exit_fields.follow(self._goal, self.pos, non_walkable, hazard_radius)
+            if path is None:
+                path = exit_fields.detour(self._goal, self.pos, non_walkable, hazard_radius)
+            if path is not None and (hazard_radius is None or
+                                     len(path) - 1 == exit_fields.lower_bound(self._goal, self.pos, non_walkable)):
+                return path
+        profiler = self.model.profiler
+        return path_finding.find_path(self.model.graph, self.pos, self._goal, non_walkable=non_walkable,
+                                      heuristic=exit_fields.heuristic(self._goal),
+                                      expansions=None if profiler is None else profiler.expansions)
 
     def decide_move_action(self, path):
         """
@@ -119,17 +276,21 @@ class CivilianAgent(Agent):
             # truncated the path according to the speed of the agent
             del (path[self._speed + 1:])
             upper_bound = self._speed + 1
+        cells = []
+        saved = False
         for i in range(1, upper_bound):
             # move the agent as long as the there are empty squares
             if self.model.grid.is_cell_empty(path[i]):
-                self.model.grid.move_agent(self, path[i])
+                cells.append(path[i])
             # if the cell is not empty check if it is the goal
             elif path[i] == self._goal:
-                self._exit_point = path[i]
-                self.model.remove_agent(self, Reasons.SAVED)
+                cells.append(path[i])
+                saved = True
+                break
             # else break the loop and wait next turn
             else:
                 break
+        self.move_along(cells, saved)
 
     def _movement_of_evacuation(self, possible_steps, surrounding_agents):
         """
@@ -160,13 +321,13 @@ class CivilianAgent(Agent):
                     distance_from_fire = self._absolute_distance(self.pos, closest_fire)
                     for coords in next_possible_steps:
                         if distance_from_fire <= self._absolute_distance(coords, closest_fire):
-                            self.model.grid.move_agent(self, coords)
+                            self.move_along([coords], False)
                             break
                 # if there is no fire around them OR agent didn't see the fire yet,
                 # they just walk along wall in random direction
                 else:
-                    random_cell = random.choice(next_possible_steps if next_possible_steps else possible_steps)
-                    self.model.grid.move_agent(self, random_cell)
+                    random_cell = self.random.choice(next_possible_steps if next_possible_steps else possible_steps)
+                    self.move_along([random_cell], False)
 
             # If agent don't see any wall and see fire, run away opposite side of the closest fire
             elif any(isinstance(agent, FireAgent) for agent in surrounding_agents):
@@ -174,7 +335,7 @@ class CivilianAgent(Agent):
                 self._move_away_from_fire(closest_fire)
             # ELSE, they just walk randomly.
             else:
-                self.model.grid.move_agent(self, random.choice(possible_steps))
+                self.move_along([self.random.choice(possible_steps)], False)
 
     def _absolute_distance(self, x, y):
         """
@@ -193,10 +354,10 @@ class CivilianAgent(Agent):
         :return (tuple): The coordinates where this agent is heading to.
 
         """
-        exits = set(self._known_exits).difference(self._discarded_exits)
+        exits = self.model.exit_index.positions(self._known_exits & ~self._discarded_exits)
         distances = [self._absolute_distance(self.pos, x) for x in exits]
         if distances:
-            self._goal = list(exits)[distances.index(min(distances))]
+            self._goal = exits[distances.index(min(distances))]
         else:
             self._goal = None
 
@@ -235,15 +396,15 @@ class CivilianAgent(Agent):
         """
         # if isinstance(other, CivilianAgent):  # Redundant
         # Exchange of information about known exits
-        shared_known_exits = list(set(self._known_exits + other._known_exits))
+        shared_known_exits = self._known_exits | other._known_exits
         self._known_exits = shared_known_exits
         other._known_exits = shared_known_exits
         # Exchange of information about discarded exits
-        shared_discarded_exits = self._discarded_exits.union(other._discarded_exits)
+        shared_discarded_exits = self._discarded_exits | other._discarded_exits
         self._discarded_exits = shared_discarded_exits
         other._discarded_exits = shared_discarded_exits
         # Exchange of information about known fire hazards
-        shared_fire_hazards = self._observed_fire.union(other._observed_fire)
+        shared_fire_hazards = self._observed_fire | other._observed_fire
         self._observed_fire = shared_fire_hazards
         other._observed_fire = shared_fire_hazards
 
@@ -253,15 +414,15 @@ class CivilianAgent(Agent):
         to observe the surrounding environments
         """
         # the list of objects surrounding an agent, 5x5 range, exclude the center where the agent is standing
-        surrounding_agents = self.model.grid.get_neighbors(self.pos, moore=True, include_center=False,
-                                                           radius=self._visual_range)
+        if self.model.population is not None:
+            # Already computed for every agent at the start of the step
+            surrounding_agents = self.model.population.visible_agents(self)
+        else:
+            surrounding_agents = self.model.grid.get_neighbors(self.pos, moore=True, include_center=False,
+                                                               radius=self._visual_range)
         contacting_objects = self.model.grid.get_neighbors(self.pos, moore=True, include_center=False)
-        possible_moving_range = self.model.grid.get_neighborhood(self.pos, moore=True, include_center=False, radius=1)
         # also checking where this poor agent can move to survive
-        possible_steps = []
-        for position in possible_moving_range:
-            if self.model.grid.is_cell_empty(position):
-                possible_steps.append(position)
+        possible_steps = self.model.grid.cells_around(self.pos, types=(CellType.EMPTY,))
         return surrounding_agents, possible_steps, contacting_objects
 
     def _move_away_from_fire(self, fire):
@@ -279,7 +440,7 @@ class CivilianAgent(Agent):
         new_pos = np.round(new_pos).astype(int)
         new_pos = (new_pos[0], new_pos[1])  # cast array to tuple
         if self.model.grid.is_cell_empty(new_pos):
-            self.model.grid.move_agent(self, new_pos)
+            self.move_along([new_pos], False)
 
     def _calculate_distance_to_closest_agent(self, point, agents):
         """
@@ -0,0 +1,521 @@
+import numpy as np
+import pandas as pd
+
+from crowd_evacuation.floor_plan import FloorPlan, e_building, load_floor_plan, sample_cells
+from crowd_evacuation.flow_field import node_id
+from crowd_evacuation.layout_cache import get_layout
+from crowd_evacuation.path_finding import NEIGHBOUR_OFFSETS
+from crowd_evacuation.reasons import Reasons
+
+UNREACHABLE = np.iinfo(np.int32).max // 2  # Distance of the cells from where an exit can't be reached
+DISCARDED_SHIFT = 32  # Discarded exits are kept in the high half of the knowledge bits, known exits in the low one
+
+
+def _dilate(layers):
+    """
+    Chebyshev dilation by one cell (every cell takes the or of its 3x3 neighbourhood) of a stack of grids.
+
+    Args:
+        layers (np.ndarray): Boolean or integer (bit set) array of shape (replicates, height, width)
+
+    Returns:
+        (np.ndarray): Dilated copy
+    """
+    rows = layers.copy()
+    rows[:, :, 1:] |= layers[:, :, :-1]
+    rows[:, :, :-1] |= layers[:, :, 1:]
+    dilated = rows.copy()
+    dilated[:, 1:, :] |= rows[:, :-1, :]
+    dilated[:, :-1, :] |= rows[:, 1:, :]
+    return dilated
+
+
+def _pick(choices, index):
+    """ choices[i, index[i]] for every row i. """
+    return choices[np.arange(len(choices)), index]
+
+
+class EnsembleReplicate:
+    """
+    Outcome of one replicate of an EnsembleModel, with the same attributes as an EvacuationModel that the batch
+    reporters read (agents_saved, agents_killed, saved_per_exit), so that batch_run.get_agents_saved and the per-exit
+    counts work on it unchanged. People are identified by their index in the replicate.
+    """
+
+    def __init__(self, ensemble, replicate):
+        self.ensemble = ensemble
+        self.replicate = replicate
+        status = ensemble.status[replicate]
+        self.agents_saved = np.flatnonzero(status == Reasons.SAVED.value).tolist()
+        self.agents_killed = np.flatnonzero(status == Reasons.KILLED_BY_FIRE.value).tolist()
+        self.saved_per_exit = dict(zip(ensemble.pos_exits, ensemble.saved_per_exit[replicate].tolist()))
+        self.steps = int(ensemble.replicate_steps[replicate])
+
+    def agent_records(self):
+        """
+        Returns:
+            (dict): Traits and outcome of every person of the replicate, with the same columns as
+            batch_run.get_agent_records
+        """
+        ensemble = self.ensemble
+        r = self.replicate
+        exit_used = ensemble.exit_used[r]
+        saved = exit_used >= 0
+        exits = np.array(ensemble.pos_exits, dtype=np.int16).reshape(-1, 2)
+        return {
+            "unique_id": np.arange(ensemble.num_agents, dtype=np.int32),
+            "age": ensemble.age[r].astype(np.int16),
+            "weight": ensemble.weight[r].astype(np.float32),
+            "visual_range": ensemble.visual_range[r].astype(np.int16),
+            "speed": ensemble.speed[r].astype(np.int16),
+            "being_risky": ensemble.being_risky[r].astype(np.int8),
+            "outcome": ensemble.status[r].astype(np.int8),
+            "exit_x": np.where(saved, exits[exit_used, 0], -1).astype(np.int16),
+            "exit_y": np.where(saved, exits[exit_used, 1], -1).astype(np.int16),
+        }
+
+
+class EnsembleModel:
+    """
+    Many replicates of the evacuation advanced together, one array operation per phase of the step for all of them,
+    instead of one EvacuationModel per replicate with one Python call per agent.
+
+    Every replicate has the same building, fire origin and number of civilians and stewards, but its own random number
+    generator, crowd, traits and fire. The state is stacked along the first axis: occupancy and fire are arrays of
+    shape (replicates, cells), the people and their traits of shape (replicates, agents). Cells are numbered
+    y * width + x, and an extra blocked cell at the end stands for the outside of the grid and for people who left.
+
+    Traits are drawn with the distributions of CivilianAgent, and every step follows the phases of the agent model:
+        - perception: exits within the visual range (Chebyshev distance) become known
+        - information exchange: known and discarded exits are shared with the people within the visual range of
+          either of both, as bit sets spread over the grid by dilation. Stewards always share, civilians only with
+          civil_info_exchange.
+        - goal: the closest (Manhattan distance) known exit that hasn't been discarded
+        - movement: up to speed moves down the static distance field of the goal, to the free neighbour closest in a
+          straight line to the exit, never into the fire (nor next to it for risky people). People blocked by others
+          step sideways, and people blocked by the fire step around it and discard the exit if they don't get any
+          closer to it in the whole step. Several people moving to the same cell are resolved by a random priority,
+          the rest wait. Those without a goal or a way take one random step, along the walls if they can. People
+          next to an exit are saved.
+        - fire: the rules of fire_spread.FireSpread, killing the people on the cells that catch fire.
+
+    Moves are decided locally (no path search around obstacles) and the interactions of one step only reach the
+    direct neighbours of every person, so the ensemble reproduces the dynamics of EvacuationModel statistically, not
+    run by run. The draws of a replicate only depend on its own state, so a replicate gives the same result with the
+    same seed no matter which other replicates it runs with.
+    """
+
+    def __init__(self, seeds, N=10, K=0, width=50, height=50, fire_x=1, fire_y=1, civil_info_exchange=True,
+                 floor_plan=None, spawn_zones=None, burned_delay=1, n_outcomes=4):
+        """
+        Args:
+            seeds (List or int): Seed of every replicate, or the number of replicates to run them unseeded
+            N (int): Number of civilians of every replicate
+            K (int): Number of stewards of every replicate
+            width (int): Width of the grid, only used by the default building
+            height (int): Height of the grid, only used by the default building
+            fire_x (int): x coordinate where the fire starts
+            fire_y (int): y coordinate where the fire starts
+            civil_info_exchange (bool): Civilians exchange information with the people around them
+            floor_plan (FloorPlan or str): Building, or the file it's loaded from, as for EvacuationModel
+            spawn_zones (List): Zones where people are more likely to be at the start, as for EvacuationModel
+            burned_delay (int): How many steps a cell on fire waits until it can spread
+            n_outcomes (int): A cell ready to spread does it with probability 1 / n_outcomes every step
+        """
+        if isinstance(seeds, int):
+            seeds = [None] * seeds
+        if floor_plan is None:
+            floor_plan = e_building(width, height)
+        elif not isinstance(floor_plan, FloorPlan):
+            floor_plan = load_floor_plan(floor_plan)
+        if len(floor_plan.exits) > DISCARDED_SHIFT - 1:
+            raise ValueError("The ensemble supports up to {} exits".format(DISCARDED_SHIFT - 1))
+        self.seeds = list(seeds)
+        self.rngs = [np.random.RandomState(seed) for seed in self.seeds]
+        self.num_replicates = R = len(self.seeds)
+        self.num_civilians = N
+        self.num_stewards = K
+        self.num_agents = A = N + K
+        self.civil_info_exchange = civil_info_exchange
+        self.floor_plan = floor_plan
+        self.burned_delay = burned_delay
+        self.n_outcomes = n_outcomes
+        self.width = W = floor_plan.width
+        self.height = H = floor_plan.height
+        self.n_cells = HW = W * H
+        self.warning_UI = ""
+        self.steps = 0
+        self._build_static()
+
+        # Fire, with the extra cell (outside of the grid) never burning
+        self.on_fire = np.zeros((R, HW + 1), dtype=bool)
+        self.burned_out = np.zeros((R, HW + 1), dtype=bool)
+        self.delay_counter = np.zeros((R, HW + 1), dtype=np.int16)
+        fire_pos = (fire_x, fire_y)
+        if not floor_plan.is_spawnable(fire_pos):
+            fire_pos = (1, 1) if floor_plan.is_spawnable((1, 1)) else floor_plan.spawnable_cells()[0]
+            self.warning_UI = "<b>WARNING:</b> Sorry but the position of the fire is outside of the building, " \
+                              "change the setting and click reset simulation."
+        self.fire_initial_pos = fire_pos
+        self.on_fire[:, node_id(fire_pos, W)] = True
+
+        # People: cell, outcome (0 while inside, else the value of the Reasons they left for) and exit they used
+        self.pos = np.full((R, A), HW, dtype=np.int64)
+        self.status = np.zeros((R, A), dtype=np.int8)
+        self.exit_used = np.full((R, A), -1, dtype=np.int8)
+        self.previous = np.full((R, A), HW, dtype=np.int64)  # Cell every person came from with their last move
+        self.occupant = np.full((R, HW + 1), -1, dtype=np.int32)  # Index of the person in every cell, -1 if none
+        self.steward = np.zeros(A, dtype=bool)
+        self.steward[N:] = True
+        self.age = np.empty((R, A), dtype=np.int64)
+        self.weight = np.empty((R, A))
+        self.visual_range = np.empty((R, A), dtype=np.int64)
+        self.speed = np.empty((R, A), dtype=np.int64)
+        self.being_risky = np.empty((R, A), dtype=np.int64)
+        weights = floor_plan.spawn_weights(spawn_zones)
+        weights[fire_pos[1], fire_pos[0]] = 0
+        for r, rng in enumerate(self.rngs):
+            self.age[r] = rng.randint(15, 65, size=A)
+            self.weight[r] = rng.uniform(40, 100, size=A)
+            self.visual_range[r] = np.where(self.age[r] <= 45, rng.randint(5, 7, size=A), 4)
+            self.speed[r] = np.where(self.weight[r] > 70, self.visual_range[r] - rng.randint(1, 3, size=A), 4)
+            self.being_risky[r] = rng.randint(0, 2, size=A)
+            positions = sample_cells(weights, A, rng)
+            cells = np.array([node_id(pos, W) for pos in positions], dtype=np.int64)
+            self.pos[r] = cells
+            self.occupant[r, cells] = np.arange(A)
+        # Civilians know the main exits, stewards all of them
+        self.knowledge = np.full((R, A), self._exit_mask(floor_plan.main_exits), dtype=np.int64)
+        self.knowledge[:, self.steward] = self._exit_mask(self.pos_exits)
+
+        self.saved_per_exit = np.zeros((R, len(self.pos_exits)), dtype=np.int64)
+        self.replicate_steps = np.zeros(R, dtype=np.int64)  # Steps every replicate ran until everybody left
+        self.active = np.ones(R, dtype=bool)  # Replicates with people inside
+        self.running = A > 0
+        if not self.running:
+            self.active[:] = False
+        self._history = []  # (step, running replicates, reporter values) of every step
+        self._collect(np.ones(R, dtype=bool))
+
+    def _exit_mask(self, exits):
+        mask = 0
+        for ext in exits:
+            mask |= 1 << self.pos_exits.index(tuple(ext))
+        return mask
+
+    def _build_static(self):
+        """
+        Arrays of the building that every replicate shares: neighbours of every cell, distance fields of the exits,
+        distance to the walls and the cells next to every exit.
+        """
+        plan = self.floor_plan
+        W, H, HW = self.width, self.height, self.n_cells
+        self.pos_exits = [tuple(ext) for ext in plan.exits]
+        self.exit_cells = np.array([node_id(ext, W) for ext in self.pos_exits], dtype=np.int64)
+        self.exit_x = np.array([ext[0] for ext in self.pos_exits], dtype=np.int64)
+        self.exit_y = np.array([ext[1] for ext in self.pos_exits], dtype=np.int64)
+
+        cells = np.arange(HW)
+        xs, ys = cells % W, cells // W
+        self.neighbours = np.full((HW + 1, len(NEIGHBOUR_OFFSETS)), HW, dtype=np.int64)
+        for i, (dx, dy) in enumerate(NEIGHBOUR_OFFSETS):
+            nxs, nys = xs + dx, ys + dy
+            inside = (nxs >= 0) & (nxs < W) & (nys >= 0) & (nys < H)
+            self.neighbours[cells[inside], i] = nys[inside] * W + nxs[inside]
+
+        static_fields = get_layout(plan, "grid").exit_fields.fields
+        self.fields = np.full((len(self.pos_exits), HW + 1), UNREACHABLE, dtype=np.int64)
+        self.straight_distance = np.zeros((len(self.pos_exits), HW + 1), dtype=np.int64)
+        for e, ext in enumerate(self.pos_exits):
+            field = static_fields[ext]
+            reachable = np.isfinite(field)
+            self.fields[e, :HW][reachable] = field[reachable]
+            self.straight_distance[e, :HW] = (xs - self.exit_x[e]) ** 2 + (ys - self.exit_y[e]) ** 2
+
+        # Cells no one can step on (walls, exits, outside of the building and of the grid) and cells that burn
+        self.blocked = np.ones(HW + 1, dtype=bool)
+        self.blocked[:HW] = ~plan.inside.ravel()
+        self.flammable = np.zeros(HW + 1, dtype=bool)
+        self.flammable[:HW] = ~(plan.wall | plan.exit).ravel()
+        # Chebyshev distance from every cell to the closest wall
+        self.wall_distance = np.zeros(HW + 1, dtype=np.int64)
+        walls = plan.wall[None]
+        distance = np.where(plan.wall, 0, W + H)
+        radius = 0
+        while walls.any() and (distance == W + H).any():
+            radius += 1
+            walls = _dilate(walls)
+            distance[walls[0] & (distance == W + H)] = radius
+        self.wall_distance[:HW] = distance.ravel()
+        # First exit next to every cell (Chebyshev distance 1), -1 if none
+        self.exit_near = np.full(HW + 1, -1, dtype=np.int64)
+        for e in reversed(range(len(self.pos_exits))):
+            around = self.neighbours[self.exit_cells[e]]
+            self.exit_near[around[around < HW]] = e
+
+    def step(self):
+        self.steps += 1
+        running = self.active.copy()
+        inside = (self.status == 0) & running[:, None]
+        self._perceive(inside)
+        self._exchange(inside)
+        goal = self._goals(inside)
+        self._move(inside, goal, running)
+        self._spread_fire(running)
+        self.replicate_steps[running] = self.steps
+        self.active = running & (self.status == 0).any(axis=1)
+        self.running = bool(self.active.any())
+        self._collect(running)
+
+    def run(self, max_steps=1000):
+        """
+        Steps every replicate until everybody left the building or max_steps is reached.
+        """
+        while self.running and self.steps < max_steps:
+            self.step()
+
+    def _xy(self):
+        return self.pos % self.width, self.pos // self.width
+
+    def _perceive(self, inside):
+        """ Exits within the visual range become known. """
+        xs, ys = self._xy()
+        distance = np.maximum(np.abs(xs[..., None] - self.exit_x), np.abs(ys[..., None] - self.exit_y))
+        seen = (distance <= self.visual_range[..., None]) & inside[..., None]
+        bits = np.left_shift(1, np.arange(len(self.pos_exits), dtype=np.int64))
+        self.knowledge |= (seen * bits).sum(axis=2)
+
+    def _exchange(self, inside):
+        """
+        People who exchange information share it with everybody within their visual range, in both directions.
+        The known and discarded exits of the people are placed on the grids of the replicates and spread by dilation:
+        the ones of the people who exchange as far as their own visual range (what they tell), and the ones of
+        everybody as far as the visual range of every person who exchanges (what they hear).
+        """
+        exchanging = inside & (self.steward | self.civil_info_exchange)
+        replicates = np.flatnonzero(exchanging.any(axis=1))
+        if len(replicates) == 0:
+            return
+        # Only the replicates where someone exchanges information
+        exchanging = exchanging[replicates]
+        inside = inside[replicates]
+        pos = self.pos[replicates]
+        knowledge = self.knowledge[replicates]
+        ranges = self.visual_range[replicates]
+        shape = (len(replicates), self.height, self.width)
+        max_range = int(ranges[exchanging].max())
+
+        told = np.zeros(shape, dtype=np.int64)
+        for radius in range(max_range, 0, -1):
+            tellers = exchanging & (ranges == radius)
+            told.reshape(len(replicates), -1)[tellers.nonzero()[0], pos[tellers]] |= knowledge[tellers]
+            told = _dilate(told)
+        received = np.zeros_like(knowledge)
+        received[inside] = told.reshape(len(replicates), -1)[inside.nonzero()[0], pos[inside]]
+
+        heard = np.zeros(shape, dtype=np.int64)
+        heard.reshape(len(replicates), -1)[inside.nonzero()[0], pos[inside]] = knowledge[inside]
+        for radius in range(1, max_range + 1):
+            heard = _dilate(heard)
+            listeners = exchanging & (ranges == radius)
+            received[listeners] |= heard.reshape(len(replicates), -1)[listeners.nonzero()[0], pos[listeners]]
+        self.knowledge[replicates] |= received
+
+    def _goals(self, inside):
+        """
+        Returns:
+            (np.ndarray): Index of the exit every person heads to, -1 if none (or not inside)
+        """
+        n_exits = len(self.pos_exits)
+        bits = np.left_shift(1, np.arange(n_exits, dtype=np.int64))
+        usable = self.knowledge & ~(self.knowledge >> DISCARDED_SHIFT)
+        available = (usable[..., None] & bits) != 0
+        xs, ys = self._xy()
+        distance = np.abs(xs[..., None] - self.exit_x) + np.abs(ys[..., None] - self.exit_y)
+        distance = np.where(available & inside[..., None], distance, UNREACHABLE)
+        goal = distance.argmin(axis=2)
+        return np.where(distance.min(axis=2) < UNREACHABLE, goal, -1)
+
+    def _discard(self, mask, goal):
+        self.knowledge[mask] |= np.left_shift(1, goal[mask] + DISCARDED_SHIFT)
+
+    def _move(self, inside, goal, running):
+        R, A = self.num_replicates, self.num_agents
+        fire = self.on_fire | self.burned_out
+        near_fire = fire.copy()
+        near_fire[:, :-1] = _dilate(fire[:, :-1].reshape(R, self.height, self.width)).reshape(R, -1)
+        # Random priority of the people in conflicts and random keys of the random steps, for the whole step
+        priority = np.zeros((R, A))
+        random_keys = np.zeros((R, A, len(NEIGHBOUR_OFFSETS)))
+        for r in np.flatnonzero(running).tolist():
+            priority[r] = self.rngs[r].random_sample(A)
+            random_keys[r] = self.rngs[r].random_sample((A, len(NEIGHBOUR_OFFSETS)))
+
+        # An exit that can't be reached at all is discarded
+        has_goal = goal >= 0
+        safe_goal = np.maximum(goal, 0)
+        unreachable = has_goal & (self.fields[safe_goal, self.pos] >= UNREACHABLE)
+        self._discard(unreachable, goal)
+        has_goal &= ~unreachable
+
+        self._leave_through_exits(np.nonzero(inside), goal)
+        start_distance = self.fields[safe_goal, self.pos]
+        blocked_by_fire = np.zeros_like(inside)
+        moving = inside & (self.status == 0)
+        for sub_step in range(int(self.speed.max(initial=0))):
+            moving &= self.speed > sub_step
+            # Only the people still moving are looked at, as flat arrays of (replicate, person) pairs
+            rep, who = np.nonzero(moving)
+            if len(rep) == 0:
+                break
+            pos = self.pos[rep, who]
+            exit_index = safe_goal[rep, who]
+            previous = self.previous[rep, who][:, None]
+            neighbours = self.neighbours[pos]
+            rows = rep[:, None]
+            hazard = fire[rows, neighbours] | (self.being_risky[rep, who].astype(bool)[:, None] &
+                                               near_fire[rows, neighbours])
+            free = ~hazard & (self.occupant[rows, neighbours] < 0) & ~self.blocked[neighbours]
+
+            # Down the distance field of the goal, to the candidate closest to the exit in a straight line
+            distance = self.fields[exit_index[:, None], neighbours]
+            here = self.fields[exit_index, pos][:, None]
+            downhill = (distance == here - 1) & has_goal[rep, who][:, None]
+            passable = downhill & ~hazard
+            candidates = passable & (free | (neighbours == self.exit_cells[exit_index][:, None]))
+            # When people block every way down, a step sideways (as far from the exit) that doesn't go back
+            crowded = passable.any(axis=1) & ~candidates.any(axis=1)
+            candidates |= (distance == here) & free & crowded[:, None] & (neighbours != previous)
+            follows = candidates.any(axis=1)
+            straight = np.where(candidates, self.straight_distance[exit_index[:, None], neighbours], UNREACHABLE)
+            target = np.where(follows, _pick(neighbours, straight.argmin(axis=1)), -1)
+
+            # The fire blocks every way down the field: step around it to the free neighbour closest to the exit,
+            # never back to the previous cell
+            burning_way = downhill.any(axis=1) & ~passable.any(axis=1)
+            around = np.where(free & burning_way[:, None] & (neighbours != previous), distance, UNREACHABLE)
+            detours = around.min(axis=1) < UNREACHABLE
+            target = np.where(detours, _pick(neighbours, around.argmin(axis=1)), target)
+            blocked_by_fire[rep[burning_way], who[burning_way]] = True
+
+            # The rest take one random step, only as their first move, like CivilianAgent._movement_of_evacuation
+            # preferring the steps along the walls that don't go back
+            if sub_step == 0:
+                wanders = ~follows & ~detours & free.any(axis=1)
+                along_wall = (self.wall_distance[neighbours] <= self.wall_distance[pos][:, None]) & \
+                             (neighbours != previous)
+                keys = np.where(free, random_keys[rep, who] + along_wall, -1)
+                target = np.where(wanders, _pick(neighbours, keys.argmax(axis=1)), target)
+
+            # Leaving through the goal exit never conflicts
+            leaving = (target >= 0) & (target == self.exit_cells[exit_index]) & has_goal[rep, who]
+            self._leave(rep[leaving], who[leaving], exit_index[leaving])
+            # One person per target cell, the one with the highest priority
+            walking = np.flatnonzero((target >= 0) & ~leaving)
+            cells = rep[walking] * (self.n_cells + 1) + target[walking]
+            order = np.lexsort((-priority[rep[walking], who[walking]], cells))
+            first = np.ones(len(order), dtype=bool)
+            first[1:] = cells[order][1:] != cells[order][:-1]
+            winners = walking[order[first]]
+            moved = (rep[winners], who[winners])
+            self.occupant[rep[winners], pos[winners]] = -1
+            self.previous[moved] = pos[winners]
+            self.pos[moved] = target[winners]
+            self.occupant[rep[winners], target[winners]] = who[winners]
+            # People next to an exit are saved before the next move, as by the ExitAgents between the moves of the
+            # agent model
+            self._leave_through_exits(moved, goal)
+            # Only people who keep following the field can move again
+            moving[:] = False
+            moving[moved] = follows[winners]
+            moving &= self.status == 0
+
+        # The agent model discards an exit when there is no way around the fire it has seen. Here it is discarded
+        # when the fire kept the person from getting any closer to it during the whole step.
+        stalled = blocked_by_fire & (self.status == 0) & (self.fields[safe_goal, self.pos] >= start_distance)
+        self._discard(stalled, goal)
+
+    def _leave(self, rep, who, exit_index):
+        """ Saves the given people (replicates and indices) through the given exits. """
+        self.occupant[rep, self.pos[rep, who]] = -1
+        self.pos[rep, who] = self.n_cells
+        self.status[rep, who] = Reasons.SAVED.value
+        self.exit_used[rep, who] = exit_index
+        np.add.at(self.saved_per_exit, (rep, exit_index), 1)
+
+    def _leave_through_exits(self, people, goal):
+        """
+        Like ExitAgent.step, the given people (replicates and indices) next to an exit are saved through it, through
+        their goal if it's one of them.
+        """
+        rep, who = people
+        pos = self.pos[rep, who]
+        goal = goal[rep, who]
+        safe_goal = np.maximum(goal, 0)
+        x, y = pos % self.width, pos // self.width
+        at_goal = (goal >= 0) & (np.abs(x - self.exit_x[safe_goal]) <= 1) & (np.abs(y - self.exit_y[safe_goal]) <= 1)
+        exit_index = np.where(at_goal, goal, self.exit_near[pos])
+        leaving = (exit_index >= 0) & (self.status[rep, who] == 0)
+        self._leave(rep[leaving], who[leaving], exit_index[leaving])
+
+    def _spread_fire(self, running):
+        """ FireSpread.step for every running replicate. """
+        R, H, W = self.num_replicates, self.height, self.width
+        waiting = self.on_fire & (self.delay_counter < self.burned_delay)
+        ready = self.on_fire & ~waiting & running[:, None]
+        spreading = np.zeros_like(ready)
+        for r in np.flatnonzero(ready.any(axis=1)).tolist():
+            cells = np.flatnonzero(ready[r])
+            spreading[r, cells[self.rngs[r].randint(self.n_outcomes, size=len(cells)) < 1]] = True
+        reached = np.zeros_like(spreading)
+        reached[:, :-1] = _dilate(spreading[:, :-1].reshape(R, H, W)).reshape(R, -1)
+        new_fire = reached & self.flammable & ~self.on_fire & ~self.burned_out
+
+        self.delay_counter[waiting & running[:, None]] += 1
+        self.on_fire[spreading] = False
+        self.burned_out[spreading] = True
+        self.on_fire[new_fire] = True
+        self.delay_counter[new_fire] = 0
+        # People on the cells catching fire are killed
+        victims = np.nonzero(new_fire & (self.occupant >= 0))
+        people = self.occupant[victims]
+        self.occupant[victims] = -1
+        self.pos[victims[0], people] = self.n_cells
+        self.status[victims[0], people] = Reasons.KILLED_BY_FIRE.value
+
+    @property
+    def agents_saved(self):
+        """ (np.ndarray): Number of people saved in every replicate """
+        return (self.status == Reasons.SAVED.value).sum(axis=1)
+
+    @property
+    def agents_killed(self):
+        """ (np.ndarray): Number of people killed in every replicate """
+        return (self.status == Reasons.KILLED_BY_FIRE.value).sum(axis=1)
+
+    def _collect(self, running):
+        values = np.column_stack([self.agents_killed, self.agents_saved, self.saved_per_exit])
+        self._history.append((self.steps, running, values))
+
+    def replicate(self, r):
+        """
+        Returns:
+            (EnsembleReplicate): Outcome of the replicate r, for the batch reporters
+        """
+        return EnsembleReplicate(self, r)
+
+    def get_model_vars_dataframe(self):
+        """
+        Returns:
+            (pd.DataFrame): The model reporters of EvacuationModel ("Agents killed", "Agents saved" and
+            "Exit (x, y)") for every step of every replicate, indexed by Step and Replicate. A replicate has no rows
+            after the step where everybody left the building, like the DataCollector of a model that stopped.
+        """
+        columns = ["Agents killed", "Agents saved"] + ["Exit {}".format(ext) for ext in self.pos_exits]
+        frames = []
+        for step, running, values in self._history:
+            replicates = np.flatnonzero(running)
+            index = pd.MultiIndex.from_arrays([np.full(len(replicates), step), replicates],
+                                              names=["Step", "Replicate"])
+            frames.append(pd.DataFrame(values[replicates], index=index, columns=columns))
+        return pd.concat(frames)
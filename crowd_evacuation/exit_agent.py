@@ -1,18 +1,19 @@
 from mesa import Agent
 
+from crowd_evacuation.cell_types import CellType
 from crowd_evacuation.reasons import Reasons
 
 
 class ExitAgent(Agent):
     """ An emergency exit agent."""
+    cell_type = CellType.EXIT
 
     def __init__(self, unique_id, model):
         super().__init__(unique_id, model)
 
     def step(self):
-        from crowd_evacuation.civilian_agent import CivilianAgent
-
-        for agent in self.model.grid.get_neighbors(self.pos, moore=True, include_center=False):
-            if isinstance(agent, CivilianAgent):
-                agent._exit_point = self.pos
-                self.model.remove_agent(agent, Reasons.SAVED)
+        grid = self.model.grid
+        for x, y in grid.cells_around(self.pos, types=(CellType.CIVILIAN, CellType.STEWARD)):
+            agent = grid[x][y]
+            agent._exit_point = self.pos
+            self.model.remove_agent(agent, Reasons.SAVED)
@@ -1,9 +1,11 @@
 from mesa import Agent
-import numpy as np
+
+from crowd_evacuation.cell_types import CellType
 
 
 class FireAgent(Agent):
     """ Fire Agent """
+    cell_type = CellType.FIRE
 
     def __init__(self, pos, model):
         """
@@ -26,7 +28,7 @@ class FireAgent(Agent):
         """
         if (self.condition == "On Fire") and (self.delay_counter >= self.burned_delay):
             # Once we've reached the minimum delay, fire will spread eventually, depending on some probability
-            p_spread = np.random.choice(4)  # Spread prob. 1/4
+            p_spread = self.model.np_random.choice(4)  # Spread prob. 1/4
             if p_spread < 1:
                 self.model.spread_fire(self)
                 self.condition = "Burned Out"
@@ -0,0 +1,80 @@
+import numpy as np
+
+from crowd_evacuation.cell_types import CellType
+from crowd_evacuation.fire_agent import FireAgent
+from crowd_evacuation.reasons import Reasons
+
+
+class FireSpread:
+    """
+    Cellular automaton version of the fire. Instead of one scheduled FireAgent per burning cell, the state of the
+    whole fire is kept in NumPy arrays and advanced for the whole grid at once every tick, with the same rules as
+    FireAgent: a cell on fire waits burned_delay ticks, then every tick it spreads to its 8 neighbours with
+    probability 1/4 and burns out.
+
+    Burning cells still hold a (non scheduled) FireAgent in the grid, so that the visualization and the perception
+    of the agents keep working as with the agent-based fire.
+    """
+
+    def __init__(self, model, burned_delay=1, n_outcomes=4):
+        """
+        Args:
+            model (EvacuationModel): Model where the fire spreads
+            burned_delay (int): How many steps a cell on fire waits until it can spread
+            n_outcomes (int): A cell ready to spread does it with probability 1 / n_outcomes every step
+        """
+        self.model = model
+        self.burned_delay = burned_delay
+        self.n_outcomes = n_outcomes
+        shape = (model.grid.height, model.grid.width)
+        self.on_fire = np.zeros(shape, dtype=bool)
+        self.burned_out = np.zeros(shape, dtype=bool)
+        self.delay_counter = np.zeros(shape, dtype=np.int16)
+
+    def ignite(self, positions):
+        """
+        Sets the given cells on fire, killing the people standing on them.
+
+        Args:
+            positions (List): (x, y) coordinates of the cells catching fire
+        """
+        model = self.model
+        grid = model.grid
+        for x, y in positions:
+            agent = grid[x][y]
+            if agent is not None:
+                model.remove_agent(agent, Reasons.KILLED_BY_FIRE)
+            grid.place_agent(FireAgent((x, y), model), (x, y))
+            self.on_fire[y, x] = True
+            self.delay_counter[y, x] = 0
+        model.update_terrain(positions)
+
+    def step(self):
+        """
+        Advances the fire of the whole grid one step.
+        """
+        waiting = self.on_fire & (self.delay_counter < self.burned_delay)
+        ready = self.on_fire & ~waiting
+        ready_ys, ready_xs = np.nonzero(ready)
+        spreads = self.model.np_random.randint(self.n_outcomes, size=len(ready_ys)) < 1
+        spreading = np.zeros_like(ready)
+        spreading[ready_ys[spreads], ready_xs[spreads]] = True
+
+        # Moore neighbourhood of the spreading cells, only empty cells and people catch fire
+        padded = np.pad(spreading, 1)
+        height, width = spreading.shape
+        reached = np.zeros_like(spreading)
+        for dy in range(3):
+            for dx in range(3):
+                reached |= padded[dy:dy + height, dx:dx + width]
+        types = self.model.grid.types
+        flammable = (types == CellType.EMPTY) | (types == CellType.CIVILIAN) | (types == CellType.STEWARD)
+        new_ys, new_xs = np.nonzero(reached & flammable)
+
+        self.delay_counter[waiting] += 1
+        self.on_fire[spreading] = False
+        self.burned_out[spreading] = True
+        grid = self.model.grid
+        for x, y in zip(ready_xs[spreads].tolist(), ready_ys[spreads].tolist()):
+            grid[x][y].condition = "Burned Out"
+        self.ignite(list(zip(new_xs.tolist(), new_ys.tolist())))
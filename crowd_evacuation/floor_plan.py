@@ -0,0 +1,312 @@
+import json
+from pathlib import Path
+
+import numpy as np
+
+try:
+    from PIL import Image
+except ImportError:  # Only needed to read floor plans from images
+    Image = None
+
+# Characters of the text floor plans. Any other character (e.g. a space or "-") is outside of the building.
+WALL_CHAR = "#"
+EXIT_CHAR = "E"
+MAIN_EXIT_CHAR = "M"
+FLOOR_CHAR = "."
+NO_SPAWN_CHAR = ","
+# RGB colours of the image floor plans. Any other colour is outside of the building.
+WALL_COLOR = (0, 0, 0)
+EXIT_COLOR = (0, 255, 0)
+MAIN_EXIT_COLOR = (0, 0, 255)
+FLOOR_COLOR = (255, 255, 255)
+NO_SPAWN_COLOR = (128, 128, 128)
+
+
+def line_cells(start, end):
+    """
+    Cells of a wall that goes from start point to end point, straight along the longest axis and then
+    diagonal, like the walls of the original building.
+
+    Args:
+        start (tuple): Coordinates of line's starting point
+        end (tuple): Coordinates of line's end point
+
+    Returns:
+        (List): Coordinates of the cells of the line, both ends included
+    """
+    x, y = start
+    diff_x, diff_y = end[0] - x, end[1] - y
+    cells = [(x, y)]
+    while diff_x != 0 or diff_y != 0:
+        step_x = int(np.sign(diff_x)) if abs(diff_x) >= abs(diff_y) else 0
+        step_y = int(np.sign(diff_y)) if abs(diff_y) >= abs(diff_x) else 0
+        x, y = x + step_x, y + step_y
+        diff_x, diff_y = diff_x - step_x, diff_y - step_y
+        cells.append((x, y))
+    return cells
+
+
+def reachable_from_border(barrier):
+    """
+    Cells that can be reached from the border of the grid without crossing the barrier, moving to any of the 8
+    neighbours like people and fire do. The region grows one ring of cells per iteration with whole-array operations.
+
+    Args:
+        barrier (np.ndarray): Boolean array of shape (height, width), True for the cells that can't be crossed
+
+    Returns:
+        (np.ndarray): Boolean array of shape (height, width)
+    """
+    height, width = barrier.shape
+    reached = np.zeros((height, width), dtype=bool)
+    reached[[0, -1], :] = True
+    reached[:, [0, -1]] = True
+    reached &= ~barrier
+    while True:
+        padded = np.pad(reached, 1)
+        grown = reached.copy()
+        for dy in range(3):
+            for dx in range(3):
+                grown |= padded[dy:dy + height, dx:dx + width]
+        grown &= ~barrier
+        if np.array_equal(grown, reached):
+            return reached
+        reached = grown
+
+
+class FloorPlan:
+    """
+    Geometry of a building compiled into boolean masks of shape (height, width), indexed by [y, x] like the layers
+    of LayeredGrid:
+
+    * wall: cells with a wall
+    * exit: cells with an emergency exit
+    * inside: floor of the building, the cells enclosed by walls and exits (without them)
+    * spawnable: cells of the floor where people and the fire can be at the start of the simulation
+
+    The masks are computed once, so placing agents, validating the position of the fire and building the graphs
+    only look them up. Floor plans are loaded from text, JSON or image files with load_floor_plan, and e_building
+    builds the original E-shaped building.
+    """
+
+    def __init__(self, wall, exits, main_exits=None, no_spawn=None, floor=None, zones=()):
+        """
+        Args:
+            wall (np.ndarray): Boolean array of shape (height, width), True for the walls
+            exits (List): Coordinates of the exits, in the order they are numbered
+            main_exits (List): Exits known by every civilian. All of them if None.
+            no_spawn (np.ndarray): Boolean array of the floor cells where nobody can be at the start
+            floor (np.ndarray): Boolean array of the cells declared as floor by the plan. If given, they must all be
+                enclosed by walls and exits.
+            zones (List): (x0, y0, x1, y1, weight) rectangles where people are weight times more likely to be at the
+                start (see spawn_weights)
+        """
+        self.height, self.width = wall.shape
+        self.exits = [tuple(ext) for ext in exits]
+        self.main_exits = self.exits if main_exits is None else [tuple(ext) for ext in main_exits]
+        self.exit = np.zeros((self.height, self.width), dtype=bool)
+        for x, y in self.exits:
+            self.exit[y, x] = True
+        # Exits are openings in the walls
+        self.wall = wall & ~self.exit
+        outside = reachable_from_border(self.wall | self.exit)
+        self.inside = ~outside & ~self.wall & ~self.exit
+        if floor is not None and np.any(floor & outside):
+            ys, xs = np.nonzero(floor & outside)
+            raise ValueError("The floor at {} isn't enclosed by walls and exits".format((int(xs[0]), int(ys[0]))))
+        self.spawnable = self.inside if no_spawn is None else self.inside & ~no_spawn
+        self.zones = [tuple(zone) for zone in zones]
+        for mask in (self.wall, self.exit, self.inside, self.spawnable):
+            mask.flags.writeable = False
+
+    @property
+    def walkable(self):
+        """ Cells people can walk through: the floor and the exits. """
+        return self.inside | self.exit
+
+    def is_spawnable(self, pos):
+        x, y = pos
+        return 0 <= x < self.width and 0 <= y < self.height and bool(self.spawnable[y, x])
+
+    def spawnable_cells(self):
+        """
+        Returns:
+            (List): Coordinates of the spawnable cells
+        """
+        ys, xs = np.nonzero(self.spawnable)
+        return list(zip(xs.tolist(), ys.tolist()))
+
+    def spawn_weights(self, zones=None):
+        """
+        Relative probability of every cell of having a person at the start of the simulation: 1 in the spawnable
+        cells, multiplied by the weight of every zone that contains them, and 0 everywhere else.
+
+        Args:
+            zones (List): (x0, y0, x1, y1, weight) rectangles (both corners included) applied after the zones of the
+                floor plan
+
+        Returns:
+            (np.ndarray): Float array of shape (height, width), a new one on every call
+        """
+        weights = self.spawnable.astype(float)
+        for x0, y0, x1, y1, weight in self.zones + list(zones or []):
+            weights[y0:y1 + 1, x0:x1 + 1] *= weight
+        return weights
+
+    @classmethod
+    def from_text(cls, text):
+        """
+        Args:
+            text (str): One line per row of cells, the first line is the top of the building (the highest y). "#" is
+                a wall, "E" an exit, "M" an exit known by every civilian, "." the floor and "," floor where nobody is
+                at the start. Any other character is outside of the building.
+
+        Returns:
+            (FloorPlan): Compiled floor plan
+        """
+        # Blank lines around the plan are ignored
+        rows = text.strip("\n").splitlines()
+        width = max(len(row) for row in rows)
+        # Pad short lines with outside cells and put the first line at the top
+        chars = np.array([list(row.ljust(width)) for row in reversed(rows)])
+        return cls._from_cells(chars == WALL_CHAR, chars == EXIT_CHAR, chars == MAIN_EXIT_CHAR,
+                               chars == NO_SPAWN_CHAR, (chars == FLOOR_CHAR) | (chars == NO_SPAWN_CHAR))
+
+    @classmethod
+    def from_json(cls, data):
+        """
+        Args:
+            data (dict): Either "rows", the lines of a text floor plan, or "width", "height" and "walls", a list of
+                [x0, y0, x1, y1] wall segments. "exits" and "main_exits" are lists of [x, y] exits (the main ones
+                are also exits), and "no_spawn" a list of [x0, y0, x1, y1] rectangles where nobody is at the start.
+                "zones" is a list of [x0, y0, x1, y1, weight] rectangles with more or fewer people at the start.
+
+        Returns:
+            (FloorPlan): Compiled floor plan
+        """
+        if "rows" in data:
+            plan = cls.from_text("\n".join(data["rows"]))
+            plan.zones = [tuple(zone) for zone in data.get("zones", [])]
+            return plan
+        shape = (data["height"], data["width"])
+        wall = np.zeros(shape, dtype=bool)
+        for x0, y0, x1, y1 in data["walls"]:
+            xs, ys = zip(*line_cells((x0, y0), (x1, y1)))
+            wall[list(ys), list(xs)] = True
+        no_spawn = np.zeros(shape, dtype=bool)
+        for x0, y0, x1, y1 in data.get("no_spawn", []):
+            no_spawn[y0:y1 + 1, x0:x1 + 1] = True
+        main_exits = data.get("main_exits")
+        return cls(wall, data.get("exits", []) or main_exits or [], main_exits, no_spawn, zones=data.get("zones", []))
+
+    @classmethod
+    def from_image(cls, path):
+        """
+        Args:
+            path (str or Path): Image file, one pixel per cell with the top row at the top of the building. Black is a
+                wall, green an exit, blue an exit known by every civilian, white the floor and grey floor where
+                nobody is at the start. Any other colour is outside of the building.
+
+        Returns:
+            (FloorPlan): Compiled floor plan
+        """
+        if Image is None:
+            raise ImportError("Reading floor plans from images requires Pillow (pip install Pillow)")
+        pixels = np.asarray(Image.open(path).convert("RGB"))[::-1]
+
+        def is_color(color):
+            return np.all(pixels == color, axis=-1)
+
+        no_spawn = is_color(NO_SPAWN_COLOR)
+        return cls._from_cells(is_color(WALL_COLOR), is_color(EXIT_COLOR), is_color(MAIN_EXIT_COLOR), no_spawn,
+                               is_color(FLOOR_COLOR) | no_spawn)
+
+    @classmethod
+    def _from_cells(cls, wall, exit_mask, main_exit_mask, no_spawn, floor):
+        def positions(mask):
+            ys, xs = np.nonzero(mask)
+            return list(zip(xs.tolist(), ys.tolist()))
+
+        main_exits = positions(main_exit_mask)
+        return cls(wall, positions(exit_mask | main_exit_mask), main_exits or None, no_spawn, floor)
+
+
+def sample_cells(weights, n, rng):
+    """
+    Draws n different cells, every one with a probability proportional to its weight, without retrying on occupied
+    cells: every candidate cell gets the random key log(u) / weight and the n largest keys are taken (weighted
+    sampling without replacement of Efraimidis and Spirakis). The cost is linear in the number of cells, however
+    full the building gets.
+
+    Args:
+        weights (np.ndarray): Float array of shape (height, width), 0 for the cells that can't be drawn
+        n (int): Number of cells
+        rng (np.random.RandomState): Random number generator
+
+    Returns:
+        (List): (x, y) coordinates of the cells, in random order
+    """
+    ys, xs = np.nonzero(weights > 0)
+    if n > len(xs):
+        raise ValueError("There are only {} free cells for {} people".format(len(xs), n))
+    if n == 0:
+        return []
+    with np.errstate(divide="ignore"):
+        keys = np.log(rng.random_sample(len(xs))) / weights[ys, xs]
+    chosen = np.argpartition(-keys, n - 1)[:n]
+    # Ordered by key, so which agent gets which cell is random too
+    chosen = chosen[np.argsort(-keys[chosen], kind="stable")]
+    return list(zip(xs[chosen].tolist(), ys[chosen].tolist()))
+
+
+def load_floor_plan(path):
+    """
+    Args:
+        path (str or Path): Floor plan file: .json (FloorPlan.from_json), .png/.bmp/.gif (FloorPlan.from_image) or
+            text with any other extension (FloorPlan.from_text)
+
+    Returns:
+        (FloorPlan): Compiled floor plan
+    """
+    path = Path(path)
+    suffix = path.suffix.lower()
+    if suffix == ".json":
+        with open(path) as f:
+            return FloorPlan.from_json(json.load(f))
+    if suffix in (".png", ".bmp", ".gif"):
+        return FloorPlan.from_image(path)
+    return FloorPlan.from_text(path.read_text())
+
+
+def e_building(width=50, height=50):
+    """
+    The original building of the model: an E-shaped floor with two courtyards open to the left side of the grid,
+    three exits on the left wall and three (the main entrance, known by every civilian) on the right wall.
+
+    Args:
+        width (int): Width of the grid
+        height (int): Height of the grid
+
+    Returns:
+        (FloorPlan): Compiled floor plan
+    """
+    length_E = int(height / 5)  # length of the vertical segments of the E
+    depth_E = int(width / 2)  # length of the horizontal segments of the E
+    walls = []
+    for i in range(3):
+        start = max(0, 2 * i * length_E)
+        walls.append((0, start, 0, start + length_E - 1))
+    for i in range(2):
+        start = 2 * i * length_E + length_E
+        walls.append((depth_E, start, depth_E, start + length_E - 1))
+    # Horizontal lines of the E (BB)
+    for y in [length_E, 2 * length_E, 3 * length_E - 1, 4 * length_E - 1]:
+        walls.append((0, y, depth_E, y))
+    # Long contour lines of the E
+    walls += [(0, 0, width - 1, 0), (0, height - 1, width - 1, height - 1), (width - 1, 0, width - 1, height - 1)]
+    # One exit in the middle of every vertical segment of the E, and the main entrance at 30% of the right wall
+    # ((0, 5), (0, 25), (0, 45), (49, 14), (49, 15) and (49, 16) in the 50x50 grid)
+    exits = [(0, length_E // 2 + 2 * i * length_E) for i in range(3)]
+    exits += [(width - 1, int(0.3 * height) - 1 + i) for i in range(3)]
+    return FloorPlan.from_json({"width": width, "height": height, "walls": walls, "exits": exits,
+                                "main_exits": exits[-3:]})
@@ -0,0 +1,330 @@
+from collections import deque
+from heapq import heappush, heappop
+
+import numpy as np
+
+from crowd_evacuation.path_finding import GridGraph
+
+
+def node_id(pos, width):
+    """
+    Flattens a grid position into the integer id used to index the distance fields.
+
+    Args:
+        pos (tuple): (x, y) coordinates of the cell
+        width (int): Width of the grid
+
+    Returns:
+        (int): y * width + x
+    """
+    return pos[1] * width + pos[0]
+
+
+def grid_adjacency(graph, width, height):
+    """
+    Converts the walkable graph into a compact CSR adjacency, where every node is identified by y * width + x.
+
+    Args:
+        graph (nx.Graph or GridGraph): Graph that represents the grid spaces.
+        width (int): Width of the grid
+        height (int): Height of the grid
+
+    Returns:
+        (tuple): indptr and indices arrays. The neighbours of node i are indices[indptr[i]:indptr[i + 1]]
+    """
+    if isinstance(graph, GridGraph):
+        return graph.indptr, graph.indices
+    n_nodes = width * height
+    neighbours = [[] for _ in range(n_nodes)]
+    for node in graph.nodes:
+        neighbours[node_id(node, width)] = [node_id(n, width) for n in graph[node]]
+    indptr = np.zeros(n_nodes + 1, dtype=np.int64)
+    indptr[1:] = np.cumsum([len(n) for n in neighbours])
+    indices = np.fromiter((n for node_neighbours in neighbours for n in node_neighbours), dtype=np.int64,
+                          count=indptr[-1])
+    return indptr, indices
+
+
+def compute_distance_field(indptr, indices, sources):
+    """
+    Multi-source breadth first search over the walkable grid. Every edge of the graph costs 1 (also the diagonal
+    ones), so BFS gives the same distances as Dijkstra.
+
+    Args:
+        indptr (np.ndarray): CSR row pointers of the walkable graph
+        indices (np.ndarray): CSR column indices of the walkable graph
+        sources (List): Node ids from where the search starts (distance 0)
+
+    Returns:
+        (np.ndarray): Number of steps from every node to the closest source. np.inf if it can't be reached.
+    """
+    dist = np.full(len(indptr) - 1, np.inf)
+    # Work on python lists, element access on numpy arrays is much slower inside the loop
+    indptr_l = indptr.tolist()
+    indices_l = indices.tolist()
+    dist_l = dist.tolist()
+    queue = deque()
+    for source in sources:
+        dist_l[source] = 0
+        queue.append(source)
+    while queue:
+        node = queue.popleft()
+        next_dist = dist_l[node] + 1
+        for neighbour in indices_l[indptr_l[node]:indptr_l[node + 1]]:
+            if dist_l[neighbour] == np.inf:
+                dist_l[neighbour] = next_dist
+                queue.append(neighbour)
+    return np.asarray(dist_l)
+
+
+class ExitDistanceFields:
+    """
+    Precomputed distance fields (one per exit) over the walkable terrain of the building.
+
+    Since every civilian heads to one of the same few exits, the shortest path problem is solved once per exit when
+    the model is created. Agents then find their way by following the gradient of the field of their goal, which
+    only costs a few lookups per cell instead of a whole A* search.
+
+    Next to the static fields, a fire-aware copy is kept for every hazard radius (how far from the fire an agent
+    wants to stay). When new cells catch fire, only the part of those fields whose shortest paths went through the
+    burning cells is repaired, instead of searching the whole building again.
+    """
+
+    def __init__(self, graph, exits, width, height, hazard_radii=(0,), static=None):
+        """
+        Args:
+            graph (nx.Graph or GridGraph): Graph that represents the walkable grid spaces.
+            exits (List): Coordinates of the exits
+            width (int): Width of the grid
+            height (int): Height of the grid
+            hazard_radii (tuple): Distances to the fire for which a fire-aware field is maintained
+            static (ExitDistanceFields): Fields of the same graph and exits, whose adjacency and static fields are
+                shared instead of computed again (see layout_cache). They are never modified, only the fire-aware
+                fields belong to every instance.
+        """
+        self.width = width
+        self.height = height
+        if static is not None:
+            self.indptr, self.indices = static.indptr, static.indices
+            self.fields = static.fields
+            self._neighbours = static._neighbours
+            self._fields = static._fields
+        else:
+            self.indptr, self.indices = grid_adjacency(graph, width, height)
+            self.fields = {tuple(ext): compute_distance_field(self.indptr, self.indices, [node_id(ext, width)])
+                           for ext in exits}
+            # Same information as python lists, which are faster to index one element at a time
+            self._neighbours = [self.indices[self.indptr[i]:self.indptr[i + 1]].tolist()
+                                for i in range(width * height)]
+            self._fields = {ext: field.tolist() for ext, field in self.fields.items()}
+        self._fire_fields = {radius: {ext: list(field) for ext, field in self._fields.items()}
+                             for radius in hazard_radii}
+        self._blocked = {radius: [False] * (width * height) for radius in hazard_radii}
+
+    def _to_pos(self, node):
+        return node % self.width, node // self.width
+
+    def _field(self, exit_pos, hazard_radius):
+        if hazard_radius is None:
+            return self._fields[exit_pos]
+        return self._fire_fields[hazard_radius][exit_pos]
+
+    def distance(self, exit_pos, pos, hazard_radius=None):
+        """
+        Args:
+            exit_pos (tuple): Exit to measure the distance to
+            pos (tuple): Starting position
+            hazard_radius (int): Distance kept from the fire. None ignores the fire.
+
+        Returns:
+            (float): Number of steps from pos to exit_pos over walkable terrain. np.inf if the exit can't be reached.
+        """
+        return self._field(exit_pos, hazard_radius)[node_id(pos, self.width)]
+
+    def lower_bound(self, exit_pos, start, non_walkable=()):
+        """
+        Args:
+            exit_pos (tuple): Exit to measure the distance to
+            start (tuple): Starting position
+            non_walkable (set): Positions where the agent shouldn't walk through
+
+        Returns:
+            (float): Number of steps that any path from start to exit_pos avoiding non_walkable takes at least: one
+            step to a free neighbour, plus its distance ignoring every obstacle. np.inf if no neighbour is free.
+        """
+        field = self._fields[exit_pos]
+        width = self.width
+        bound = np.inf
+        for neighbour in self._neighbours[node_id(start, width)]:
+            if field[neighbour] < bound and (neighbour % width, neighbour // width) not in non_walkable:
+                bound = field[neighbour]
+        return bound + 1
+
+    def heuristic(self, exit_pos):
+        """
+        Exact distance (ignoring any dynamic obstacle) to exit_pos as an A* heuristic. Obstacles can only make
+        paths longer, so it never overestimates and A* only has to search around the blocked cells.
+
+        Returns:
+            (function): heuristic(u, v) as expected by path_finding.astar_path
+        """
+        field = self._fields[exit_pos]
+        width = self.width
+
+        def exit_heuristic(u, v):
+            return field[u[1] * width + u[0]]
+
+        return exit_heuristic
+
+    def follow(self, exit_pos, start, non_walkable=(), hazard_radius=None):
+        """
+        Walks down the gradient of the distance field from start to exit_pos, avoiding the positions in non_walkable.
+        Every step goes to a neighbour one step closer to the exit, so the path is a shortest path. Among the
+        candidates, the cell closest in a straight line to the exit is preferred.
+
+        Args:
+            exit_pos (tuple): Exit the agent is heading to
+            start (tuple): Starting position
+            non_walkable (set): Positions where the agent shouldn't walk through
+            hazard_radius (int): Follow the fire-aware field for this distance to the fire. None ignores the fire.
+
+        Returns:
+            (List): Path from start to exit_pos. None when every shortest path goes through non_walkable positions.
+        """
+        field = self._field(exit_pos, hazard_radius)
+        width = self.width
+        ex, ey = exit_pos
+        node = node_id(start, width)
+        if field[node] == np.inf:
+            return None
+        path = [tuple(start)]
+        while field[node] > 0:
+            best = None
+            best_dist = None
+            target_dist = field[node] - 1
+            for neighbour in self._neighbours[node]:
+                if field[neighbour] != target_dist:
+                    continue
+                pos = (neighbour % width, neighbour // width)
+                if pos in non_walkable:
+                    continue
+                straight_dist = (pos[0] - ex) ** 2 + (pos[1] - ey) ** 2
+                if best is None or straight_dist < best_dist:
+                    best = neighbour
+                    best_dist = straight_dist
+            if best is None:
+                return None
+            node = best
+            path.append(self._to_pos(node))
+        return path
+
+    def detour(self, exit_pos, start, non_walkable=(), hazard_radius=None):
+        """
+        Local search around the cells blocking the gradient right next to start (usually other people): steps
+        sideways to the free neighbour closest to the exit and follows the gradient from there. The path is only
+        returned when it is as short as any path through a free neighbour can be, otherwise A* has to decide.
+
+        Args:
+            exit_pos (tuple): Exit the agent is heading to
+            start (tuple): Starting position
+            non_walkable (set): Positions where the agent shouldn't walk through
+            hazard_radius (int): Use the fire-aware field for this distance to the fire. None ignores the fire.
+
+        Returns:
+            (List): Shortest path from start to exit_pos. None if it couldn't be found locally.
+        """
+        field = self._field(exit_pos, hazard_radius)
+        width = self.width
+        candidates = []
+        for neighbour in self._neighbours[node_id(start, width)]:
+            pos = (neighbour % width, neighbour // width)
+            if field[neighbour] != np.inf and pos not in non_walkable:
+                candidates.append((field[neighbour], pos))
+        if not candidates:
+            return None
+        candidates.sort()
+        lower_bound = candidates[0][0]
+        for dist, pos in candidates:
+            if dist > lower_bound:
+                break
+            path = self.follow(exit_pos, pos, non_walkable, hazard_radius)
+            if path is not None:
+                return [tuple(start)] + path
+        return None
+
+    def block(self, positions):
+        """
+        Marks positions as non walkable (e.g. they caught fire) and repairs the fire-aware fields. The cells within
+        the hazard radius of every position are blocked in the corresponding field.
+
+        Args:
+            positions (List): Coordinates of the cells that became non walkable
+        """
+        width = self.width
+        for radius, blocked in self._blocked.items():
+            new_nodes = []
+            for x, y in positions:
+                for cell_x in range(max(0, x - radius), min(width, x + radius + 1)):
+                    for cell_y in range(max(0, y - radius), min(self.height, y + radius + 1)):
+                        node = cell_y * width + cell_x
+                        if not blocked[node]:
+                            blocked[node] = True
+                            new_nodes.append(node)
+            if new_nodes:
+                for field in self._fire_fields[radius].values():
+                    self._repair(field, blocked, new_nodes)
+
+    def _repair(self, field, blocked, removed):
+        """
+        Decremental repair of a distance field after removing some nodes. Distances can only grow, and only for the
+        nodes whose every shortest path went through a removed node. Those are found first, going outwards from the
+        removed nodes, and then their distances are recomputed from the border of the affected region.
+
+        Args:
+            field (List): Distance field to repair in place
+            blocked (List): Whether every node is currently blocked
+            removed (List): Nodes that just got blocked
+        """
+        neighbours = self._neighbours
+        # 1. Find the affected region, in order of increasing (old) distance so that every node is checked after all
+        # of the nodes one step closer to the exit.
+        affected = set()
+        queue = []
+        for node in removed:
+            if field[node] != np.inf:
+                affected.add(node)
+                heappush(queue, (field[node], node))
+        while queue:
+            dist, node = heappop(queue)
+            for neighbour in neighbours[node]:
+                if neighbour in affected or blocked[neighbour] or field[neighbour] != dist + 1:
+                    continue
+                # Still supported if any other neighbour one step closer to the exit is intact
+                supported = False
+                for other in neighbours[neighbour]:
+                    if field[other] == dist and other not in affected and not blocked[other]:
+                        supported = True
+                        break
+                if not supported:
+                    affected.add(neighbour)
+                    heappush(queue, (dist + 1, neighbour))
+
+        # 2. Recompute the affected distances, starting from the intact nodes around the region
+        for node in affected:
+            field[node] = np.inf
+        for node in affected:
+            if blocked[node]:
+                continue
+            for neighbour in neighbours[node]:
+                if neighbour not in affected and not blocked[neighbour] and field[neighbour] + 1 < field[node]:
+                    field[node] = field[neighbour] + 1
+            if field[node] != np.inf:
+                heappush(queue, (field[node], node))
+        while queue:
+            dist, node = heappop(queue)
+            if dist > field[node]:
+                continue
+            for neighbour in neighbours[node]:
+                if not blocked[neighbour] and dist + 1 < field[neighbour]:
+                    field[neighbour] = dist + 1
+                    heappush(queue, (dist + 1, neighbour))
@@ -0,0 +1,150 @@
+import numpy as np
+
+
+class CellSet:
+    """
+    Immutable set of grid cells stored as the bits of a Python int, bit y * width + x for the cell (x, y).
+
+    Civilians use it for the fire they know about. Merging what two civilians know is a single bitwise or of two
+    ints instead of rebuilding a set of tuples, and the merged value is shared by both of them: a CellSet is never
+    modified, so agents that know the same cells keep references to the same object and the memory used doesn't
+    grow with the number of agents.
+
+    It can be used wherever a set of positions is expected (in, iteration, len, truth value).
+    """
+
+    __slots__ = ("bits", "width")
+
+    def __init__(self, bits=0, width=1):
+        """
+        Args:
+            bits (int): Bits of the cells in the set
+            width (int): Width of the grid
+        """
+        self.bits = bits
+        self.width = width
+
+    @classmethod
+    def from_cells(cls, cells, width):
+        """
+        Args:
+            cells (iterable): (x, y) coordinates
+            width (int): Width of the grid
+
+        Returns:
+            (CellSet): Set of the given cells
+        """
+        return cls(0, width).with_cells(cells)
+
+    def with_cells(self, cells):
+        """
+        Args:
+            cells (iterable): (x, y) coordinates to add
+
+        Returns:
+            (CellSet): Union of this set and the given cells. Itself if they were all already in it.
+        """
+        bits = self.bits
+        width = self.width
+        for x, y in cells:
+            bits |= 1 << (y * width + x)
+        return self if bits == self.bits else CellSet(bits, width)
+
+    def union(self, other):
+        """
+        Returns:
+            (CellSet): Union of both sets, one of them if it already contains the other
+        """
+        bits = self.bits | other.bits
+        if bits == self.bits:
+            return self
+        if bits == other.bits:
+            return other
+        return CellSet(bits, self.width)
+
+    __or__ = union
+
+    def __contains__(self, pos):
+        return (self.bits >> (pos[1] * self.width + pos[0])) & 1 == 1
+
+    def node_ids(self):
+        """
+        Returns:
+            (List): y * width + x of every cell in the set, in increasing order
+        """
+        ids = []
+        bits = self.bits
+        while bits:
+            lowest = bits & -bits
+            ids.append(lowest.bit_length() - 1)
+            bits ^= lowest
+        return ids
+
+    def __iter__(self):
+        width = self.width
+        return ((node % width, node // width) for node in self.node_ids())
+
+    def __len__(self):
+        return bin(self.bits).count("1")
+
+    def __bool__(self):
+        return self.bits != 0
+
+    def __eq__(self, other):
+        return isinstance(other, CellSet) and self.bits == other.bits and self.width == other.width
+
+    def __hash__(self):
+        return hash((self.bits, self.width))
+
+    def to_mask(self, height):
+        """
+        Args:
+            height (int): Height of the grid
+
+        Returns:
+            (np.ndarray): Boolean array of shape (height, width), True for the cells in the set
+        """
+        n_cells = height * self.width
+        packed = np.frombuffer(self.bits.to_bytes((n_cells + 7) // 8, "little"), dtype=np.uint8)
+        return np.unpackbits(packed, bitorder="little")[:n_cells].astype(bool).reshape(height, self.width)
+
+
+class ExitIndex:
+    """
+    Numbers the exits of the building so that a set of exits is a small int, with bit i set for the exit i.
+    """
+
+    def __init__(self, exits):
+        """
+        Args:
+            exits (List): Coordinates of the exits
+        """
+        self.exits = [tuple(ext) for ext in exits]
+        self._bits = {ext: 1 << i for i, ext in enumerate(self.exits)}
+        # Positions of the exits of the masks looked up so far, in the order of self.exits. Only the masks that
+        # agents actually have are built, there are 2 ** len(exits) possible ones.
+        self._positions = {}
+
+    def bit(self, pos):
+        return self._bits[tuple(pos)]
+
+    def mask(self, positions):
+        """
+        Returns:
+            (int): Mask of the given exits
+        """
+        mask = 0
+        for pos in positions:
+            mask |= self._bits[tuple(pos)]
+        return mask
+
+    def positions(self, mask):
+        """
+        Returns:
+            (List): Coordinates of the exits in the mask. The list is shared, it must not be modified.
+        """
+        positions = self._positions.get(mask)
+        if positions is None:
+            positions = [ext for i, ext in enumerate(self.exits) if mask >> i & 1]
+            self._positions[mask] = positions
+        return positions
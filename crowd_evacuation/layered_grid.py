@@ -0,0 +1,107 @@
+import numpy as np
+from mesa.space import SingleGrid
+
+from crowd_evacuation.cell_types import CellType
+
+# Plain ints, enum attribute lookups are noticeably slower in the hot paths below
+EMPTY = int(CellType.EMPTY)
+HUMANS = (int(CellType.CIVILIAN), int(CellType.STEWARD))
+
+
+class LayeredGrid(SingleGrid):
+    """
+    SingleGrid that keeps typed NumPy layers in sync with the agents placed on it:
+
+    * types: CellType code of the agent in every cell (CellType.EMPTY if there is none)
+    * agent_index: unique_id of the civilian or steward in every cell, -1 for any other cell
+
+    Both layers have shape (height, width) and are indexed by [y, x]. Emptiness checks and neighbourhood scans are
+    answered from the layers, so only the cells that actually contain an agent are turned into Python objects.
+    """
+
+    def __init__(self, width, height, torus):
+        self.types = np.zeros((height, width), dtype=np.int8)
+        self.agent_index = np.full((height, width), -1, dtype=np.int32)
+        super().__init__(width, height, torus)
+
+    @property
+    def empties(self):
+        """ Empty cells, computed from the type layer instead of being maintained as a list on every move. """
+        ys, xs = np.nonzero(self.types == EMPTY)
+        return list(zip(xs.tolist(), ys.tolist()))
+
+    @empties.setter
+    def empties(self, value):
+        # Grid.__init__ fills the list of empty cells, the type layer already holds that information.
+        pass
+
+    def _place_agent(self, pos, agent):
+        x, y = pos
+        if self.grid[x][y] is not None:
+            raise Exception("Cell not empty")
+        self.grid[x][y] = agent
+        self.types[y, x] = agent.cell_type
+        if agent.cell_type in HUMANS:
+            self.agent_index[y, x] = agent.unique_id
+
+    def _remove_agent(self, pos, agent):
+        x, y = pos
+        self.grid[x][y] = None
+        self.types[y, x] = EMPTY
+        self.agent_index[y, x] = -1
+
+    def exists_empty_cells(self):
+        return bool(np.any(self.types == EMPTY))
+
+    def is_cell_empty(self, pos):
+        x, y = pos
+        return self.grid[x][y] is None
+
+    def window(self, pos, radius=1):
+        """
+        Returns:
+            (tuple): Bounds x0, x1, y0, y1 (exclusive ends) of the square of the given radius around pos, clipped to
+            the grid.
+        """
+        x, y = pos
+        return max(0, x - radius), min(self.width, x + radius + 1), max(0, y - radius), min(self.height, y + radius + 1)
+
+    def cells_around(self, pos, radius=1, include_center=False, types=None):
+        """
+        Positions of the Moore neighbourhood of pos holding one of the given cell types, in the same order as
+        get_neighborhood.
+
+        Args:
+            pos (tuple): Center of the neighbourhood
+            radius (int): Radius of the neighbourhood
+            include_center (bool): Whether pos itself is included
+            types (tuple): CellType codes to look for. Any occupied cell if None.
+
+        Returns:
+            (List): (x, y) coordinates of the matching cells
+        """
+        x0, x1, y0, y1 = self.window(pos, radius)
+        window = self.types[y0:y1, x0:x1]
+        if types is None:
+            selected = window != EMPTY
+        elif len(types) == 1:
+            selected = window == types[0]
+        else:
+            selected = np.isin(window, types)
+        if not include_center:
+            selected[pos[1] - y0, pos[0] - x0] = False
+        ys, xs = np.nonzero(selected)
+        return list(zip((xs + x0).tolist(), (ys + y0).tolist()))
+
+    def get_neighbors(self, pos, moore, include_center=False, radius=1):
+        if not moore or self.torus:
+            return super().get_neighbors(pos, moore, include_center, radius)
+        grid = self.grid
+        return [grid[x][y] for x, y in self.cells_around(pos, radius, include_center)]
+
+    def get_neighborhood(self, pos, moore, include_center=False, radius=1):
+        if not moore or self.torus:
+            return super().get_neighborhood(pos, moore, include_center, radius)
+        x0, x1, y0, y1 = self.window(pos, radius)
+        center = tuple(pos)
+        return [(x, y) for y in range(y0, y1) for x in range(x0, x1) if include_center or (x, y) != center]
@@ -0,0 +1,127 @@
+import hashlib
+import os
+import pickle
+from pathlib import Path
+
+import networkx as nx
+import numpy as np
+
+from crowd_evacuation import path_finding
+from crowd_evacuation.flow_field import ExitDistanceFields
+
+CACHE_VERSION = 1  # Changes every time the contents of a Layout change, so that old cache files are not loaded
+GRAPH_BACKENDS = ("networkx", "grid")
+
+_layouts = {}  # (layout key, graph backend) to the Layouts built or loaded by this process
+
+
+def layout_key(floor_plan):
+    """
+    Args:
+        floor_plan (FloorPlan): Building
+
+    Returns:
+        (str): Hash of everything the walkable graph and the distance fields depend on: the size, the walkable cells
+        and the exits, in order
+    """
+    digest = hashlib.sha256()
+    digest.update(repr((CACHE_VERSION, floor_plan.width, floor_plan.height, list(floor_plan.exits))).encode())
+    digest.update(np.packbits(floor_plan.walkable).tobytes())
+    return digest.hexdigest()[:32]
+
+
+def _read_only(array):
+    array.flags.writeable = False
+    return array
+
+
+class Layout:
+    """
+    The parts of a model that only depend on its floor plan: the walkable mask, the graph of the walkable cells and
+    the static distance fields of the exits. They are built once per floor plan and graph backend, and every model
+    of that building gets the same objects instead of building them again (see get_layout).
+
+    Everything is read-only: the arrays can't be written, the networkx graph is frozen and the python lists of the
+    fields are tuples. Models keep what changes during a simulation (the fire-aware fields) on their own.
+    """
+
+    def __init__(self, floor_plan, graph_backend="networkx"):
+        """
+        Args:
+            floor_plan (FloorPlan): Building
+            graph_backend (str): "networkx" or "grid", as in EvacuationModel
+        """
+        if graph_backend not in GRAPH_BACKENDS:
+            raise ValueError("graph_backend must be 'networkx' or 'grid'")
+        self.key = layout_key(floor_plan)
+        self.graph_backend = graph_backend
+        self.walkable = _read_only(floor_plan.walkable.copy())
+        if graph_backend == "grid":
+            self.graph = path_finding.GridGraph(self.walkable)
+        else:
+            self.graph = nx.freeze(path_finding.walkable_graph(self.walkable))
+        self.exit_fields = ExitDistanceFields(self.graph, floor_plan.exits, floor_plan.width, floor_plan.height,
+                                              hazard_radii=())
+        self._freeze()
+
+    def _freeze(self):
+        fields = self.exit_fields
+        _read_only(self.walkable)
+        _read_only(fields.indptr)
+        _read_only(fields.indices)
+        for field in fields.fields.values():
+            _read_only(field)
+        fields._neighbours = tuple(tuple(neighbours) for neighbours in fields._neighbours)
+        fields._fields = {ext: tuple(field) for ext, field in fields._fields.items()}
+
+    def __setstate__(self, state):
+        # Arrays are writeable again after unpickling
+        self.__dict__.update(state)
+        self._freeze()
+
+
+def _cache_path(directory, key, graph_backend):
+    return Path(directory) / "layout-{}-{}.pkl".format(key, graph_backend)
+
+
+def get_layout(floor_plan, graph_backend="networkx", directory=None):
+    """
+    Returns the Layout of a floor plan, built at most once per process. With a directory, layouts are also saved
+    there, one file per floor plan (by layout_key) and graph backend, and loaded by any later process instead of
+    being built again.
+
+    Args:
+        floor_plan (FloorPlan): Building
+        graph_backend (str): "networkx" or "grid", as in EvacuationModel
+        directory (str or Path): Directory of the on-disk cache, None to only cache in memory
+
+    Returns:
+        (Layout): Read-only layout shared by every model of the same building
+    """
+    key = (layout_key(floor_plan), graph_backend)
+    layout = _layouts.get(key)
+    if layout is not None:
+        return layout
+    path = None if directory is None else _cache_path(directory, *key)
+    if path is not None and path.exists():
+        try:
+            with open(path, "rb") as f:
+                layout = pickle.load(f)
+        except (EOFError, pickle.UnpicklingError, AttributeError, ImportError):
+            layout = None  # Unreadable file (e.g. written by another version), built again below
+    if layout is None:
+        layout = Layout(floor_plan, graph_backend)
+        if path is not None:
+            # Write to a temporary file first, so processes sharing the directory never read half a file
+            path.parent.mkdir(parents=True, exist_ok=True)
+            tmp_path = path.with_suffix(".{}.tmp".format(os.getpid()))
+            with open(tmp_path, "wb") as f:
+                pickle.dump(layout, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_path, path)
+    _layouts[key] = layout
+    return layout
+
+
+def clear_cache():
+    """ Forgets the layouts cached in memory by this process (the files on disk are kept). """
+    _layouts.clear()
@@ -1,24 +1,48 @@
+from contextlib import nullcontext
 from functools import partial
 
 import numpy as np
 
 from mesa import Model
 from mesa.time import RandomActivation
-from mesa.space import SingleGrid
 from mesa.datacollection import DataCollector
 
+from crowd_evacuation.cell_types import CellType
 from crowd_evacuation.exit_agent import ExitAgent
 from crowd_evacuation.wall_agent import WallAgent
 from crowd_evacuation.fire_agent import FireAgent
+from crowd_evacuation.fire_spread import FireSpread
 from crowd_evacuation.steward_agent import StewardAgent
 from crowd_evacuation.civilian_agent import CivilianAgent
 from crowd_evacuation.reasons import Reasons
-from crowd_evacuation import path_finding
+from crowd_evacuation.flow_field import ExitDistanceFields
+from crowd_evacuation.floor_plan import FloorPlan, e_building, load_floor_plan, sample_cells
+from crowd_evacuation.knowledge import ExitIndex
+from crowd_evacuation.layered_grid import LayeredGrid
+from crowd_evacuation.layout_cache import GRAPH_BACKENDS, get_layout
+from crowd_evacuation.planning import PathPlanner
+from crowd_evacuation.population import Population
+from crowd_evacuation.profiling import Profiler
+from crowd_evacuation.scheduling import ACTIVATIONS, SimultaneousActivation
+from crowd_evacuation.trajectory import TrajectoryRecorder
 
 
 def count_agents_saved(exit_pos, model):
-    exit_list = [agent._exit_point for agent in model.agents_saved]
-    return exit_list.count(exit_pos)
+    return model.saved_per_exit[exit_pos]
+
+
+# Reporters are module functions instead of lambdas over the model, so a model can be pickled (see checkpoint.py)
+def count_total_killed(model):
+    return len(model.agents_killed)
+
+
+def count_total_saved(model):
+    return len(model.agents_saved)
+
+
+def age_band(age):
+    """ Age group of an agent, the same split used for the visual range and the visualization. """
+    return "<=45" if age <= 45 else ">45"
 
 
 class EvacuationModel(Model):
@@ -32,28 +56,103 @@ class EvacuationModel(Model):
     how the amount of casualties varies with respect to the different variables.
     """
 
-    def __init__(self, N=10, K=0, width=50, height=50, fire_x=1, fire_y=1, civil_info_exchange=True):
+    def __init__(self, N=10, K=0, width=50, height=50, fire_x=1, fire_y=1, civil_info_exchange=True,
+                 graph_backend="networkx", fire_mode="agents", population_engine=False, seed=None, profile=False,
+                 trajectory_dir=None, trajectory_steps=500, floor_plan=None, spawn_zones=None, layout_cache=None,
+                 activation="random", planning_workers=None):
+        """
+        Args:
+            width (int): Width of the grid, only used by the default building
+            height (int): Height of the grid, only used by the default building
+            graph_backend (str): "networkx" to represent the walkable terrain with a networkx graph, or "grid" for
+                the compact path_finding.GridGraph (integer nodes and CSR adjacency), faster on large grids.
+            fire_mode (str): "agents" to simulate the fire with one scheduled FireAgent per burning cell, or "array"
+                to advance the whole fire at once every step with fire_spread.FireSpread.
+            population_engine (bool): Store the traits of the civilians in NumPy arrays (population.Population) and
+                compute what all of them see in one batched pass at the start of every step.
+            seed (int): Seed of the random number generators of the model (self.random and self.np_random). Every
+                random decision of the model and its agents comes from them, so runs with the same seed are identical.
+            profile (bool): Measure the time spent in every phase of every step (see profiling.Profiler), available
+                in self.profiler.
+            trajectory_dir (str): Record the positions of the agents after every step, and when they are saved or
+                killed, in this directory (see trajectory.TrajectoryRecorder). Nothing is recorded if None.
+            trajectory_steps (int): Maximum number of steps recorded
+            floor_plan (FloorPlan or str): Building where the evacuation happens, or the file it's loaded from (see
+                floor_plan.load_floor_plan). The original E-shaped building (floor_plan.e_building) if None.
+            spawn_zones (List): (x0, y0, x1, y1, weight) rectangles where people are weight times more likely to be
+                at the start than in the rest of the building (e.g. (25, 0, 49, 49, 3) for more people in the east
+                wing), on top of the zones of the floor plan.
+            layout_cache (str): Directory where the graph and distance fields of the building are saved, so that
+                other processes load them instead of building them again (see layout_cache.get_layout). They are
+                always shared by the models of the same process.
+            activation (str): "random" to step the agents one at a time in a random order, every one of them
+                seeing the moves of the previous ones, or "simultaneous" to make all civilians and stewards decide
+                their moves on the same grid and resolve the conflicts between them at once
+                (scheduling.SimultaneousActivation).
+            planning_workers (int): Split the step in two phases: first every civilian and steward looks around and
+                plans its path on the building as it is at the start of the step, with this many processes
+                (planning.PathPlanner), then they move. If None, every agent looks around, plans and moves in its
+                turn.
+        """
+        if graph_backend not in GRAPH_BACKENDS:
+            raise ValueError("graph_backend must be 'networkx' or 'grid'")
+        if fire_mode not in ("agents", "array"):
+            raise ValueError("fire_mode must be 'agents' or 'array'")
+        if activation not in ACTIVATIONS:
+            raise ValueError("activation must be 'random' or 'simultaneous'")
+        # Mesa only seeds self.random when the seed is given as a keyword argument
+        self.reset_randomizer(seed)
+        self.np_random = np.random.RandomState(seed)
         self.num_civilians = N
         self.num_stewards = K
         self.civil_info_exchange = civil_info_exchange
         self.fire_initial_pos = (fire_x, fire_y)
+        if floor_plan is None:
+            floor_plan = e_building(width, height)
+        elif not isinstance(floor_plan, FloorPlan):
+            floor_plan = load_floor_plan(floor_plan)
+        self.floor_plan = floor_plan
         self.warning_UI = ""
         self.agents_alive = N + K  # Agents alive and inside the building
         self.agents_saved = []  # Agents that managed to get out
         self.agents_killed = []  # Agents that perished during the evacuation
-        self.grid = SingleGrid(height, width, False)
+        # Counters updated every time an agent leaves the building (with agents_alive), so they never have to be
+        # recomputed
+        self.killed_per_group = {}  # (agent type name, age band) to the number of agents killed
+        # Mesa grid plus NumPy layers of cell types and agent ids
+        self.grid = LayeredGrid(floor_plan.width, floor_plan.height, False)
         self.graph = None  # General graph representing walkable terrain
-        self.schedule = RandomActivation(self)  # Every tick, agents move in a different random order
-        # Create exits
-        self.pos_exits = [(0, 5), (0, 25), (0, 45)]
-        for i in range(3):
-            self.pos_exits.append((self.grid.width - 1, 14 + i))
-
-        self.draw_environment(self.pos_exits)
-        self.graph = path_finding.create_graph(self)
+        self.exit_fields = None  # Distance from every walkable position to each exit
+        self.fire = None  # Vectorized fire, only when fire_mode is "array"
+        self.terrain_version = 0  # Increases every time the walkable terrain changes (fire spreads)
+        self.terrain_changes = []  # Cells that caught fire with every new terrain version
+        self.path_cache_stats = {"hits": 0, "repairs": 0, "misses": 0}  # Reuse of the paths planned by civilians
+        self.population = Population(N + K) if population_engine else None
+        if activation == "simultaneous":
+            self.schedule = SimultaneousActivation(self)  # Every tick, civilians and stewards move at the same time
+        else:
+            self.schedule = RandomActivation(self)  # Every tick, agents move in a different random order
+        self.profiler = Profiler() if profile else None
+        self.planner = None if planning_workers is None else PathPlanner(self, planning_workers)
+        self.recorder = None if trajectory_dir is None else TrajectoryRecorder(trajectory_dir, N + K, trajectory_steps)
+        self.current_step = 0  # Step being simulated, 0 while the model is created
+        if self.profiler is not None:
+            self.profiler.instrument_schedule(self.schedule)
+        self.pos_exits = list(floor_plan.exits)
+
+        self.saved_per_exit = {ext: 0 for ext in self.pos_exits}  # Number of agents saved through every exit
+        self.exit_index = ExitIndex(self.pos_exits)  # Sets of exits known by the civilians are bitmasks
+
+        self.draw_environment()
+        # The graph and the static distance fields are built once per building and shared by every model of it
+        layout = get_layout(floor_plan, graph_backend, layout_cache)
+        self.graph = layout.graph
+        # Fire-aware fields are kept for every distance from the fire that civilians keep (CivilianAgent._being_risky)
+        self.exit_fields = ExitDistanceFields(self.graph, self.pos_exits, self.grid.width, self.grid.height,
+                                              hazard_radii=(0, 1), static=layout.exit_fields)
         # Define data collector
-        model_collector = {"Agents killed": lambda killed: len(self.agents_killed),
-                           "Agents saved": lambda saved: len(self.agents_saved)}
+        model_collector = {"Agents killed": count_total_killed,
+                           "Agents saved": count_total_saved}
         for exit_pos in self.pos_exits:
             title = "Exit {}".format(exit_pos)
             model_collector[title] = partial(count_agents_saved, exit_pos)
@@ -62,37 +161,34 @@ class EvacuationModel(Model):
         )
         # Create fire
         # for pos in self.fire_initial_pos:  # Only 1 source of fire since we are setting it from UI
-        x, y = self.fire_initial_pos
-        if not self.is_inside_square((x, y), (0, 29), (25, 39)) and not self.is_inside_square(
-                (x, y), (0, 10), (25, 20)):
+        if floor_plan.is_spawnable(self.fire_initial_pos):
             pos = self.fire_initial_pos
         else:
-            pos = (1, 1)
+            pos = (1, 1) if floor_plan.is_spawnable((1, 1)) else floor_plan.spawnable_cells()[0]
             self.warning_UI = "<b>WARNING:</b> Sorry but the position of the fire is outside of the building, " \
                               "change the setting and click reset simulation."
-        fire_agent = FireAgent(pos, self)
-        self.schedule.add(fire_agent)
-        self.grid.place_agent(fire_agent, pos)
+        if fire_mode == "array":
+            self.fire = FireSpread(self)
+            self.fire.ignite([pos])
+        else:
+            fire_agent = FireAgent(pos, self)
+            self.schedule.add(fire_agent)
+            self.grid.place_agent(fire_agent, pos)
+            self.update_terrain([pos])
+        # Random cells for every civilian and steward, drawn at once among the free spawnable cells
+        weights = floor_plan.spawn_weights(spawn_zones)
+        weights[self.grid.types != CellType.EMPTY] = 0
+        positions = sample_cells(weights, N + K, self.np_random)
         # Create civilian agents
         for i in range(self.num_civilians):
 
             # a civilian agent will know at least the main entrance to the building
-            known_exits = self.pos_exits[-3:]
+            known_exits = floor_plan.main_exits
             a = CivilianAgent(i, self, known_exits)
 
             self.schedule.add(a)
-            # Add the agent to a random grid cell
-
-            while True:
-                # pick the random coordinate
-                x = self.random.randrange(1, self.grid.width - 1)
-                y = self.random.randrange(1, self.grid.height - 1)
-                # check if the point is empty and inside of the building
-                if self.grid.is_cell_empty((x, y)) and not self.is_inside_square((x, y), (0, 29), (25, 39)) \
-                        and not self.is_inside_square((x, y), (0, 10), (25, 20)):
-                    break
-
-            self.grid.place_agent(a, (x, y))
+            # Add the agent to its random grid cell
+            self.grid.place_agent(a, positions[i])
 
         # Create steward agents
         for i in range(self.num_civilians, self.num_civilians + self.num_stewards):
@@ -102,34 +198,94 @@ class EvacuationModel(Model):
             a = StewardAgent(i, self, known_exits)
 
             self.schedule.add(a)
-            # Add the agent to a random grid cell
-
-            while True:
-                # pick the random coordinate
-                x = self.random.randrange(1, self.grid.width - 1)
-                y = self.random.randrange(1, self.grid.height - 1)
-                # check if the point is empty and inside of the building
-                if self.grid.is_cell_empty((x, y)) and not self.is_inside_square((x, y), (0, 29), (25, 39)) \
-                        and not self.is_inside_square((x, y), (0, 10), (25, 20)):
-                    break
-
-            self.grid.place_agent(a, (x, y))
+            # Add the agent to its random grid cell
+            self.grid.place_agent(a, positions[i])
 
         self.running = True  # Set this to false when we want to finish simulation (e.g. all agents are out of building)
         self.datacollector.collect(self)
-
-    @staticmethod
-    def is_inside_square(point, bottom_left, top_right):
-        return bottom_left[0] <= point[0] <= top_right[0] and bottom_left[1] <= point[1] <= top_right[1]
+        self._record_trajectory()
 
     def step(self):
-        self.schedule.step()
+        self.current_step = self.schedule.steps + 1
+        if self.population is not None:
+            with self._phase("population perception"):
+                self.population.perceive(self.grid)
+        if self.planner is not None:
+            with self._phase("planning phase"):
+                movers = [agent for agent in self.schedule.agents if isinstance(agent, CivilianAgent)]
+                # Information spreads in the order agents look around, which is random like the order they move in
+                self.random.shuffle(movers)
+                for agent in movers:
+                    agent.prepare()
+                self.planner.plan([agent for agent in movers if agent._goal is not None])
+        with self._phase("schedule"):
+            self.schedule.step()
+        if self.fire is not None:
+            with self._phase("fire spread"):
+                self.fire.step()
         # collect data
-        self.datacollector.collect(self)
+        with self._phase("datacollector"):
+            self.datacollector.collect(self)
+        self._record_trajectory()
+        if self.profiler is not None:
+            self.profiler.end_step(self.schedule.steps)
 
         # Halt if no more agents in the building
         if self.count_agents(self) == 0:
             self.running = False
+            if self.planner is not None:
+                self.planner.close()
+
+    def __getstate__(self):
+        # The trajectory recorder writes the files of this run only, copies of the model (see checkpoint.py) don't
+        # take it with them
+        state = self.__dict__.copy()
+        state["recorder"] = None
+        return state
+
+    def add_stewards(self, K):
+        """
+        Adds stewards in random free cells of the building, e.g. to a model forked from a checkpoint.
+
+        Args:
+            K (int): Number of stewards to add
+        """
+        if self.recorder is not None:
+            raise ValueError("Stewards can't be added to a model whose trajectory is being recorded")
+        first_id = self.num_civilians + self.num_stewards
+        weights = self.floor_plan.spawn_weights()
+        weights[self.grid.types != CellType.EMPTY] = 0
+        positions = sample_cells(weights, K, self.np_random)
+        if self.population is not None:
+            self.population.extend(K)
+        for i, pos in zip(range(first_id, first_id + K), positions):
+            a = StewardAgent(i, self, self.pos_exits)
+            self.schedule.add(a)
+            self.grid.place_agent(a, pos)
+        self.num_stewards += K
+        self.agents_alive += K
+
+    def set_civil_info_exchange(self, civil_info_exchange):
+        """
+        Turns the information exchange between civilians on or off for the rest of the simulation.
+
+        Args:
+            civil_info_exchange (bool): Whether civilians exchange information with each other
+        """
+        self.civil_info_exchange = civil_info_exchange
+        for agent in self.schedule.agents:
+            if type(agent) is CivilianAgent:
+                agent._info_exchange = civil_info_exchange
+
+    def _record_trajectory(self):
+        if self.recorder is not None:
+            with self._phase("trajectory recording"):
+                self.recorder.record(self.grid)
+                self.recorder.flush()
+
+    def _phase(self, name):
+        # Times a phase of the step when profiling, does nothing otherwise
+        return self.profiler.phase(name) if self.profiler is not None else nullcontext()
 
     def remove_agent(self, agent, reason, **kwargs):
         """
@@ -143,73 +299,27 @@ class EvacuationModel(Model):
         """
         if reason == Reasons.SAVED:
             self.agents_saved.append(agent)
+            self.saved_per_exit[agent._exit_point] += 1
         elif reason == Reasons.KILLED_BY_FIRE:
             self.agents_killed.append(agent)
+            group = (type(agent).__name__, age_band(agent._age))
+            self.killed_per_group[group] = self.killed_per_group.get(group, 0) + 1
+        if self.recorder is not None:
+            self.recorder.log_event(self.current_step, agent, reason,
+                                    agent._exit_point if reason == Reasons.SAVED else agent.pos)
 
         self.agents_alive -= 1
         self.schedule.remove(agent)
         self.grid.remove_agent(agent)
 
-    def draw_environment(self, exits=None):
-        length_E = int(self.grid.height / 5)  # length of the vertical segments of the E
-        depth_E = int(self.grid.width / 2)  # length of the horizontal segments of the E
-        for i in range(3):
-            start = max(0, 2 * i * length_E)
-            self.draw_wall((0, start), (0, start + length_E - 1))
-        for i in range(2):
-            start = 2 * i * length_E + length_E
-            self.draw_wall((depth_E, start), (depth_E, start + length_E - 1))
-        # Horizontal lines of the E (BB)
-        aux_y_coord = [length_E, 2 * length_E, 3 * length_E - 1, 4 * length_E - 1]
-        for y in aux_y_coord:
-            self.draw_wall((0, y), (depth_E, y))
-        top_left_corner = (0, self.grid.height - 1)
-        top_right_corner = (self.grid.width - 1, self.grid.height - 1)
-        bottom_right_corner = (self.grid.width - 1, 0)
-        # Draw long contour lines E
-        self.draw_wall((0, 0), bottom_right_corner)
-        self.draw_wall(top_left_corner, top_right_corner)
-        self.draw_wall(bottom_right_corner, top_right_corner)
-
-        # Draw exits
-        self.draw_exits(exits)
-
-    def draw_wall(self, start, end):
-        """
-        Draws a line that goes from start point to end point.
-
-        Args:
-            start (List): Coordinates of line's starting point
-            end (List): Coordinates of line's end point
-
-        Returns:
-            None
+    def draw_environment(self):
         """
-        diff_x, diff_y = np.subtract(end, start)
-        wall_coordinates = np.asarray(start)
-
-        if self.grid.is_cell_empty(wall_coordinates.tolist()):
-            w = WallAgent(wall_coordinates.tolist(), self)
-            self.grid.place_agent(w, wall_coordinates.tolist())
-
-        while diff_x != 0 or diff_y != 0:
-            if abs(diff_x) == abs(diff_y):
-                # diagonal wall
-                wall_coordinates[0] += np.sign(diff_x)
-                wall_coordinates[1] += np.sign(diff_y)
-                diff_x -= 1
-                diff_y -= 1
-            elif abs(diff_x) < abs(diff_y):
-                # wall built in y dimension
-                wall_coordinates[1] += np.sign(diff_y)
-                diff_y -= 1
-            else:
-                # wall built in x dimension
-                wall_coordinates[0] += np.sign(diff_x)
-                diff_x -= 1
-            if self.grid.is_cell_empty(wall_coordinates.tolist()):
-                w = WallAgent(wall_coordinates.tolist(), self)
-                self.grid.place_agent(w, wall_coordinates.tolist())
+        Places the walls and the exits of the floor plan on the grid.
+        """
+        ys, xs = np.nonzero(self.floor_plan.wall)
+        for pos in zip(xs.tolist(), ys.tolist()):
+            self.grid.place_agent(WallAgent(pos, self), pos)
+        self.draw_exits(self.pos_exits)
 
     def draw_exits(self, exits_list):
         for ext in exits_list:
@@ -223,13 +333,17 @@ class EvacuationModel(Model):
             self.grid.place_agent(e, ext)
 
     def spread_fire(self, fire_agent):
-        fire_neighbors = self.grid.get_neighborhood(fire_agent.pos, moore=True, include_center=False)
+        # Only empty cells and people can catch fire
+        fire_neighbors = self.grid.cells_around(fire_agent.pos,
+                                                types=(CellType.EMPTY, CellType.CIVILIAN, CellType.STEWARD))
+        new_fire = []
         for grid_space in fire_neighbors:
             if self.grid.is_cell_empty(grid_space):
                 # Create new fire agent and add it to grid and scheduler
                 new_fire_agent = FireAgent(grid_space, self)
                 self.schedule.add(new_fire_agent)
                 self.grid.place_agent(new_fire_agent, grid_space)
+                new_fire.append(grid_space)
             else:
                 # If human agents, eliminate them and spread anyway
                 agent = self.grid.get_cell_list_contents(grid_space)[0]
@@ -238,15 +352,36 @@ class EvacuationModel(Model):
                     self.remove_agent(agent, Reasons.KILLED_BY_FIRE)
                     self.schedule.add(new_fire_agent)
                     self.grid.place_agent(new_fire_agent, grid_space)
+                    new_fire.append(grid_space)
+        self.update_terrain(new_fire)
+
+    def update_terrain(self, new_fire):
+        """
+        Updates the knowledge of the walkable terrain after some cells caught fire.
+
+        Args:
+            new_fire (List): Coordinates of the cells that caught fire
+        """
+        if new_fire:
+            # Only the part of the fire-aware exit fields that went through the new fire has to be recomputed
+            self.exit_fields.block(new_fire)
+            self.terrain_changes.append(list(new_fire))
+            self.terrain_version += 1
+
+    def burned_since(self, version):
+        """
+        Args:
+            version (int): Terrain version to compare with
+
+        Returns:
+            (iterator): Coordinates of the cells that caught fire after that terrain version
+        """
+        for new_fire in self.terrain_changes[version:]:
+            yield from new_fire
 
     @staticmethod
     def count_agents(model):
         """
         Helper method to count agents alive and still in the building.
         """
-        count = 0
-        for agent in model.schedule.agents:
-            agent_type = type(agent)
-            if (agent_type == CivilianAgent) or (agent_type == StewardAgent):
-                count += 1
-        return count
+        return model.agents_alive
@@ -0,0 +1,411 @@
+import hashlib
+import json
+import math
+import pickle
+import queue
+from contextlib import nullcontext
+from itertools import product
+from multiprocessing import Pool
+from pathlib import Path
+from statistics import NormalDist
+
+import numpy as np
+import pandas as pd
+
+from crowd_evacuation.result_store import ResultStore
+
+
+def run_seed(params, iteration, base_seed=0):
+    """
+    Derives the seed of one run from its parameters, so that every run gets the same seed no matter in which order
+    (or in which process) it is executed.
+
+    Args:
+        params (dict): Parameters of the model of the run
+        iteration (int): Repetition of the run with these parameters
+        base_seed (int): Seed of the whole batch
+
+    Returns:
+        (int): Seed for the random number generators of the model
+    """
+    key = json.dumps([base_seed, sorted(params.items()), iteration], default=str)
+    return int.from_bytes(hashlib.sha256(key.encode()).digest()[:4], "little")
+
+
+def run_key(params, iteration, base_seed=0):
+    """
+    Identifier of one run, derived from the same values as its seed. It doesn't depend on the other runs of the
+    batch, so a batch resumed with more iterations or other parameter ranges recognises the runs it already did.
+
+    Args:
+        params (dict): Parameters of the model of the run
+        iteration (int): Repetition of the run with these parameters
+        base_seed (int): Seed of the whole batch
+
+    Returns:
+        (int): Non-negative 63 bit run_id
+    """
+    key = json.dumps(["run", base_seed, sorted(params.items()), iteration], default=str)
+    return int.from_bytes(hashlib.sha256(key.encode()).digest()[:8], "little") >> 1
+
+
+def t_quantile(p, dof):
+    """
+    Quantile of Student's t distribution, so that scipy isn't needed. Exact for 1 and 2 degrees of freedom, and a
+    Cornish-Fisher expansion around the normal quantile (accurate to about 1%) from 3 on.
+
+    Args:
+        p (float): Probability
+        dof (int): Degrees of freedom
+
+    Returns:
+        (float): t such that P(T <= t) = p
+    """
+    if dof == 1:
+        return math.tan(math.pi * (p - 0.5))
+    if dof == 2:
+        return (2 * p - 1) / math.sqrt(2 * p * (1 - p))
+    z = NormalDist().inv_cdf(p)
+    return (z + (z ** 3 + z) / (4 * dof) + (5 * z ** 5 + 16 * z ** 3 + 3 * z) / (96 * dof ** 2) +
+            (3 * z ** 7 + 19 * z ** 5 + 17 * z ** 3 - 15 * z) / (384 * dof ** 3))
+
+
+def confidence_half_width(values, confidence=0.95):
+    """
+    Args:
+        values (List): Results of the runs
+        confidence (float): Confidence level
+
+    Returns:
+        (float): Half width of the confidence interval of the mean of values. inf with less than 2 values.
+    """
+    if len(values) < 2:
+        return math.inf
+    std = np.std(values, ddof=1)
+    return t_quantile((1 + confidence) / 2, len(values) - 1) * std / math.sqrt(len(values))
+
+
+def _run_model(task):
+    """
+    Runs one model until it stops or reaches max_steps. Defined at module level so that it can be sent to the
+    worker processes.
+
+    Args:
+        task (tuple): run_id, model class, model parameters, seed, max_steps and model reporters
+
+    Returns:
+        (tuple): run_id and the values of the model reporters at the end of the run
+    """
+    run_id, model_cls, params, seed, max_steps, model_reporters = task
+    model = model_cls(seed=seed, **params)
+    while model.running and model.schedule.steps < max_steps:
+        model.step()
+    if getattr(model, "planner", None) is not None:
+        model.planner.close()  # The run may have stopped at max_steps, before the evacuation ended
+    return run_id, {name: reporter(model) for name, reporter in model_reporters.items()}
+
+
+def _run_ensemble(task):
+    """
+    Runs several iterations of the same parameters at once, as the replicates of one ensemble model (see
+    ensemble.EnsembleModel), until every replicate stops or max_steps is reached.
+
+    Args:
+        task (tuple): run_ids, ensemble model class, model parameters, seeds (one per run), max_steps and model
+            reporters
+
+    Returns:
+        (List): run_id and the values of the model reporters (evaluated on the replicate of the run) of every run
+    """
+    run_ids, model_cls, params, seeds, max_steps, model_reporters = task
+    model = model_cls(seeds, **params)
+    model.run(max_steps)
+    results = []
+    for replicate, run_id in enumerate(run_ids):
+        outcome = model.replicate(replicate)
+        results.append((run_id, {name: reporter(outcome) for name, reporter in model_reporters.items()}))
+    return results
+
+
+class ParallelBatchRunner:
+    """
+    Replacement of Mesa's BatchRunner that spreads the runs over a pool of processes.
+
+    Every run gets a seed and a run_id derived from its parameters and iteration (see run_seed and run_key), so the
+    results don't depend on the number of workers or on the order in which runs finish. Finished runs are appended to
+    a checkpoint file as they arrive, and runs already in it are skipped, so a batch that crashed can be resumed where
+    it stopped, also with more iterations or other parameter values (only the runs that are missing are done).
+    Alternatively, the results can be streamed to a result_store.ResultStore, which then also serves as checkpoint.
+    Checkpoints and stores record the engine that produced them (the agent model or an ensemble), and a batch refuses
+    to resume results produced by the other engine.
+
+    In adaptive mode (when a tolerance is given), every combination of parameters is run at least min_iterations and
+    at most iterations times, and stops as soon as the confidence interval of the mean of every metric is within
+    +- tolerance. Convergence is only checked on the first runs of a combination, in order, so the runs that are done
+    don't depend on the order in which they finish either. A batch resumed with a larger iterations counts the runs
+    that are already finished toward the confidence interval of their own combination.
+
+    In ensemble mode, model_cls is a vectorized ensemble (ensemble.EnsembleModel) and all the iterations of a
+    combination of parameters are run together as its replicates, with the same seeds as the separate runs would get.
+    """
+
+    def __init__(self, model_cls, variable_parameters, fixed_parameters=None, iterations=1, max_steps=1000,
+                 model_reporters=None, workers=None, base_seed=0, checkpoint=None, store=None, tolerance=None,
+                 metrics=None, min_iterations=3, confidence=0.95, ensemble=False):
+        """
+        Args:
+            model_cls (type): Model class, it has to accept a seed keyword argument
+            variable_parameters (dict): Parameter name to the values to sweep. Every combination is run.
+            fixed_parameters (dict): Parameters that are the same for every run
+            iterations (int): Number of runs for every combination of parameters. The maximum in adaptive mode, where
+                it has to be at least 2.
+            max_steps (int): Maximum number of steps of a run
+            model_reporters (dict): Column name to a function of the model, evaluated at the end of every run. The
+                functions have to be defined at module level so that they can be pickled.
+            workers (int): Number of worker processes. Defaults to the number of CPUs.
+            base_seed (int): Seed of the whole batch, every run seed is derived from it
+            checkpoint (str or Path): File where finished runs are stored. None disables resuming.
+            store (ResultStore): Store where the results are written as every run finishes, instead of keeping them
+                in memory. Runs already in the store are skipped.
+            tolerance (float): Half width of the confidence intervals at which the runs of a combination of parameters
+                stop. None runs every combination the given number of iterations.
+            metrics (tuple): Names of the (numeric) model reporters that have to converge. Defaults to the first
+                model reporter.
+            min_iterations (int): Minimum number of runs of every combination of parameters in adaptive mode
+            confidence (float): Confidence level of the intervals
+            ensemble (bool): model_cls is an ensemble model, created with the list of seeds of the runs and the
+                parameters, that runs all the iterations of a combination of parameters at once. The model reporters
+                are evaluated on model.replicate(i) of every run. Not available in adaptive mode.
+        """
+        if ensemble and tolerance is not None:
+            raise ValueError("Ensemble runs can't be used in adaptive mode")
+        if tolerance is not None and iterations < 2:
+            raise ValueError("Adaptive mode needs at least 2 iterations, a confidence interval needs two runs")
+        self.model_cls = model_cls
+        self.variable_parameters = {name: list(values) for name, values in variable_parameters.items()}
+        self.fixed_parameters = fixed_parameters or {}
+        self.iterations = iterations
+        self.max_steps = max_steps
+        self.model_reporters = model_reporters or {}
+        self.workers = workers
+        self.base_seed = base_seed
+        self.checkpoint = Path(checkpoint) if checkpoint is not None else None
+        self.store = store
+        self.tolerance = tolerance
+        self.metrics = tuple(metrics) if metrics is not None else tuple(self.model_reporters)[:1]
+        self.min_iterations = min(max(2, min_iterations), iterations)
+        self.confidence = confidence
+        self.ensemble = ensemble
+        self.metadata = {"engine": "ensemble" if ensemble else "agents"}  # How the results are produced
+        self.runs_per_cell = {}  # Index of every combination of parameters to its number of runs and convergence
+        self.model_vars = {}  # run_id to (variable parameters, iteration, seed, reporter values)
+        self._pending = {}  # run_id to (combination, iteration, seed) of the runs that have been started
+        self._cell_params = self._cells()
+
+    def _cells(self):
+        """
+        Returns:
+            (List): Variable parameters of every combination, always in the same order
+        """
+        names = list(self.variable_parameters)
+        return [dict(zip(names, values)) for values in product(*self.variable_parameters.values())]
+
+    def _run_id(self, cell, iteration):
+        return run_key({**self.fixed_parameters, **self._cell_params[cell]}, iteration, self.base_seed)
+
+    def _load_checkpoint(self):
+        """
+        Reads the runs finished by a previous execution. A run that was being written when the process crashed is
+        dropped from the file, it will just be run again.
+        """
+        if self.checkpoint is None or not self.checkpoint.exists():
+            return
+        with open(self.checkpoint, "r+b") as f:
+            end = 0
+            while True:
+                try:
+                    run_id, record = pickle.load(f)
+                except (EOFError, pickle.UnpicklingError):
+                    break
+                if run_id is None:
+                    # Header written when the file was created
+                    if record != self.metadata:
+                        raise ValueError("The runs in {} were produced with {}, not {}".format(
+                            self.checkpoint, record, self.metadata))
+                elif end == 0:
+                    raise ValueError("The runs in {} don't say how they were produced, they can't be resumed"
+                                     .format(self.checkpoint))
+                else:
+                    self.model_vars[run_id] = record
+                end = f.tell()
+            f.truncate(end)
+
+    def run_all(self):
+        """
+        Runs every combination of parameters that isn't in the checkpoint yet.
+        """
+        self._load_checkpoint()
+        if self.store is not None:
+            self.store.check_metadata(self.metadata)
+        cells = self._cells()
+        done = self._finished_metrics()
+        with Pool(self.workers) as pool, self._open_checkpoint() as checkpoint:
+            if self.ensemble:
+                tasks = [self._ensemble_task(cell, params, done) for cell, params in enumerate(cells)]
+                for results in pool.imap_unordered(_run_ensemble, [task for task in tasks if task[0]]):
+                    for run_id, reporters in results:
+                        self._record(run_id, reporters, checkpoint)
+                for cell in range(len(cells)):
+                    self.runs_per_cell[cell] = (self.iterations, None)
+            elif self.tolerance is None:
+                tasks = [self._task(cell, params, iteration) for cell, params in enumerate(cells)
+                         for iteration in range(self.iterations) if self._run_id(cell, iteration) not in done]
+                for run_id, reporters in pool.imap_unordered(_run_model, tasks):
+                    self._record(run_id, reporters, checkpoint)
+                for cell in range(len(cells)):
+                    self.runs_per_cell[cell] = (self.iterations, None)
+            else:
+                self._run_adaptive(pool, cells, done, checkpoint)
+
+    def _run_adaptive(self, pool, cells, done, checkpoint):
+        """
+        Keeps every combination of parameters running until its metrics converge.
+
+        Args:
+            pool (Pool): Worker processes
+            cells (List): Variable parameters of every combination
+            done (dict): run_id to the metric values of the runs that are already finished
+            checkpoint (file): Open checkpoint file, or None
+        """
+        results = queue.Queue()
+        finished = [0] * len(cells)  # Length of the prefix of finished runs of every combination
+        launched = [0] * len(cells)  # Runs of every combination that have been started (or were already done)
+        in_flight = 0
+
+        def advance(cell):
+            # Starts the next runs of a combination, or marks it as finished. Returns the number of runs started.
+            started = 0
+            while True:
+                while finished[cell] < launched[cell] and self._run_id(cell, finished[cell]) in done:
+                    finished[cell] += 1
+                if finished[cell] < launched[cell]:
+                    return started  # Still waiting for a run
+                n_runs = finished[cell]
+                runs = [done[self._run_id(cell, i)] for i in range(n_runs)]
+                converged = n_runs >= self.min_iterations and all(
+                    confidence_half_width([run[i] for run in runs], self.confidence) <= self.tolerance
+                    for i in range(len(self.metrics)))
+                if converged or n_runs >= self.iterations:
+                    self.runs_per_cell[cell] = (n_runs, converged)
+                    return started
+                # Up to the minimum number of runs at once, then one by one
+                for iteration in range(launched[cell], min(max(self.min_iterations, n_runs + 1), self.iterations)):
+                    if self._run_id(cell, iteration) not in done:
+                        pool.apply_async(_run_model, (self._task(cell, cells[cell], iteration),),
+                                         callback=results.put, error_callback=results.put)
+                        started += 1
+                    launched[cell] = iteration + 1
+
+        for cell in range(len(cells)):
+            in_flight += advance(cell)
+        while in_flight:
+            result = results.get()
+            in_flight -= 1
+            if isinstance(result, BaseException):
+                raise result
+            run_id, reporters = result
+            cell = self._pending[run_id][0]
+            self._record(run_id, reporters, checkpoint)
+            done[run_id] = tuple(reporters[metric] for metric in self.metrics)
+            in_flight += advance(cell)
+
+    def _task(self, cell, params, iteration):
+        """
+        Returns:
+            (tuple): Arguments of _run_model for the given run
+        """
+        run_id = self._run_id(cell, iteration)
+        model_params = {**self.fixed_parameters, **params}
+        seed = run_seed(model_params, iteration, self.base_seed)
+        self._pending[run_id] = (cell, iteration, seed)
+        return run_id, self.model_cls, model_params, seed, self.max_steps, self.model_reporters
+
+    def _ensemble_task(self, cell, params, done):
+        """
+        Returns:
+            (tuple): Arguments of _run_ensemble for the runs of the given combination of parameters that aren't done
+        """
+        tasks = [self._task(cell, params, iteration) for iteration in range(self.iterations)
+                 if self._run_id(cell, iteration) not in done]
+        run_ids = [task[0] for task in tasks]
+        seeds = [task[3] for task in tasks]
+        return run_ids, self.model_cls, {**self.fixed_parameters, **params}, seeds, self.max_steps, \
+            self.model_reporters
+
+    def _record(self, run_id, reporters, checkpoint):
+        """
+        Stores the results of a finished run, in the store if there is one or in memory (and the checkpoint file).
+        """
+        cell, iteration, seed = self._pending.pop(run_id)
+        params = self._cell_params[cell]
+        if self.store is not None:
+            self.store.append_run(run_id, {**params, **self.fixed_parameters, "iteration": iteration}, seed,
+                                  reporters)
+            return
+        record = (params, iteration, seed, reporters)
+        self.model_vars[run_id] = record
+        if checkpoint is not None:
+            pickle.dump((run_id, record), checkpoint)
+            checkpoint.flush()
+
+    def _open_checkpoint(self):
+        if self.checkpoint is None or self.store is not None:
+            return nullcontext()
+        checkpoint = open(self.checkpoint, "ab")
+        if checkpoint.tell() == 0:
+            pickle.dump((None, self.metadata), checkpoint)
+            checkpoint.flush()
+        return checkpoint
+
+    def _finished_metrics(self):
+        """
+        Returns:
+            (dict): run_id to the values of the metrics of every run that is already finished
+        """
+        if self.store is None:
+            return {run_id: tuple(record[3][metric] for metric in self.metrics)
+                    for run_id, record in self.model_vars.items()}
+        if ResultStore.RUNS not in self.store.schema:
+            return {}
+        columns = [self.store.column(ResultStore.RUNS, metric).tolist() for metric in self.metrics]
+        return dict(zip(self.store.column(ResultStore.RUNS, "run_id").tolist(), zip(*columns)))
+
+    def get_runs_per_cell_dataframe(self):
+        """
+        Returns:
+            (pd.DataFrame): One row per combination of parameters, with the number of runs it used (Runs) and whether
+            its metrics converged within the tolerance (Converged, empty when not running in adaptive mode).
+        """
+        cells = self._cells()
+        rows = [{**cells[cell], "Runs": n_runs, "Converged": converged}
+                for cell, (n_runs, converged) in sorted(self.runs_per_cell.items())]
+        return pd.DataFrame(rows, columns=list(self.variable_parameters) + ["Runs", "Converged"])
+
+    def get_model_vars_dataframe(self):
+        """
+        Returns:
+            (pd.DataFrame): One row per run of this batch, with the same columns as Mesa's BatchRunner (variable
+            parameters, Run, model reporters and fixed parameters) plus the iteration and the seed of the run. Runs
+            of the checkpoint that belong to other batches (e.g. other parameter values) are left out.
+        """
+        rows = []
+        for cell in range(len(self._cell_params)):
+            for iteration in range(self.iterations):
+                run_id = self._run_id(cell, iteration)
+                if run_id in self.model_vars:
+                    params, iteration, seed, reporters = self.model_vars[run_id]
+                    rows.append({**params, "Run": run_id, "Iteration": iteration, "Seed": seed, **reporters,
+                                 **self.fixed_parameters})
+        columns = list(self.variable_parameters) + ["Run", "Iteration", "Seed"] + list(self.model_reporters) + \
+            list(self.fixed_parameters)
+        return pd.DataFrame(rows, columns=columns)
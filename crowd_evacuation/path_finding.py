@@ -1,10 +1,11 @@
+from collections import deque
 from heapq import heappush, heappop
-from itertools import count, product
+from itertools import count
 
 import numpy as np
 import networkx as nx
 
-from crowd_evacuation.wall_agent import WallAgent
+from crowd_evacuation.knowledge import CellSet
 
 
 def euc_dist(a, b):
@@ -14,26 +15,34 @@ def euc_dist(a, b):
 
 
 def create_graph(model):
-    height = model.grid.height
-    width = model.grid.width
-    # Creating a 2D grid-like graph, each node represents a position
+    return walkable_graph(model.floor_plan.walkable)
+
+
+def walkable_graph(walkable):
+    """
+    Args:
+        walkable (np.ndarray): Boolean array of shape (height, width), True for the cells that can be walked.
+
+    Returns:
+        (nx.Graph): Graph whose nodes are the (x, y) coordinates of the walkable cells, connected to their 8 neighbours
+    """
+    height, width = walkable.shape
+    # Creating a 2D grid-like graph, each node (x, y) represents a position
     graph = nx.grid_graph(dim=[height, width])
     # Adding diagonal connectivity
-    for row in range(0, height - 1):
-        for col in range(0, width):
-            if col == 0:  # Only connectivity to the upper right
-                graph.add_edge((row, col), (row + 1, col + 1))
-            elif col == (width - 1):  # Only connectivity to the upper left
-                graph.add_edge((row, col), (row + 1, col - 1))
+    for x in range(0, width - 1):
+        for y in range(0, height):
+            if y == 0:  # Only connectivity to the upper right
+                graph.add_edge((x, y), (x + 1, y + 1))
+            elif y == (height - 1):  # Only connectivity to the upper left
+                graph.add_edge((x, y), (x + 1, y - 1))
             else:
-                graph.add_edge((row, col), (row + 1, col - 1))
-                graph.add_edge((row, col), (row + 1, col + 1))
+                graph.add_edge((x, y), (x + 1, y - 1))
+                graph.add_edge((x, y), (x + 1, y + 1))
 
-    # Now we remove the nodes that are not walkable (walls)
-    cell_list = list(product(np.arange(0, width, 1), np.arange(0, height, 1)))
-    for agent in model.grid.iter_cell_list_contents(cell_list):
-        if isinstance(agent, WallAgent):
-            graph.remove_node(tuple(agent.pos))
+    # Now we remove the nodes that are not walkable (walls and the outside of the building)
+    ys, xs = np.nonzero(~walkable)
+    graph.remove_nodes_from(zip(xs.tolist(), ys.tolist()))
 
     for node in graph.nodes:
         graph.nodes[node]["walkable"] = True
@@ -41,7 +50,122 @@ def create_graph(model):
     return graph
 
 
-def astar_path(G, source, target, heuristic=None, weight='weight'):
+# Offsets (dx, dy) of the 8 neighbours of a cell, same connectivity as create_graph
+NEIGHBOUR_OFFSETS = [(-1, -1), (0, -1), (1, -1), (-1, 0), (1, 0), (-1, 1), (0, 1), (1, 1)]
+
+
+class GridGraph:
+    """
+    Compact alternative to the networkx graph of create_graph. Every cell (x, y) is the node y * width + x, the
+    adjacency between walkable cells is stored as CSR arrays (the neighbours of node i are
+    indices[indptr[i]:indptr[i + 1]]) and walkability as a boolean array. Every edge costs 1.
+
+    Nodes are still referred to by their (x, y) coordinates from the outside, so it can be used with astar_path and
+    find_path the same way as the networkx graph.
+    """
+
+    def __init__(self, walkable):
+        """
+        Args:
+            walkable (np.ndarray): Boolean array of shape (height, width), True for the cells that can be walked.
+        """
+        walkable = np.asarray(walkable, dtype=bool)
+        self.height, self.width = walkable.shape
+        self.indptr, self.indices = self._build_adjacency(walkable)
+        # Precomputed walkable-cell mask, indexed by node id. It is never modified, obstacles that change during the
+        # simulation are passed to every query instead.
+        self.walkable = walkable.ravel().copy()
+        self.walkable.flags.writeable = False
+        # Same data as python lists/bytes, which the search loop reads faster one element at a time
+        self._walkable = self.walkable.tobytes()
+        self._indptr = self.indptr.tolist()
+        self._indices = self.indices.tolist()
+        self._nodes = [self.pos(node) for node in np.flatnonzero(self.walkable).tolist()]
+
+    @staticmethod
+    def _build_adjacency(walkable):
+        height, width = walkable.shape
+        ys, xs = np.nonzero(walkable)
+        sources = []
+        targets = []
+        for dx, dy in NEIGHBOUR_OFFSETS:
+            nxs = xs + dx
+            nys = ys + dy
+            inside = (nxs >= 0) & (nxs < width) & (nys >= 0) & (nys < height)
+            valid = inside.copy()
+            valid[inside] = walkable[nys[inside], nxs[inside]]
+            sources.append(ys[valid] * width + xs[valid])
+            targets.append(nys[valid] * width + nxs[valid])
+        sources = np.concatenate(sources)
+        targets = np.concatenate(targets)
+        order = np.lexsort((targets, sources))
+        indptr = np.zeros(height * width + 1, dtype=np.int64)
+        indptr[1:] = np.cumsum(np.bincount(sources, minlength=height * width))
+        return indptr, targets[order].astype(np.int64)
+
+    def node_id(self, pos):
+        return pos[1] * self.width + pos[0]
+
+    def pos(self, node):
+        return node % self.width, node // self.width
+
+    def __contains__(self, pos):
+        x, y = pos
+        return 0 <= x < self.width and 0 <= y < self.height and self._walkable[y * self.width + x] == 1
+
+    def __iter__(self):
+        return iter(self.nodes)
+
+    def __len__(self):
+        return len(self._nodes)
+
+    @property
+    def nodes(self):
+        """
+        Returns:
+            (List): Coordinates of all the nodes in the graph
+        """
+        return self._nodes
+
+    def neighbors(self, pos):
+        """
+        Returns:
+            (List): Coordinates of the walkable cells adjacent to pos
+        """
+        node = self.node_id(pos)
+        return [self.pos(n) for n in self._indices[self._indptr[node]:self._indptr[node + 1]]]
+
+    def allowed_cells(self, blocked=()):
+        """
+        Cells a query may walk through: the walkable mask without the blocked cells of this query.
+
+        Args:
+            blocked (set, CellSet or np.ndarray): Positions to avoid, or boolean mask of shape (height, width)
+
+        Returns:
+            (bytes or tuple): Either the whole mask as bytes, or the walkable bytes plus a set of blocked node ids
+        """
+        if isinstance(blocked, CellSet):
+            blocked = blocked.to_mask(self.height)
+        if isinstance(blocked, np.ndarray):
+            return (self.walkable & ~blocked.ravel()).tobytes(), frozenset()
+        return self._walkable, frozenset(self.node_id(pos) for pos in blocked)
+
+
+def create_grid_graph(model):
+    """
+    Builds the GridGraph of the model's grid from the walkable cells of its floor plan.
+
+    Args:
+        model (EvacuationModel): Model whose grid is represented
+
+    Returns:
+        (GridGraph): Graph that represents the walkable grid spaces.
+    """
+    return GridGraph(model.floor_plan.walkable)
+
+
+def astar_path(G, source, target, heuristic=None, weight='weight', blocked=frozenset(), expansions=None):
     """Returns a list of nodes in a shortest path between source and target
     using the A* ("A-star") algorithm.
 
@@ -51,7 +175,7 @@ def astar_path(G, source, target, heuristic=None, weight='weight'):
 
     Parameters
     ----------
-    G : NetworkX graph
+    G : NetworkX graph or GridGraph
 
     source : node
        Starting node for path
@@ -67,6 +191,14 @@ def astar_path(G, source, target, heuristic=None, weight='weight'):
     weight: string, optional (default='weight')
        Edge data key corresponding to the edge weight.
 
+    blocked : set or numpy array, optional
+       Nodes the path can't go through, either as a set of nodes (or CellSet) or as a
+       boolean mask of shape (height, width) indexed by [y, x]. The graph
+       itself is never modified, so queries can run concurrently.
+
+    expansions : list, optional
+       If given, the number of nodes expanded by the search is appended to it.
+
     Raises
     ------
     NetworkXNoPath
@@ -82,6 +214,13 @@ def astar_path(G, source, target, heuristic=None, weight='weight'):
         def heuristic(u, v):
             return 0
 
+    if isinstance(G, GridGraph):
+        return _grid_astar_path(G, source, target, heuristic, blocked, expansions)
+
+    if isinstance(blocked, np.ndarray):
+        blocked_mask = blocked
+        blocked = {node for node in G.nodes if blocked_mask[node[1], node[0]]}
+
     push = heappush
     pop = heappop
 
@@ -111,6 +250,8 @@ def astar_path(G, source, target, heuristic=None, weight='weight'):
                 path.append(node)
                 node = explored[node]
             path.reverse()
+            if expansions is not None:
+                expansions.append(len(explored))
             return path
 
         if curnode in explored:
@@ -119,7 +260,7 @@ def astar_path(G, source, target, heuristic=None, weight='weight'):
         explored[curnode] = parent
 
         for neighbor, w in G[curnode].items():
-            if not G.nodes[neighbor]["walkable"]:
+            if neighbor in blocked or not G.nodes[neighbor]["walkable"]:
                 continue
             else:
                 if neighbor in explored:
@@ -138,35 +279,119 @@ def astar_path(G, source, target, heuristic=None, weight='weight'):
                 enqueued[neighbor] = ncost, h
                 push(queue, (ncost + h, next(c), neighbor, ncost, curnode))
 
+    if expansions is not None:
+        expansions.append(len(explored))
+    raise nx.NetworkXNoPath("Node %s not reachable from %s" % (source, target))
+
+
+def _grid_astar_path(G, source, target, heuristic, blocked, expansions):
+    """Same search as astar_path, on the integer nodes and CSR arrays of a GridGraph."""
+    push = heappush
+    pop = heappop
+    width = G.width
+    indptr = G._indptr
+    indices = G._indices
+    walkable, blocked = G.allowed_cells(blocked)
+    source_id = G.node_id(source)
+    target_id = G.node_id(target)
+
+    c = count()
+    queue = [(0, next(c), source_id, 0, None)]
+    enqueued = {}
+    explored = {}
+
+    while queue:
+        _, __, curnode, dist, parent = pop(queue)
+
+        if curnode == target_id:
+            path = [curnode]
+            node = parent
+            while node is not None:
+                path.append(node)
+                node = explored[node]
+            path.reverse()
+            if expansions is not None:
+                expansions.append(len(explored))
+            return [(node % width, node // width) for node in path]
+
+        if curnode in explored:
+            continue
+
+        explored[curnode] = parent
+
+        ncost = dist + 1
+        for neighbor in indices[indptr[curnode]:indptr[curnode + 1]]:
+            if not walkable[neighbor] or neighbor in blocked or neighbor in explored:
+                continue
+            if neighbor in enqueued:
+                qcost, h = enqueued[neighbor]
+                if qcost <= ncost:
+                    continue
+            else:
+                h = heuristic((neighbor % width, neighbor // width), target)
+            enqueued[neighbor] = ncost, h
+            push(queue, (ncost + h, next(c), neighbor, ncost, curnode))
+
+    if expansions is not None:
+        expansions.append(len(explored))
     raise nx.NetworkXNoPath("Node %s not reachable from %s" % (source, target))
 
 
-def find_path(graph, start, target, non_walkable=[]):
+def find_path(graph, start, target, non_walkable=frozenset(), heuristic=euc_dist, expansions=None):
     """
-    Finds the optimal path between start and target, avoiding nodes in non_walkable.
+    Finds the optimal path between start and target, avoiding nodes in non_walkable. The graph is not modified.
 
     Args:
-        graph (nx.Graph): Graph that represents the grid spaces.
+        graph (nx.Graph or GridGraph): Graph that represents the grid spaces.
         start (tuple): Starting position
         target (tuple): Target position
-        non_walkable (List): List of positions where agent shouldn't walk through
+        non_walkable (set, CellSet or np.ndarray): Positions where agent shouldn't walk through, or a boolean mask of
+            shape (height, width) with those positions set to True. Positions outside of the graph are ignored.
+        heuristic (function): Estimate of the distance between two nodes. Defaults to the euclidean distance.
+        expansions (List): If given, the number of nodes expanded by the search is appended to it.
 
     Returns:
         (List): Optimal path. None when no path is found.
 
     """
-    # We restrict paths that would go through non_walkable spaces
-    for node in non_walkable:
-        graph.nodes[node]["walkable"] = False
-
     try:
         # A* algorithm
-        best_path = astar_path(graph, start, target, heuristic=euc_dist)
+        return astar_path(graph, start, target, heuristic=heuristic, blocked=non_walkable, expansions=expansions)
     except nx.NetworkXNoPath:
-        best_path = None
+        return None
 
-    # Undo the operation (other agents will move making the previous non-walkable spaces available again)
-    for node in non_walkable:
-        graph.nodes[node]["walkable"] = True
 
-    return best_path
+def bounded_path(graph, start, target, non_walkable=frozenset(), max_length=3):
+    """
+    Breadth first search of a path of at most max_length steps between start and target, avoiding nodes in
+    non_walkable. Only explores the few cells around start, so it is cheap also when there is no such path.
+
+    Args:
+        graph (nx.Graph or GridGraph): Graph that represents the grid spaces.
+        start (tuple): Starting position
+        target (tuple): Target position
+        non_walkable (set): Positions where agent shouldn't walk through
+        max_length (int): Maximum number of steps of the path
+
+    Returns:
+        (List): Shortest path. None when there is no path of at most max_length steps.
+    """
+    start = tuple(start)
+    parents = {start: None}
+    queue = deque([(start, 0)])
+    while queue:
+        node, length = queue.popleft()
+        if node == target:
+            path = []
+            while node is not None:
+                path.append(node)
+                node = parents[node]
+            path.reverse()
+            return path
+        if length == max_length:
+            continue
+        for neighbor in graph.neighbors(node):
+            if neighbor not in parents and neighbor not in non_walkable:
+                parents[neighbor] = node
+                queue.append((neighbor, length + 1))
+    return None
@@ -0,0 +1,184 @@
+import weakref
+from multiprocessing import Pipe, Process
+
+from crowd_evacuation.civilian_agent import CivilianAgent
+from crowd_evacuation.profiling import Profiler
+
+
+class _Terrain:
+    """
+    What path planning reads from the model (graph, distance fields and the cells that caught fire), replicated in
+    every worker process. The fire-aware fields are kept up to date by blocking the same cells as the model, in the
+    same order, so they are always the same as the model's.
+    """
+    population = None
+
+    def __init__(self, graph, exit_fields, width, terrain_changes):
+        self.graph = graph
+        self.exit_fields = exit_fields  # Copy of the model's fields, with every change in terrain_changes blocked
+        self.width = width
+        self.terrain_changes = list(terrain_changes)
+        self.terrain_version = len(self.terrain_changes)
+        self.path_cache_stats = {"hits": 0, "repairs": 0, "misses": 0}
+        self.profiler = None
+
+    def update(self, terrain_changes):
+        # Cells that caught fire since the last update, blocked in the same order as in the model
+        for new_fire in terrain_changes:
+            self.exit_fields.block(new_fire)
+            self.terrain_changes.append(new_fire)
+        self.terrain_version += len(terrain_changes)
+
+    def burned_since(self, version):
+        for new_fire in self.terrain_changes[version:]:
+            yield from new_fire
+
+
+def _plan_chunk(terrain, task):
+    """
+    Plans the paths of some agents in a worker process, on CivilianAgent objects that only have what planning reads.
+
+    Args:
+        terrain (_Terrain): Replica of the terrain of the model
+        task (tuple): (terrain changes since the last task, whether A* expansions are counted, agents) where every
+            agent is (pos, goal, observed fire, being risky, path cache, people next to it)
+
+    Returns:
+        (tuple): ((reachable, path) and path cache of every agent, path cache statistics, A* expansions)
+    """
+    terrain_changes, count_expansions, agents = task
+    terrain.update(terrain_changes)
+    terrain.path_cache_stats = {"hits": 0, "repairs": 0, "misses": 0}
+    terrain.profiler = Profiler() if count_expansions else None
+    results = []
+    for pos, goal, observed_fire, being_risky, path_cache, people in agents:
+        agent = CivilianAgent.__new__(CivilianAgent)
+        agent.model = terrain
+        agent.pos = pos
+        agent._goal = goal
+        agent._observed_fire = observed_fire
+        agent._being_risky = being_risky
+        agent._path_cache = path_cache
+        agent._step_state = (None, None, None, people)
+        agent.plan()
+        results.append((agent._planned, agent._path_cache))
+    expansions = [] if terrain.profiler is None else terrain.profiler.expansions
+    return results, terrain.path_cache_stats, expansions
+
+
+def _worker(connection, graph, exit_fields, width, terrain_changes):
+    """ Plans the chunks of agents sent by a PathPlanner until it receives None. """
+    terrain = _Terrain(graph, exit_fields, width, terrain_changes)
+    while True:
+        task = connection.recv()
+        if task is None:
+            break
+        connection.send(_plan_chunk(terrain, task))
+
+
+def _stop_workers(processes, connections):
+    """ Stops the worker processes of a PathPlanner. Doesn't reference the planner, so it can be its finalizer. """
+    for connection in connections:
+        try:
+            connection.send(None)
+            connection.close()
+        except OSError:
+            pass  # The worker is already gone (e.g. terminated at the exit of the interpreter)
+    for process in processes:
+        process.join()
+
+
+class PathPlanner:
+    """
+    Planning phase of the two-phase step of EvacuationModel (planning_workers parameter). Once every civilian and
+    steward prepared its move (CivilianAgent.prepare), their paths are planned at once against the same terrain
+    (walls, fire and the people every agent saw next to it), and the agents then move in the order of the schedule.
+
+    With more than one worker, the agents are split in as many chunks, planned by as many processes. Every worker
+    keeps a replica of the distance fields, and gets the cells that caught fire since the previous planning phase
+    with its chunk. It plans with the same code as the agents, so the paths are the same as when they are planned in
+    the model's process.
+
+    The workers are started at the first step and stopped when the evacuation ends, with close, or when the planner
+    is garbage collected (e.g. a model stopped at max_steps and then dropped). Models run by the worker processes of
+    ParallelBatchRunner can't start their own processes, so they should plan with one worker.
+    """
+
+    def __init__(self, model, workers=1):
+        """
+        Args:
+            model (EvacuationModel): Model whose agents are planned
+            workers (int): Number of processes planning the paths, 1 to plan them in the model's process
+        """
+        if workers < 1:
+            raise ValueError("planning_workers must be at least 1")
+        self.model = model
+        self.workers = workers
+        self._processes = []
+        self._connections = []
+        self._finalizer = None  # Stops the workers if the planner is collected before close
+        self._sent_version = 0  # Terrain version the workers are up to date with
+
+    def _start(self):
+        model = self.model
+        for _ in range(self.workers):
+            connection, worker_connection = Pipe()
+            process = Process(target=_worker, args=(worker_connection, model.graph, model.exit_fields,
+                                                    model.grid.width, model.terrain_changes), daemon=True)
+            process.start()
+            worker_connection.close()
+            self._processes.append(process)
+            self._connections.append(connection)
+        self._finalizer = weakref.finalize(self, _stop_workers, self._processes, self._connections)
+        self._sent_version = model.terrain_version
+
+    def plan(self, agents):
+        """
+        Plans the paths of agents that prepared their move, as if every one of them called CivilianAgent.plan.
+
+        Args:
+            agents (List): CivilianAgents with a goal
+        """
+        if self.workers == 1:
+            for agent in agents:
+                agent.plan()
+            return
+        model = self.model
+        if not self._processes:
+            self._start()
+        requests = [(agent.pos, agent._goal, agent._observed_fire, agent._being_risky, agent._path_cache,
+                     agent._step_state[3]) for agent in agents]
+        new_changes = model.terrain_changes[self._sent_version:]
+        self._sent_version = model.terrain_version
+        # Every worker gets a chunk, even an empty one, so that all of them get the new changes
+        chunk_size = -(-len(requests) // self.workers)
+        for i, connection in enumerate(self._connections):
+            connection.send((new_changes, model.profiler is not None,
+                             requests[i * chunk_size:(i + 1) * chunk_size]))
+        plans = []
+        for connection in self._connections:
+            results, stats, expansions = connection.recv()
+            plans.extend(results)
+            for name, count in stats.items():
+                model.path_cache_stats[name] += count
+            if model.profiler is not None:
+                model.profiler.expansions.extend(expansions)
+        for agent, (planned, path_cache) in zip(agents, plans):
+            agent._planned = planned
+            agent._path_cache = path_cache
+
+    def close(self):
+        """ Stops the worker processes, they are started again if more paths are planned. """
+        if self._finalizer is not None:
+            self._finalizer()
+            self._finalizer = None
+        self._processes = []
+        self._connections = []
+
+    def __getstate__(self):
+        # Copies of the model (see checkpoint.py) start their own workers
+        state = self.__dict__.copy()
+        state["_processes"] = []
+        state["_connections"] = []
+        state["_finalizer"] = None
+        return state
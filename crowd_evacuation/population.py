@@ -0,0 +1,118 @@
+import numpy as np
+
+from crowd_evacuation.layered_grid import EMPTY
+
+
+class PopulationTrait:
+    """
+    Descriptor for a trait of CivilianAgent. When the model has a Population, the value lives in the population
+    array of the same name, at the index of the agent's unique_id. Otherwise it is a plain attribute of the agent.
+    """
+
+    def __set_name__(self, owner, name):
+        self.name = name
+        self.column = name.lstrip("_")
+
+    def __get__(self, agent, owner=None):
+        if agent is None:
+            return self
+        population = agent.model.population
+        if population is None:
+            return agent.__dict__[self.name]
+        return getattr(population, self.column)[agent.unique_id].item()
+
+    def __set__(self, agent, value):
+        population = agent.model.population
+        if population is None:
+            agent.__dict__[self.name] = value
+        else:
+            getattr(population, self.column)[agent.unique_id] = value
+
+
+class Population:
+    """
+    Structure-of-arrays storage of the civilians (and stewards) of a model: every trait is a NumPy array indexed by
+    the agent's unique_id, and CivilianAgent reads and writes its traits from here.
+
+    It also computes what every agent sees in one batched pass over the type layer of the grid at the start of each
+    step, instead of one neighbourhood scan per agent. Agents then perceive the building as it was at the start of
+    the step.
+    """
+
+    TRAITS = {
+        "age": np.int16,
+        "weight": np.float64,
+        "visual_range": np.int16,
+        "speed": np.int16,
+        "being_risky": np.int16,
+        "willingness_to_follow_steward": np.float64,
+    }
+
+    def __init__(self, capacity):
+        """
+        Args:
+            capacity (int): Number of agents, unique_ids go from 0 to capacity - 1
+        """
+        for trait, dtype in self.TRAITS.items():
+            setattr(self, trait, np.zeros(capacity, dtype=dtype))
+        self._visible = {}
+
+    def extend(self, n):
+        """
+        Makes room for n more agents, with the next unique_ids.
+
+        Args:
+            n (int): Number of agents added
+        """
+        for trait, dtype in self.TRAITS.items():
+            setattr(self, trait, np.concatenate([getattr(self, trait), np.zeros(n, dtype=dtype)]))
+
+    def perceive(self, grid):
+        """
+        Finds, for every civilian and steward on the grid, the occupied cells within its visual range.
+
+        Args:
+            grid (LayeredGrid): Grid where the agents are
+        """
+        ys, xs = np.nonzero(grid.agent_index >= 0)
+        ids = grid.agent_index[ys, xs]
+        self._visible = {}
+        if len(ids) == 0:
+            return
+        radius = self.visual_range[ids]
+        max_radius = int(radius.max())
+        offsets = np.arange(-max_radius, max_radius + 1)
+        # (agents, window rows, window columns) coordinates of the cells around every agent
+        cell_ys = ys[:, None, None] + offsets[None, :, None]
+        cell_xs = xs[:, None, None] + offsets[None, None, :]
+        inside = (cell_ys >= 0) & (cell_ys < grid.height) & (cell_xs >= 0) & (cell_xs < grid.width)
+        in_range = ((np.abs(offsets)[None, :, None] <= radius[:, None, None]) &
+                    (np.abs(offsets)[None, None, :] <= radius[:, None, None]))
+        types = grid.types[np.clip(cell_ys, 0, grid.height - 1), np.clip(cell_xs, 0, grid.width - 1)]
+        seen = inside & in_range & (types != EMPTY)
+        seen[:, max_radius, max_radius] = False  # The agent itself
+        agent, row, col = np.nonzero(seen)
+        seen_xs = (xs[agent] + col - max_radius).tolist()
+        seen_ys = (ys[agent] + row - max_radius).tolist()
+        cells = list(zip(seen_xs, seen_ys))
+        ends = np.cumsum(np.bincount(agent, minlength=len(ids))).tolist()
+        start = 0
+        for unique_id, end in zip(ids.tolist(), ends):
+            self._visible[unique_id] = cells[start:end]
+            start = end
+
+    def visible_agents(self, agent):
+        """
+        Args:
+            agent (CivilianAgent): Agent looking around
+
+        Returns:
+            (List): Agents in the cells the agent saw at the start of the step, in the same order as get_neighbors
+        """
+        grid = agent.model.grid.grid
+        visible = []
+        for x, y in self._visible.get(agent.unique_id, ()):
+            other = grid[x][y]
+            if other is not None and other is not agent:
+                visible.append(other)
+        return visible
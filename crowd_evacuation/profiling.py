@@ -0,0 +1,159 @@
+import json
+from time import perf_counter
+
+import pandas as pd
+
+from crowd_evacuation.civilian_agent import CivilianAgent
+from crowd_evacuation.exit_agent import ExitAgent
+from crowd_evacuation.fire_agent import FireAgent
+
+
+class _Phase:
+    """ Context manager that adds the time spent inside it to a timer of the profiler. """
+
+    def __init__(self, timer):
+        self.timer = timer
+
+    def __enter__(self):
+        self.start = perf_counter()
+
+    def __exit__(self, *exc_info):
+        self.timer[0] += perf_counter() - self.start
+        self.timer[1] += 1
+
+
+class Profiler:
+    """
+    Opt-in instrumentation of EvacuationModel.step (created with profile=True). It measures the time and the number
+    of calls of every phase of a step:
+
+    * Model phases: population perception, the agents' steps (schedule), the array fire and the DataCollector.
+    * Agent phases: perception (_looking_around), knowledge exchange (_interact), path planning, movement, and the
+      whole step of every agent type (CivilianAgent.step, StewardAgent.step, ExitAgent.step, FireAgent.step).
+
+    It also counts the nodes expanded by every A* query. Agent methods are only wrapped on the agents of a profiled
+    model, so models without a profiler don't pay anything.
+    """
+
+    # Methods timed for every agent type, and the phase they are accounted to
+    AGENT_PHASES = {
+        CivilianAgent: {"_looking_around": "perception", "_interact": "interaction", "_route": "path planning",
+                        "_avoid_people": "path planning", "decide_move_action": "movement",
+                        "_movement_of_evacuation": "movement"},
+        ExitAgent: {},
+        FireAgent: {},
+    }
+
+    def __init__(self):
+        self._timers = {}  # phase to [seconds, calls] during the current step
+        self.expansions = []  # Nodes expanded by every A* query of the current step
+        self.steps = []  # Breakdown of every finished step
+        self.totals = {}  # phase to [seconds, calls] of the whole run
+
+    def _timer(self, phase):
+        if phase not in self._timers:
+            self._timers[phase] = [0.0, 0]
+        return self._timers[phase]
+
+    def phase(self, name):
+        """
+        Returns:
+            (context manager): Times the code inside the with statement as the given phase
+        """
+        return _Phase(self._timer(name))
+
+    def timed(self, phase, function):
+        """
+        Returns:
+            (function): function, timed as the given phase every time it's called
+        """
+        timer = self._timer(phase)
+
+        def timed_function(*args, **kwargs):
+            start = perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                timer[0] += perf_counter() - start
+                timer[1] += 1
+
+        return timed_function
+
+    def instrument(self, agent):
+        """
+        Times the step and the phases of an agent, by wrapping its bound methods.
+
+        Args:
+            agent (Agent): Agent to instrument
+        """
+        for agent_type, phases in self.AGENT_PHASES.items():
+            if isinstance(agent, agent_type):
+                agent.step = self.timed(type(agent).__name__ + ".step", agent.step)
+                for method, phase in phases.items():
+                    setattr(agent, method, self.timed(phase, getattr(agent, method)))
+                return
+
+    def instrument_schedule(self, schedule):
+        """
+        Instruments every agent added to the schedule from now on.
+
+        Args:
+            schedule (BaseScheduler): Scheduler of the model
+        """
+        add = schedule.add
+
+        def add_instrumented(agent):
+            self.instrument(agent)
+            add(agent)
+
+        schedule.add = add_instrumented
+
+    def end_step(self, step):
+        """
+        Stores the breakdown of the step that just finished and resets the timers for the next one.
+
+        Args:
+            step (int): Number of the step
+        """
+        phases = {}
+        for phase, timer in self._timers.items():
+            if timer[1]:
+                phases[phase] = {"seconds": timer[0], "calls": timer[1]}
+                total = self.totals.setdefault(phase, [0.0, 0])
+                total[0] += timer[0]
+                total[1] += timer[1]
+                timer[0] = 0.0
+                timer[1] = 0
+        astar = {"queries": len(self.expansions), "expansions": sum(self.expansions),
+                 "max_expansions": max(self.expansions, default=0)}
+        self.expansions.clear()
+        self.steps.append({"step": step, "phases": phases, "astar": astar})
+
+    def to_dataframe(self):
+        """
+        Returns:
+            (pd.DataFrame): One row per step, with the seconds and calls of every phase and the A* statistics
+        """
+        rows = []
+        for breakdown in self.steps:
+            row = {"step": breakdown["step"]}
+            for phase, values in breakdown["phases"].items():
+                row[phase + " seconds"] = values["seconds"]
+                row[phase + " calls"] = values["calls"]
+            for name, value in breakdown["astar"].items():
+                row["A* " + name] = value
+            rows.append(row)
+        return pd.DataFrame(rows).set_index("step") if rows else pd.DataFrame()
+
+    def export(self, path):
+        """
+        Writes the per-step breakdown to a file, as CSV if the name ends with .csv and as JSON otherwise.
+
+        Args:
+            path (str or Path): Output file
+        """
+        if str(path).endswith(".csv"):
+            self.to_dataframe().to_csv(path)
+        else:
+            with open(path, "w") as f:
+                json.dump({"steps": self.steps, "totals": self.totals}, f, indent=1)
@@ -0,0 +1,139 @@
+from functools import partial
+
+import numpy as np
+from mesa import Agent, Model
+from mesa.datacollection import DataCollector
+
+from crowd_evacuation.cell_types import CellType
+from crowd_evacuation.layered_grid import LayeredGrid
+from crowd_evacuation.reasons import Reasons
+from crowd_evacuation.trajectory import load_building, load_trajectory
+
+
+class ReplayAgent(Agent):
+    """
+    Stand-in for the agents of a recorded run. It has the attributes the visualization needs: the cell_type of the
+    agent it replaces and, depending on it, the age and weight of the civilian or the condition of the fire.
+    """
+
+    def __init__(self, unique_id, model, cell_type, age=None, weight=None):
+        super().__init__(unique_id, model)
+        self.cell_type = cell_type
+        self._age = age
+        self._weight = weight
+        self.condition = "On Fire"
+        self.pos = None
+
+    def step(self):
+        pass
+
+
+def count_replay_saved(exit_pos, model):
+    return model.saved_per_exit[exit_pos]
+
+
+class ReplayModel(Model):
+    """
+    Plays a run recorded by trajectory.TrajectoryRecorder (EvacuationModel(trajectory_dir=...)) instead of
+    simulating it, so it can be shown with the same visualization elements as the live model at the cost of reading
+    the recording.
+
+    Every step moves the replay speed recorded steps forwards, or backwards. seek jumps to any step, and the replay
+    can start at any step.
+    """
+
+    def __init__(self, directory, start_step=0, speed=1, backwards=False):
+        """
+        Args:
+            directory (str): Directory of the recording
+            start_step (int): First step shown
+            speed (int): Recorded steps advanced with every step of the replay
+            backwards (bool): Play the recording backwards
+        """
+        super().__init__()
+        self.positions, self.events = load_trajectory(directory)
+        self.layout, self.agent_info, self.fire_history = load_building(directory)
+        self.n_steps = len(self.positions)
+        self.speed = speed if not backwards else -speed
+        self.warning_UI = ""
+        self.profiler = None
+        height, width = self.layout.shape
+        self.grid = LayeredGrid(width, height, False)
+        ys, xs = np.nonzero(self.layout != CellType.EMPTY)
+        self.pos_exits = []
+        for x, y in zip(xs.tolist(), ys.tolist()):
+            cell_type = CellType(int(self.layout[y, x]))
+            self.grid.place_agent(ReplayAgent((x, y), self, cell_type), (x, y))
+            if cell_type == CellType.EXIT:
+                self.pos_exits.append((x, y))
+        self.agents = [ReplayAgent(unique_id, self, CellType(int(info["cell_type"])), int(info["age"]),
+                                   float(info["weight"]))
+                       for unique_id, info in enumerate(self.agent_info)]
+        self.fire_agents = {}  # Position to the ReplayAgent of the cells that are on fire or burned out
+        self.current_step = None
+        self.agents_saved = []
+        self.agents_killed = []
+        self.saved_per_exit = {}
+
+        model_collector = {"Agents killed": lambda model: len(model.agents_killed),
+                           "Agents saved": lambda model: len(model.agents_saved)}
+        for exit_pos in self.pos_exits:
+            model_collector["Exit {}".format(exit_pos)] = partial(count_replay_saved, exit_pos)
+        self.datacollector = DataCollector(model_reporters=model_collector)
+        self.seek(start_step)
+        self.running = True
+        self.datacollector.collect(self)
+
+    def seek(self, step):
+        """
+        Shows the state of the building after the given recorded step.
+
+        Args:
+            step (int): Recorded step, clipped to the steps of the recording
+        """
+        step = int(np.clip(step, 0, self.n_steps - 1))
+        grid = self.grid
+        # People: first take the ones that moved from the grid, then put them back, so nobody is placed in a cell
+        # that another agent is about to leave
+        frame = self.positions[step]
+        moved = []
+        for agent, (x, y) in zip(self.agents, frame.tolist()):
+            pos = (x, y) if x >= 0 else None
+            if agent.pos != pos:
+                if agent.pos is not None:
+                    grid.remove_agent(agent)
+                moved.append((agent, pos))
+        # Fire: ignited at or before this step, burned out if that happened at or before it too
+        ignited, burned_out = self.fire_history
+        on_fire = (ignited >= 0) & (ignited <= step)
+        for pos in [pos for pos in self.fire_agents if not on_fire[pos[1], pos[0]]]:
+            grid.remove_agent(self.fire_agents.pop(pos))
+        ys, xs = np.nonzero(on_fire)
+        for x, y in zip(xs.tolist(), ys.tolist()):
+            fire = self.fire_agents.get((x, y))
+            if fire is None:
+                fire = ReplayAgent((x, y), self, CellType.FIRE)
+                self.fire_agents[(x, y)] = fire
+                grid.place_agent(fire, (x, y))
+            fire.condition = "Burned Out" if 0 <= burned_out[y, x] <= step else "On Fire"
+        for agent, pos in moved:
+            if pos is not None:
+                grid.place_agent(agent, pos)
+
+        # Statistics up to this step
+        events = self.events[self.events["step"] <= step]
+        saved = events[events["reason"] == Reasons.SAVED.value]
+        self.agents_saved = [self.agents[unique_id] for unique_id in saved["unique_id"].tolist()]
+        self.agents_killed = [self.agents[unique_id] for unique_id in
+                              events[events["reason"] == Reasons.KILLED_BY_FIRE.value]["unique_id"].tolist()]
+        self.saved_per_exit = {ext: 0 for ext in self.pos_exits}
+        for x, y in zip(saved["x"].tolist(), saved["y"].tolist()):
+            self.saved_per_exit[(x, y)] += 1
+        self.current_step = step
+
+    def step(self):
+        self.seek(self.current_step + self.speed)
+        self.datacollector.collect(self)
+        # Stop at either end of the recording
+        if self.current_step in (0, self.n_steps - 1):
+            self.running = False
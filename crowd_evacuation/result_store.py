@@ -0,0 +1,208 @@
+import json
+import os
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+
+class ResultStore:
+    """
+    Columnar storage of the results of a batch run, written to disk as every run finishes.
+
+    The store is a directory with one sub-directory per table and one raw binary file per column, plus a schema.json
+    with the type of every column and the number of rows that were completely written. Appending a run only appends
+    bytes at the end of the column files, and loading a column is a np.memmap of its file, so nothing has to be
+    parsed.
+
+    The results of a run (as returned by the model reporters) are split in tables:
+
+    * Scalar values become one row of the "runs" table, next to the run_id, the seed and the run parameters (with
+      the iteration). The run_id identifies the run (see parallel_batch_runner.run_key), so a store holds every run
+      at most once.
+    * Values that are a dict of equally long columns (see batch_run.get_agent_records) are appended to the table
+      with the name of the reporter, with an extra run_id column.
+
+    A metadata.json describes how the results were produced (e.g. the engine that simulated them), so that a batch
+    doesn't resume a store written by a different one (see check_metadata).
+    """
+
+    RUNS = "runs"
+
+    def __init__(self, directory):
+        """
+        Opens the store in directory, creating it if needed. Rows written after the last schema update (e.g. by a
+        run that was interrupted) are dropped.
+
+        Args:
+            directory (str or Path): Directory of the store
+        """
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self._schema_path = self.directory / "schema.json"
+        self._metadata_path = self.directory / "metadata.json"
+        self._run_ids = None  # Loaded the first time they are needed
+        if self._schema_path.exists():
+            with open(self._schema_path) as f:
+                self.schema = json.load(f)
+        else:
+            self.schema = {}  # table to {"rows": number of rows, "columns": {column: dtype}}
+        for table, info in self.schema.items():
+            for column, dtype in info["columns"].items():
+                path = self._column_path(table, column)
+                size = info["rows"] * np.dtype(dtype).itemsize
+                if path.exists() and path.stat().st_size > size:
+                    with open(path, "r+b") as f:
+                        f.truncate(size)
+
+    def _column_path(self, table, column):
+        return self.directory / table / (column + ".bin")
+
+    def _append(self, table, columns):
+        """
+        Appends rows to a table, creating the table the first time.
+
+        Args:
+            table (str): Name of the table
+            columns (dict): Column name to the values of the new rows. Every column has the same length.
+        """
+        columns = {name: np.asarray(values) for name, values in columns.items()}
+        info = self.schema.get(table)
+        if info is None:
+            (self.directory / table).mkdir(exist_ok=True)
+            info = {"rows": 0, "columns": {name: values.dtype.str for name, values in columns.items()}}
+            self.schema[table] = info
+            for name in info["columns"]:
+                # Left over by an interrupted run before the table made it into the schema
+                if self._column_path(table, name).exists():
+                    self._column_path(table, name).unlink()
+        elif set(columns) != set(info["columns"]):
+            raise ValueError("Columns of table {} don't match the stored ones".format(table))
+        n_rows = None
+        for name, dtype in info["columns"].items():
+            values = columns[name].astype(dtype, copy=False)
+            if n_rows is None:
+                n_rows = len(values)
+            elif len(values) != n_rows:
+                raise ValueError("Columns of table {} have different lengths".format(table))
+            with open(self._column_path(table, name), "ab") as f:
+                f.write(values.tobytes())
+        info["rows"] += n_rows
+
+    def _save_schema(self):
+        # Replace the file atomically, so the row counts always describe data that was completely written
+        tmp_path = self._schema_path.with_suffix(".tmp")
+        with open(tmp_path, "w") as f:
+            json.dump(self.schema, f, indent=1)
+        os.replace(tmp_path, self._schema_path)
+
+    def metadata(self):
+        """
+        Returns:
+            (dict): Metadata of the store, None if it has none
+        """
+        if not self._metadata_path.exists():
+            return None
+        with open(self._metadata_path) as f:
+            return json.load(f)
+
+    def check_metadata(self, metadata):
+        """
+        Records the metadata of a new store, or checks that the results already in the store were produced with the
+        same metadata.
+
+        Args:
+            metadata (dict): JSON-serializable description of how the results are produced
+
+        Raises:
+            ValueError: The store already has results produced with different or unknown metadata
+        """
+        stored = self.metadata()
+        if stored is None:
+            if self.run_ids():
+                raise ValueError("The results in {} don't say how they were produced, they can't be resumed"
+                                 .format(self.directory))
+            tmp_path = self._metadata_path.with_suffix(".tmp")
+            with open(tmp_path, "w") as f:
+                json.dump(metadata, f, indent=1)
+            os.replace(tmp_path, self._metadata_path)
+        elif stored != metadata:
+            raise ValueError("The results in {} were produced with {}, not {}".format(self.directory, stored, metadata))
+
+    def append_run(self, run_id, params, seed, reporters):
+        """
+        Writes the results of one run.
+
+        Args:
+            run_id (int): Identifier of the run
+            params (dict): Parameters of the run
+            seed (int): Seed of the run
+            reporters (dict): Reporter name to its value at the end of the run
+
+        Raises:
+            ValueError: The store already has a run with this run_id
+        """
+        if run_id in self._stored_run_ids():
+            raise ValueError("Run {} is already in {}".format(run_id, self.directory))
+        run = {"run_id": [run_id], "seed": [seed]}
+        for name, value in params.items():
+            run[name] = [value]
+        for name, value in reporters.items():
+            if isinstance(value, dict):
+                n_rows = len(next(iter(value.values()), ()))
+                self._append(name, {"run_id": np.full(n_rows, run_id, dtype=np.int64), **value})
+            else:
+                run[name] = [value]
+        self._append(self.RUNS, run)
+        self._save_schema()
+        self._run_ids.add(run_id)
+
+    def _stored_run_ids(self):
+        if self._run_ids is None:
+            if self.RUNS in self.schema:
+                self._run_ids = set(self.column(self.RUNS, "run_id").tolist())
+            else:
+                self._run_ids = set()
+        return self._run_ids
+
+    def run_ids(self):
+        """
+        Returns:
+            (set): Ids of the runs already in the store
+        """
+        return set(self._stored_run_ids())
+
+    def column(self, table, name):
+        """
+        Args:
+            table (str): Name of the table
+            name (str): Name of the column
+
+        Returns:
+            (np.ndarray): Read-only memory map of the column
+        """
+        info = self.schema[table]
+        if info["rows"] == 0:
+            return np.empty(0, dtype=info["columns"][name])
+        return np.memmap(self._column_path(table, name), dtype=info["columns"][name], mode="r",
+                         shape=(info["rows"],))
+
+    def table(self, table):
+        """
+        Args:
+            table (str): Name of the table
+
+        Returns:
+            (dict): Column name to the memory map of the column
+        """
+        return {name: self.column(table, name) for name in self.schema[table]["columns"]}
+
+    def to_dataframe(self, table):
+        """
+        Args:
+            table (str): Name of the table
+
+        Returns:
+            (pd.DataFrame): Copy of the table in memory
+        """
+        return pd.DataFrame({name: np.array(values) for name, values in self.table(table).items()})
@@ -0,0 +1,9 @@
+import argparse
+
+from crowd_evacuation.server import replay_server
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Shows a recorded run in the visualization server')
+    parser.add_argument('directory', type=str,
+                        help='Directory of the recording, the trajectory_dir of the model that was recorded')
+    replay_server(parser.parse_args().directory).launch()
@@ -0,0 +1,97 @@
+import numpy as np
+from mesa.time import BaseScheduler
+
+from crowd_evacuation.cell_types import CellType
+from crowd_evacuation.civilian_agent import CivilianAgent
+
+ACTIVATIONS = ("random", "simultaneous")
+
+
+def resolve_moves(proposals, exit_cells, width):
+    """
+    Resolves the conflicts between moves proposed against the same grid, with array operations over all the proposed
+    cells at once.
+
+    A proposed move is the list of cells an agent walks through, all of them empty in the grid it was proposed on
+    (the last one can be an exit). Since nobody proposes an occupied cell, agents can't swap places or follow each
+    other into a cell being left, and only the cells where they stop have to be different (walking through a cell
+    where someone else stops is what would happen if the agent moved before them). Exits take any number of agents.
+    When several agents want to stop in the same cell, the one with the highest priority gets it, and the others stop
+    in the furthest cell of their move that nobody wants to stop in. If two of them fall back to the same cell, the
+    one with the lowest priority doesn't move.
+
+    Args:
+        proposals (List): Cells proposed by every agent, as lists of (x, y), from the highest to the lowest priority
+        exit_cells (np.ndarray): Flat boolean mask (y * width + x) of the cells that are exits
+        width (int): Width of the grid
+
+    Returns:
+        (np.ndarray): Number of proposed cells every agent walks through, in the order of the proposals
+    """
+    lengths = np.fromiter((len(cells) for cells in proposals), dtype=np.int64, count=len(proposals))
+    total = int(lengths.sum())
+    if total == 0:
+        return lengths
+    n_agents = len(proposals)
+    agents = np.repeat(np.arange(n_agents), lengths)
+    # Position of every cell in its proposal
+    order = np.arange(total) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+    cells = np.array([cell for proposal in proposals for cell in proposal], dtype=np.int64)
+    nodes = cells[:, 1] * width + cells[:, 0]
+    exclusive = ~exit_cells[nodes]
+    # Cells where every agent wants to stop, the highest priority (lowest index) gets it
+    targets = exclusive & (order == lengths[agents] - 1)
+    winners = np.full(exit_cells.size, n_agents, dtype=np.int64)
+    np.minimum.at(winners, nodes[targets], agents[targets])
+    losers = np.zeros(n_agents, dtype=bool)
+    losers[agents[targets]] = winners[nodes[targets]] != agents[targets]
+    # The losers fall back to the furthest cell nobody wants to stop in
+    targeted = winners < n_agents
+    candidates = losers[agents] & exclusive & ~targeted[nodes]
+    allowed = lengths.copy()
+    allowed[losers] = 0
+    np.maximum.at(allowed, agents[candidates], order[candidates] + 1)
+    # Then the same between the losers falling back to the same cell
+    fallbacks = candidates & (order == allowed[agents] - 1)
+    winners[:] = n_agents
+    np.minimum.at(winners, nodes[fallbacks], agents[fallbacks])
+    allowed[agents[fallbacks][winners[nodes[fallbacks]] != agents[fallbacks]]] = 0
+    return allowed
+
+
+class SimultaneousActivation(BaseScheduler):
+    """
+    Alternative to RandomActivation where civilians and stewards move at the same time. Every step:
+
+    1. All civilians and stewards perceive, exchange information and propose a move (CivilianAgent.propose) against
+       the grid as it was at the start of the step, which nobody modifies meanwhile.
+    2. The conflicts between the moves are resolved at once (see resolve_moves), with a priority drawn at random
+       every step from the random generator of the model, so runs with the same seed are identical.
+    3. The moves are applied, and the agents that reached an exit leave the building.
+    4. The rest of the agents (exits and fire) step in random order.
+
+    Unlike RandomActivation, no agent sees where the others moved earlier in the same step, which removes the serial
+    dependency between their decisions at the cost of people getting in each other's way a bit more often.
+    """
+
+    def step(self):
+        agent_keys = list(self._agents.keys())
+        self.model.random.shuffle(agent_keys)  # Order of the proposals, and their priority
+        movers = []
+        others = []
+        for key in agent_keys:
+            agent = self._agents[key]
+            (movers if isinstance(agent, CivilianAgent) else others).append(key)
+        proposals = [self._agents[key].propose() for key in movers]
+        grid = self.model.grid
+        exit_cells = (grid.types == CellType.EXIT).ravel()
+        allowed = resolve_moves([cells for cells, _ in proposals], exit_cells, grid.width)
+        for key, (cells, saved), n_cells in zip(movers, proposals, allowed.tolist()):
+            if n_cells:
+                self._agents[key].move_along(cells[:n_cells], saved and n_cells == len(cells))
+        for key in others:
+            # Fire can remove agents from the schedule before their turn
+            if key in self._agents:
+                self._agents[key].step()
+        self.steps += 1
+        self.time += 1
@@ -1,17 +1,17 @@
+import numpy as np
 from mesa.visualization.ModularVisualization import ModularServer
 from .model import EvacuationModel
-from mesa.visualization.modules import CanvasGrid
 from crowd_evacuation.ChartVisualization import ChartModule
 from crowd_evacuation.BarChartVisualization import BarChartModule
+from crowd_evacuation.DeltaCanvasGridVisualization import DeltaCanvasGrid
 from mesa.visualization.UserParam import UserSettableParameter
 from mesa.visualization.modules import TextElement
 
-from crowd_evacuation.exit_agent import ExitAgent
-from crowd_evacuation.wall_agent import WallAgent
-from crowd_evacuation.fire_agent import FireAgent
-from crowd_evacuation.civilian_agent import CivilianAgent
-from crowd_evacuation.steward_agent import StewardAgent
+from crowd_evacuation.cell_types import CellType
+from crowd_evacuation.floor_plan import e_building
 from crowd_evacuation.introduction_text import IntroductionText
+from crowd_evacuation.replay import ReplayModel
+from crowd_evacuation.trajectory import load_building, load_trajectory
 
 COLORS_FIRE = {"On Fire": "#FF0000",
                "Burned Out": "#800000"}
@@ -26,6 +26,25 @@ class WarningUI(TextElement):
         return text
 
 
+class ProfilingPanel(TextElement):
+    """ Time spent in every phase of the last step, shown when the model is created with profiling enabled. """
+
+    def __init__(self):
+        pass
+
+    def render(self, model):
+        if model.profiler is None or not model.profiler.steps:
+            return ""
+        breakdown = model.profiler.steps[-1]
+        row = "<tr><td>{}</td><td>{:.2f} ms</td><td>{}</td></tr>"
+        rows = "".join(row.format(phase, values["seconds"] * 1000, values["calls"])
+                       for phase, values in breakdown["phases"].items())
+        astar = breakdown["astar"]
+        return ("<h3>Profiling (step {})</h3><table><tr><th>Phase</th><th>Time</th><th>Calls</th></tr>{}</table>"
+                "<p>A* queries: {}, expanded nodes: {} (max {} per query)</p>").format(
+            breakdown["step"], rows, astar["queries"], astar["expansions"], astar["max_expansions"])
+
+
 class StatisticsTitle(TextElement):
     def __init__(self, text):
         self.text = text
@@ -36,7 +55,8 @@ class StatisticsTitle(TextElement):
 
 def agent_portrayal(agent):
     """
-    Determines how an agent will be drawn in the grid
+    Determines how an agent will be drawn in the grid. It's chosen by the cell_type of the agent, so the agents of
+    ReplayModel are drawn like the ones they replace.
     Args:
         agent (Agent): agent to be drawn
 
@@ -48,7 +68,7 @@ def agent_portrayal(agent):
 
     portrayal = {}
 
-    if type(agent) is CivilianAgent:
+    if agent.cell_type == CellType.CIVILIAN:
         portrayal["Shape"] = "circle"
         if agent._age <= 45:
             portrayal["Color"] = "CornflowerBlue"
@@ -58,7 +78,7 @@ def agent_portrayal(agent):
         portrayal["r"] = agent._weight / 100
         portrayal["Layer"] = 1
 
-    elif type(agent) is WallAgent:
+    elif agent.cell_type == CellType.WALL:
         portrayal["Shape"] = "rect"
         portrayal["Color"] = "black"
         portrayal["Filled"] = "true"
@@ -66,7 +86,7 @@ def agent_portrayal(agent):
         portrayal["h"] = 0.8
         portrayal["Layer"] = 0
 
-    elif type(agent) is FireAgent:
+    elif agent.cell_type == CellType.FIRE:
         portrayal["Shape"] = "rect"
         portrayal["Color"] = COLORS_FIRE[agent.condition]
         portrayal["Filled"] = "true"
@@ -74,7 +94,7 @@ def agent_portrayal(agent):
         portrayal["h"] = 1
         portrayal["Layer"] = 2
 
-    elif type(agent) is ExitAgent:
+    elif agent.cell_type == CellType.EXIT:
         portrayal["Shape"] = "rect"
         portrayal["Color"] = "green"
         portrayal["Filled"] = "true"
@@ -83,7 +103,7 @@ def agent_portrayal(agent):
         portrayal["r"] = 0.8
         portrayal["Layer"] = 0
 
-    elif type(agent) is StewardAgent:
+    elif agent.cell_type == CellType.STEWARD:
         portrayal["Shape"] = "circle"
         portrayal["Color"] = "gold"
         portrayal["Filled"] = "true"
@@ -95,20 +115,15 @@ def agent_portrayal(agent):
 
 line_chart = ChartModule([{"Label": "Agents killed", "Color": "red"},
                           {"Label": "Agents saved", "Color": "green"}])
-labels = [(0, 5), (0, 25), (0, 45), (49, 14), (49, 15),
-          (49, 16)]  # hardcoded for now, will not work if exits are changed
-exits_barchart = BarChartModule([{"Label": "Exit {}".format(labels[0]), "Color": "green"},
-                                 {"Label": "Exit {}".format(labels[1]), "Color": "green"},
-                                 {"Label": "Exit {}".format(labels[2]), "Color": "green"},
-                                 {"Label": "Exit {}".format(labels[3]), "Color": "green"},
-                                 {"Label": "Exit {}".format(labels[4]), "Color": "green"},
-                                 {"Label": "Exit {}".format(labels[5]), "Color": "green"}])
+building = e_building(50, 50)  # Building shown by the server
+exits_barchart = BarChartModule([{"Label": "Exit {}".format(ext), "Color": "green"} for ext in building.exits])
 # demographics_agents_perished = PieChartModule([{},
 #                                                {}])
 
 introduction = IntroductionText()
-grid = CanvasGrid(agent_portrayal, 50, 50, 500, 500)
+grid = DeltaCanvasGrid(agent_portrayal, building.width, building.height, 500, 500)
 warnings = WarningUI()
+profiling_panel = ProfilingPanel()
 title_statistics = StatisticsTitle("<h2 style='margin-top:50px'>Statistics</h2><br>")
 
 model_legend = '''
@@ -130,20 +145,60 @@ model_params = {
                                description="Choose how many civilian agents to include in the model"),
     "K": UserSettableParameter('slider', "Number of steward agents", 0, 0, 30, 1,
                                description="Choose how many steward agents to include in the model"),
-    "fire_x": UserSettableParameter('slider', "Fire starting point (x-coordinate)", 1, 1, 48, 1,
+    "fire_x": UserSettableParameter('slider', "Fire starting point (x-coordinate)", 1, 1, building.width - 2, 1,
                                     description="Fire starting point (x-coordinate)"),
-    "fire_y": UserSettableParameter('slider', "Fire starting point (y-coordinate)", 1, 1, 48, 1,
+    "fire_y": UserSettableParameter('slider', "Fire starting point (y-coordinate)", 1, 1, building.height - 2, 1,
                                     description="Fire starting point (y-coordinate)"),
     "civil_info_exchange": UserSettableParameter('checkbox', 'Information exchange between civilians', value=True,
                                                  description="Choose whether civilians will exchange information with each other"),
+    "profile": UserSettableParameter('checkbox', 'Show the time spent in every phase of the step', value=False,
+                                     description="Profile every step of the simulation"),
+    "activation": UserSettableParameter('choice', 'Activation of the agents', value="random",
+                                        choices=["random", "simultaneous"],
+                                        description="Move civilians and stewards one at a time in a random order, or "
+                                                    "all at the same time"),
     "Legend": UserSettableParameter('static_text', value=model_legend),
 
-    "width": 50,
-    "height": 50
+    "floor_plan": building
 }
 
 server = ModularServer(EvacuationModel,
-                       [introduction, warnings, grid, title_statistics,  line_chart, exits_barchart],
+                       [introduction, warnings, grid, title_statistics,  line_chart, exits_barchart, profiling_panel],
                        "Evacuation model",
                        model_params)
 server.port = 8521
+
+
+def replay_server(directory):
+    """
+    Server that shows a run recorded with EvacuationModel(trajectory_dir=...) instead of simulating it, with the same
+    grid and charts as the live server. The grid and the exits of the charts are the ones of the recorded building.
+
+    Args:
+        directory (str): Directory of the recording
+
+    Returns:
+        (ModularServer): Server of a ReplayModel
+    """
+    positions, _ = load_trajectory(directory)
+    last_step = len(positions) - 1
+    layout, _, _ = load_building(directory)
+    height, width = layout.shape
+    ys, xs = np.nonzero(layout == CellType.EXIT)  # In the same order as the exits of ReplayModel
+    replay_grid = DeltaCanvasGrid(agent_portrayal, width, height, 500, 500)
+    replay_exits_barchart = BarChartModule([{"Label": "Exit {}".format((x, y)), "Color": "green"}
+                                            for x, y in zip(xs.tolist(), ys.tolist())])
+    replay_params = {
+        "directory": directory,
+        "start_step": UserSettableParameter('slider', "Start at step", 0, 0, last_step, 1,
+                                            description="Recorded step shown first, reset to jump to it"),
+        "speed": UserSettableParameter('slider', "Recorded steps per step", 1, 1, 20, 1,
+                                       description="How many recorded steps every step of the replay advances"),
+        "backwards": UserSettableParameter('checkbox', 'Play backwards', value=False,
+                                           description="Play the recording from the start step to the beginning"),
+        "Legend": UserSettableParameter('static_text', value=model_legend),
+    }
+    replay = ModularServer(ReplayModel, [replay_grid, title_statistics, line_chart, replay_exits_barchart],
+                           "Evacuation model (replay)", replay_params)
+    replay.port = 8521
+    return replay
@@ -1,3 +1,4 @@
+from crowd_evacuation.cell_types import CellType
 from crowd_evacuation.civilian_agent import CivilianAgent
 
 # The stewards should shout information to people around them. We can simulate this by making them interact
@@ -5,6 +6,8 @@ from crowd_evacuation.civilian_agent import CivilianAgent
 # their surroundings, the stewards will do this also, but the difference is that they will share knowledge of
 # all the exits and make the goal of the civilians around them optimal.
 class StewardAgent(CivilianAgent):
+    cell_type = CellType.STEWARD
+
     def __init__(self, unique_id, model, known_exits):
         super().__init__(unique_id, model, known_exits)
 
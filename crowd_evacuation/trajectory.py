@@ -0,0 +1,143 @@
+import json
+from pathlib import Path
+
+import numpy as np
+
+from crowd_evacuation.cell_types import CellType
+
+# Layout of the event log: step of the event, agent, Reasons value and where it happened (exit or cell on fire)
+EVENT_DTYPE = np.dtype([("step", np.int32), ("unique_id", np.int32), ("reason", np.int8), ("x", np.int16),
+                        ("y", np.int16)])
+# Civilians and stewards of a recording: CellType code, age and weight, indexed by unique_id
+AGENT_DTYPE = np.dtype([("cell_type", np.int8), ("age", np.int16), ("weight", np.float32)])
+
+
+class TrajectoryRecorder:
+    """
+    Records the position of every civilian and steward after every step in a preallocated, memory-mapped array of
+    shape (steps + 1, agents, 2) stored in positions.npy (row 0 holds the initial positions). Agents that are no
+    longer in the building have position (-1, -1). Only the page of the current step has to be in memory, so the
+    RAM used doesn't grow with the length of the run.
+
+    Saved and killed agents are also logged in events.npy, and meta.json says how many steps were recorded. Besides,
+    to draw the recording again:
+
+    * layout.npy: CellType of the walls and exits of the building, shape (height, width)
+    * agents.npy: type, age and weight of every agent (AGENT_DTYPE)
+    * fire.npy: step when every cell caught fire and step when it burned out (-1 if it didn't), shape
+      (2, height, width)
+
+    Use load_trajectory to read a recording without simulating it again.
+    """
+
+    def __init__(self, directory, n_agents, max_steps):
+        """
+        Args:
+            directory (str or Path): Directory where the recording is written
+            n_agents (int): Number of civilians and stewards, unique_ids go from 0 to n_agents - 1
+            max_steps (int): Number of steps that fit in the recording. Later steps aren't recorded.
+        """
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.positions = np.lib.format.open_memmap(self.directory / "positions.npy", mode="w+", dtype=np.int16,
+                                                   shape=(max_steps + 1, n_agents, 2))
+        self.steps = 0  # Number of rows of positions written
+        self._events = []
+        self._saved_events = None  # Number of events in events.npy
+        self.fire = None  # Created with the first recorded step, when the size of the grid is known
+        self._burning = []  # Cells on fire that haven't burned out yet
+
+    def record(self, grid):
+        """
+        Writes the positions of the agents on the grid as the next step.
+
+        Args:
+            grid (LayeredGrid): Grid of the model
+        """
+        if self.steps >= len(self.positions):
+            return
+        ys, xs = np.nonzero(grid.agent_index >= 0)
+        ids = grid.agent_index[ys, xs]
+        if self.steps == 0:
+            self._record_building(grid, xs, ys, ids)
+        frame = self.positions[self.steps]
+        frame[:] = -1
+        frame[ids, 0] = xs
+        frame[ids, 1] = ys
+        self._record_fire(grid)
+        self.steps += 1
+
+    def _record_building(self, grid, xs, ys, ids):
+        layout = np.where(np.isin(grid.types, (CellType.WALL, CellType.EXIT)), grid.types, CellType.EMPTY)
+        np.save(self.directory / "layout.npy", layout)
+        agents = np.zeros(self.positions.shape[1], dtype=AGENT_DTYPE)
+        for x, y, unique_id in zip(xs.tolist(), ys.tolist(), ids.tolist()):
+            agent = grid[x][y]
+            agents[unique_id] = (agent.cell_type, agent._age, agent._weight)
+        np.save(self.directory / "agents.npy", agents)
+        self.fire = np.full((2, grid.height, grid.width), -1, dtype=np.int16)
+
+    def _record_fire(self, grid):
+        # Only the front of the fire is checked for cells that burned out, and the type layer for the new ones
+        still_burning = []
+        for x, y in self._burning:
+            if grid[x][y].condition == "Burned Out":
+                self.fire[1, y, x] = self.steps
+            else:
+                still_burning.append((x, y))
+        ys, xs = np.nonzero((grid.types == CellType.FIRE) & (self.fire[0] == -1))
+        self.fire[0, ys, xs] = self.steps
+        self._burning = still_burning + list(zip(xs.tolist(), ys.tolist()))
+
+    def log_event(self, step, agent, reason, pos):
+        """
+        Args:
+            step (int): Step when it happened
+            agent (Agent): Agent that left the building
+            reason (Reasons): Why it left the building
+            pos (tuple): Exit where the agent was saved, or cell where it died
+        """
+        self._events.append((step, agent.unique_id, reason.value, pos[0], pos[1]))
+
+    def flush(self):
+        """
+        Writes the recording to disk. Called after every step, so a recording of an interrupted run can be read up to
+        its last step.
+        """
+        self.positions.flush()
+        if self._saved_events != len(self._events):
+            np.save(self.directory / "events.npy", np.array(self._events, dtype=EVENT_DTYPE))
+            self._saved_events = len(self._events)
+        np.save(self.directory / "fire.npy", self.fire)
+        with open(self.directory / "meta.json", "w") as f:
+            json.dump({"steps": self.steps, "agents": self.positions.shape[1]}, f)
+
+
+def load_trajectory(directory):
+    """
+    Args:
+        directory (str or Path): Directory of a TrajectoryRecorder
+
+    Returns:
+        (tuple): positions, memory-mapped array of shape (recorded steps, agents, 2), and events, structured array
+        with the fields of EVENT_DTYPE
+    """
+    directory = Path(directory)
+    with open(directory / "meta.json") as f:
+        meta = json.load(f)
+    positions = np.load(directory / "positions.npy", mmap_mode="r")[:meta["steps"]]
+    events = np.load(directory / "events.npy")
+    return positions, events
+
+
+def load_building(directory):
+    """
+    Args:
+        directory (str or Path): Directory of a TrajectoryRecorder
+
+    Returns:
+        (tuple): layout (CellType of the walls and exits), agents (AGENT_DTYPE) and fire (ignition and burn out step
+        of every cell) arrays of the recording
+    """
+    directory = Path(directory)
+    return np.load(directory / "layout.npy"), np.load(directory / "agents.npy"), np.load(directory / "fire.npy")
@@ -1,8 +1,11 @@
 from mesa import Agent
 
+from crowd_evacuation.cell_types import CellType
+
 
 class WallAgent(Agent):
     """ A wall agent."""
+    cell_type = CellType.WALL
 
     def __init__(self, unique_id, model):
         super().__init__(unique_id, model)
\ No newline at end of file